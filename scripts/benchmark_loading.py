@@ -0,0 +1,58 @@
+""" Measure scaling of crop loading from a cube with the number of threads. """
+import os
+import sys
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import make_config
+
+sys.path.append('..')
+from seismiqb import SeismicGeometry
+
+
+
+# Help message
+MSG = """Measure throughput of `load_crop` with different number of threads.
+Crops are sampled uniformly from the cube; slide cache is reset before each run,
+so the disk is actually hit. Consider dropping OS page cache between runs for cold-read numbers.
+"""
+
+# Argname, description, dtype, default
+ARGS = [
+    ('cube-path', 'path to the cube to load crops from', str, None),
+    ('crop-shape', 'shape of crops to load', [int], [1, 256, 256]),
+    ('n-crops', 'number of crops to load for each number of threads', int, 512),
+    ('threads', 'numbers of threads to test', [int], [1, 2, 4, 8, 16]),
+]
+
+
+def sample_locations(geometry, crop_shape, n_crops, seed=42):
+    """ Sample locations of crops uniformly inside the cube. """
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, np.array(geometry.cube_shape) - crop_shape + 1, size=(n_crops, 3))
+    return [[slice(start, start + size) for start, size in zip(point, crop_shape)] for point in starts]
+
+
+if __name__ == '__main__':
+    config = make_config(MSG, ARGS, os.path.basename(__file__).split('.')[0])
+
+    geometry = SeismicGeometry(config['cube-path'])
+    crop_shape = np.array(config['crop-shape'])
+    locations = sample_locations(geometry, crop_shape, config['n-crops'])
+    nbytes = np.prod(crop_shape) * 4 * len(locations)
+
+    baseline = None
+    for n_threads in config['threads']:
+        if hasattr(geometry, '_cached_load'):
+            geometry._cached_load.reset() # pylint: disable=protected-access
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            start = perf_counter()
+            list(executor.map(geometry.load_crop, locations))
+            elapsed = perf_counter() - start
+
+        baseline = baseline or elapsed
+        print(f'{n_threads:>3} threads: {elapsed:8.3f} s, {nbytes / elapsed / 1024**2:9.1f} MB/s, '
+              f'speedup {baseline / elapsed:5.2f}')
@@ -2,8 +2,9 @@
 from .cubeset import SeismicCubeset
 from .crop_batch import SeismicCropBatch
 from .geometry import SeismicGeometry
-from .horizon import UnstructuredHorizon, StructuredHorizon, Horizon
+from .horizon import UnstructuredHorizon, StructuredHorizon, Horizon, TiledMatrix, HorizonCollection
 from .facies import GeoBody
+from .samplers import AliasSampler
 from .metrics import HorizonMetrics, GeometryMetrics, enlarge_carcass_metric, METRIC_CMAP
 from .plotters import plot_image, plot_loss
 from .utils import * # pylint: disable=wildcard-import
@@ -22,6 +22,7 @@ from ...batchflow import B, V, C, D, P, R, W
 from ...batchflow.models.torch import EncoderDecoder
 
 from ..cubeset import SeismicCubeset, Horizon
+from ..horizon import HorizonCollection
 from ..metrics import HorizonMetrics
 from ..plotters import plot_loss, plot_image
 
@@ -54,6 +55,10 @@ class BaseController:
     """
     #pylint: disable=unused-argument, logging-fstring-interpolation, no-member, too-many-public-methods
     #pylint: disable=access-member-before-definition, attribute-defined-outside-init
+
+    # Default method of surface extraction from predicted masks, see `mode` of :meth:`.Horizon.from_mask`
+    MASK_MODE = 'mean'
+
     def __init__(self, batch_size=64, crop_shape=(1, 256, 256),
                  model_config=None, model_path=None, device=None,
                  show_plots=False, save_dir=None, logger=None, bar=True):
@@ -329,6 +334,9 @@ class BaseController:
             chunk_overlap : float
                 Overlap percentage of successive chunks. Must be in 0, 1 range.
 
+            For both versions, `mode` defines how the surface is extracted from the predicted mask,
+            see :meth:`.Horizon.from_mask`. By default, `MASK_MODE` of the class is used.
+
         orientation : {'i', 'x', 'ix'}
             Orientation of the inference:
             If 'i', then cube is split into inline-oriented slices.
@@ -403,9 +411,10 @@ class BaseController:
         return config, crop_shape_grid, strides_grid
 
 
-    def inference_0(self, dataset, heights_range=None, orientation='i', overlap_factor=2, **kwargs):
+    def inference_0(self, dataset, heights_range=None, orientation='i', overlap_factor=2, mode=None, **kwargs):
         """ Inference on chunks, assemble into massive 3D array, extract horizon surface. """
         _ = kwargs
+        mode = mode or self.MASK_MODE
         geometry = dataset.geometries[0]
         spatial_ranges, heights_range = self.make_inference_ranges(dataset, heights_range)
         config, crop_shape_grid, strides_grid = self.make_inference_config(orientation, overlap_factor)
@@ -421,12 +430,15 @@ class BaseController:
             batch = inference_pipeline.next_batch(D('size'))
 
         # Convert to Horizon instances
-        return Horizon.from_mask(batch.assembled_pred, dataset.grid_info, threshold=0.5, minsize=50)
+        return Horizon.from_mask(batch.assembled_pred, dataset.grid_info, mode=mode, threshold=0.5, minsize=50)
 
     def inference_1(self, dataset, heights_range=None, orientation='i', overlap_factor=2,
-                    chunk_size=100, chunk_overlap=0.2, **kwargs):
+                    chunk_size=100, chunk_overlap=0.2, *, mode=None, **kwargs):
         """ Split area for inference into `big` chunks, inference on each of them, merge results. """
         _ = kwargs
+        mode = mode or self.MASK_MODE
+        # Surface is picked only where the model is confident; components are made of any positive predictions
+        threshold = 0.5 if mode == 'argmax' else 0.0
         geometry = dataset.geometries[0]
         spatial_ranges, heights_range = self.make_inference_ranges(dataset, heights_range)
         config, crop_shape_grid, strides_grid = self.make_inference_config(orientation, overlap_factor)
@@ -448,8 +460,8 @@ class BaseController:
             for _ in range(dataset.grid_iters):
                 batch = inference_pipeline.next_batch(D('size'))
 
-            chunk_horizons = Horizon.from_mask(batch.assembled_pred,
-                                               dataset.grid_info, threshold=0.0, minsize=50)
+            chunk_horizons = Horizon.from_mask(batch.assembled_pred, dataset.grid_info,
+                                               mode=mode, threshold=threshold, minsize=50)
             horizons.extend(chunk_horizons)
 
         return Horizon.merge_list(horizons, mean_threshold=5.5, adjacency=3, minsize=500)
@@ -480,11 +492,18 @@ class BaseController:
         If targets are provided, also l1 differences.
         """
         #pylint: disable=cell-var-from-loop, invalid-name, protected-access
+        # Cut data along all the evaluated horizons in one pass over the cube: only bounding boxes are stored,
+        # and each of them is put into the array of the whole cube when the horizon is evaluated
+        data_list = Horizon.get_cube_values_many(self.predictions[:n])
+        # Stats of targets are stacked once to compare every prediction against all of them at once
+        targets = HorizonCollection(self.targets) if self.targets else None
+
         results = []
         for i in range(n):
             info = {}
             horizon = self.predictions[i]
-            horizon._horizon_metrics = None
+            horizon._horizon_metrics = HorizonMetrics(horizon, data=data_list[i])
+            data_list[i] = None
             prefix = [horizon.geometry.short_name, f'{i}_horizon'] if add_prefix else []
 
             # Basic demo: depth map and properties
@@ -500,7 +519,7 @@ class BaseController:
                     savepath=self.make_save_path(*prefix, name + 'corrs.png')
                 )
 
-            hm = HorizonMetrics((horizon, self.targets))
+            hm = HorizonMetrics((horizon, targets), data=horizon._horizon_metrics.data)
             # Instantaneous phase
             local_corrs = hm.evaluate(
                 'local_corrs',
@@ -532,6 +551,9 @@ class BaseController:
             self.log(f'horizon {i}: len {len(horizon)}, cov {horizon.coverage:4.4}, '
                      f'corrs {info["corrs"]:4.4}, local corrs {info["local_corrs"]:4.4}, depth {horizon.h_mean}')
 
+            # Release data of the current horizon: it is re-created on demand
+            horizon._horizon_metrics = None
+            del hm
         return results
 
 
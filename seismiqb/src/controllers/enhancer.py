@@ -19,6 +19,9 @@ class Enhancer(BaseController):
     """
     #pylint: disable=unused-argument, logging-fstring-interpolation, no-member
 
+    # Only one surface is predicted in each crop
+    MASK_MODE = 'argmax'
+
     def train(self, horizon, **kwargs):
         """ Train model for horizon extension.
         Creates dataset and sampler for a given horizon and calls `meth:Detector.train`.
@@ -10,6 +10,7 @@ import torch
 from ...batchflow import Pipeline, B, V, C, D, P, R, L
 
 from ..horizon import Horizon
+from ..metrics import HorizonMetrics
 
 from .enhancer import Enhancer
 from .best_practices import MODEL_CONFIG_EXTENSION
@@ -22,7 +23,7 @@ class Extender(Enhancer):
     """
     #pylint: disable=unused-argument, logging-fstring-interpolation, no-member, attribute-defined-outside-init
 
-    def inference(self, horizon, n_steps=30, batch_size=128, stride=16):
+    def inference(self, horizon, n_steps=30, batch_size=128, stride=16, metric=None):
         """Extend, i.e. fill the holes of the given horizon with the
         Horizon Extension algorithm using loaded/trained model.
         For each step of the Extension algorithm crops close to the horizon boundaries
@@ -40,6 +41,10 @@ class Extender(Enhancer):
             Size of batches for train and inference.
         stride : int
             Distance between a horizon border and a corner of sampled crop that is fed to the model.
+        metric : str, optional
+            If provided, then name of the metric to evaluate on the horizon after each step, for example,
+            `local_corrs`. Only the changed part of the horizon is re-evaluated on each step.
+            Averaged values are stored in `step_metrics` attribute.
 
         Logs
         ----
@@ -52,6 +57,8 @@ class Extender(Enhancer):
             'model_pipeline': self.model_pipeline
         }
         horizon = copy(horizon)
+        horizon_metrics = HorizonMetrics(horizon) if metric is not None else None
+        self.step_metrics = []
 
         prev_len = len(horizon)
         self.log(f'Inference started for {n_steps} with stride {stride}.')
@@ -81,6 +88,11 @@ class Extender(Enhancer):
                 if merge_code == 3:
                     _ = horizon.overlap_merge(hor, inplace=True)
 
+            if horizon_metrics is not None:
+                value = np.nanmean(horizon_metrics.evaluate(metric))
+                self.step_metrics.append(value)
+                self.log(f'Value of {metric} after the step: {value:.4}')
+
             curr_len = len(horizon)
             if (curr_len - prev_len) < 25:
                 break
@@ -130,7 +142,7 @@ class Extender(Enhancer):
                            fetches='predictions',
                            save_to=B('predicted_masks', mode='w'))
             .transpose(src='predicted_masks', order=(1, 2, 0))
-            .masks_to_horizons(src='predicted_masks', threshold=0.5, minsize=16,
+            .masks_to_surfaces(src='predicted_masks', threshold=0.5, minsize=16,
                                order=L(D('orders_gen')), dst='horizons', skip_merge=True)
             .update(V('predicted_horizons', mode='e'), B('horizons'))
         )
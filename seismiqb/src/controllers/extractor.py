@@ -10,6 +10,7 @@ from ...batchflow import Pipeline, B, V, C, D, P, R
 from ...batchflow.models.torch import EncoderDecoder
 
 from ..cubeset import Horizon, HorizonMetrics
+from ..horizon import HorizonCollection
 
 from .base import BaseController
 
@@ -61,8 +62,11 @@ class Extractor(BaseController):
     def inference_1(self, dataset, heights_range=None, orientation='i', overlap_factor=2,
                     filter=True,
                     thresholds=None, coverage_threshold=0.5, std_threshold=5., metric_threshold=0.5,
-                    chunk_size=100, chunk_overlap=0.2, minsize=10000, **kwargs):
-        """ Split area for inference into `big` chunks, inference on each of them, merge results. """
+                    chunk_size=100, chunk_overlap=0.2, minsize=10000, metric_batch_size=8, **kwargs):
+        """ Split area for inference into `big` chunks, inference on each of them, merge results.
+        Metrics of horizons are computed in groups of `metric_batch_size`: data along all of them
+        is cut in one pass over the cube.
+        """
         #pylint: disable=redefined-builtin, too-many-branches
         _ = kwargs
         thresholds = thresholds or np.arange(0.2, 1.0, 0.1)
@@ -105,7 +109,7 @@ class Extractor(BaseController):
         merged_horizons = Horizon.merge_list(merged_horizons, mean_threshold=0.5)
         del storage
 
-        filtered_horizons = []
+        candidates = []
         for horizon in merged_horizons:
             # CHECK 1: coverage
             if horizon.coverage >= coverage_threshold:
@@ -117,40 +121,41 @@ class Extractor(BaseController):
                 std_coeff = np.std(matrix)
 
                 if std_coeff <= std_threshold:
-
-                    # CHECK 3: metric
-                    hm = HorizonMetrics(horizon)
-                    corrs = hm.evaluate('support_corrs', supports=50, agg='nanmean')
-
-                    if filter:
-                        horizon.filter(filtering_matrix=(corrs <= metric_threshold).astype(np.int32))
-                        if horizon.coverage <= coverage_threshold:
-                            continue
-
-                    corr_coeff = np.nanmean(corrs)
-
-                    if corr_coeff >= metric_threshold:
-                        horizon._corr_coeff = corr_coeff
-                        filtered_horizons.append(horizon)
-                        self.log(f'depth: {horizon.h_mean:6.6}; cov: {horizon.coverage:6.6};'
-                                 f' std: {std_coeff:6.6}; metric: {corr_coeff:6.6}')
+                    candidates.append((horizon, std_coeff))
         del merged_horizons
 
-
-        horizons = []
-        for horizon in filtered_horizons:
-            for i, already_stored in enumerate(horizons):
-
-                if abs(horizon.h_mean - already_stored.h_mean) < 2.:
-                    if horizon._corr_coeff > already_stored._corr_coeff:
-                        _ = horizons.pop(i)
-                        horizons.append(horizon)
-                        break
-                    break
-            else:
-                horizons.append(horizon)
-
-        return horizons
+        # CHECK 3: metric. Data along multiple horizons is cut in one pass over the cube
+        filtered_horizons = []
+        for start in range(0, len(candidates), metric_batch_size):
+            group = candidates[start:start + metric_batch_size]
+            # Only bounding boxes are cut: data is put into the array of the whole cube one horizon at a time
+            data_list = Horizon.get_cube_values_many([horizon for horizon, _ in group])
+
+            for k, (horizon, std_coeff) in enumerate(group):
+                hm = HorizonMetrics(horizon, data=data_list[k])
+                data_list[k] = None
+                corrs = hm.evaluate('support_corrs', supports=50, agg='nanmean')
+
+                if filter:
+                    horizon.filter(filtering_matrix=(corrs <= metric_threshold).astype(np.int32))
+                    if horizon.coverage <= coverage_threshold:
+                        continue
+
+                corr_coeff = np.nanmean(corrs)
+
+                if corr_coeff >= metric_threshold:
+                    horizon._corr_coeff = corr_coeff
+                    filtered_horizons.append(horizon)
+                    self.log(f'depth: {horizon.h_mean:6.6}; cov: {horizon.coverage:6.6};'
+                             f' std: {std_coeff:6.6}; metric: {corr_coeff:6.6}')
+            del data_list
+        del candidates
+
+
+        # Keep only the best horizon among ones with close mean depths
+        scores = [horizon._corr_coeff for horizon in filtered_horizons]
+        horizons = HorizonCollection(filtered_horizons).deduplicate(scores, threshold=2.)
+        return horizons.horizons
 
 
 
@@ -7,6 +7,8 @@ from .base import BaseController
 
 class CarcassInterpolator(BaseController):
     """ Detector with convenient defaults to create a 2D surface from a sparce labeled carcass. """
+    # Only one surface is predicted in each crop
+    MASK_MODE = 'argmax'
 
     def train(self, dataset=None, horizon=None, **kwargs):
         """ Train model on a sparce labeled carcass. """
@@ -33,6 +35,9 @@ class GridInterpolator(BaseController):
     """ Detector with convenient defaults to create a sparce carcass from a horizon by using a quality
     grid with supplied frequencies. Then, spread it to the whole cube spatial range.
     """
+    # Only one surface is predicted in each crop
+    MASK_MODE = 'argmax'
+
     def train(self, dataset=None, horizon=None, frequencies=(200, 200), **kwargs):
         """ Create a grid for a horizon, then train model on it. """
         if dataset is None and horizon is not None:
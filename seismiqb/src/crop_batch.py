@@ -1,4 +1,5 @@
 """ Seismic Crop Batch."""
+#pylint: disable=too-many-lines
 import string
 import random
 from copy import copy
@@ -12,7 +13,7 @@ from ..batchflow import FilesIndex, Batch, action, inbatch_parallel
 from ..batchflow.batch_image import transform_actions # pylint: disable=no-name-in-module,import-error
 
 from .horizon import Horizon
-from .utils import aggregate
+from .utils import aggregate, location_bounds, extract_surface, LabelIndex
 from .plotters import plot_image
 
 
@@ -219,30 +220,39 @@ class SeismicCropBatch(Batch):
 
 
     def _make_slice(self, point, shape, loc=(0, 0, 0)):
-        """ Creates list of `np.arange`'s for desired location. """
+        """ Creates list of slices for desired location.
+        Crops are moved inside the cube, if needed; crops bigger than the cube raise an error.
+        """
+        cube_shape = np.array(self.get(point[0], 'geometries').cube_shape)
+        if (np.array(shape) > cube_shape).any():
+            raise ValueError(f'Crop of {tuple(shape)} shape does not fit into the cube of {tuple(cube_shape)} shape.')
+
         if isinstance(point[1], float) or isinstance(point[2], float) or isinstance(point[3], float):
-            ix = point[0]
-            cube_shape = np.array(self.get(ix, 'geometries').cube_shape)
             slice_point = np.rint(point[1:].astype(float) * (cube_shape - np.array(shape))).astype(int)
         else:
             slice_point = point[1:]
 
         slice_ = []
         for i in range(3):
-            start_point = int(max(slice_point[i] - loc[i]*shape[i], 0))
+            start_point = int(min(max(slice_point[i] - loc[i]*shape[i], 0), cube_shape[i] - shape[i]))
             end_point = start_point + shape[i]
-            slice_.append(np.arange(start_point, end_point))
+            slice_.append(slice(start_point, end_point))
         return slice_
 
     def _correct_point_to_grid(self, point, shape, grid_src='quality_grid', eps=3):
-        """ Move the point to the closest location in the quality grid. """
+        """ Move the point to the closest location in the quality grid.
+        Point can be either in the unit cube or in cube coordinates, as in :meth:`._make_slice`.
+        """
         #pylint: disable=too-many-return-statements
         ix = point[0]
         geometry = self.get(ix, 'geometries')
         grid = getattr(geometry, grid_src) if isinstance(grid_src, str) else grid_src
         shape_t = shape[[1, 0, 2]]
 
-        pnt = (point[1:] * geometry.cube_shape)
+        # Points from the unit cube are converted to cube coordinates to look them up in the grid
+        unit = isinstance(point[1], float) or isinstance(point[2], float) or isinstance(point[3], float)
+
+        pnt = point[1:] * geometry.cube_shape if unit else point[1:]
         pnt = np.rint(pnt.astype(float)).astype(int)
 
         # Point is already in grid
@@ -258,7 +268,7 @@ class SeismicCropBatch(Batch):
             if grid[pnt[0], pnt_] == 1:
                 sum_i = np.nansum(grid[pnt[0], max(pnt_-eps, 0):pnt_+eps])
                 sum_x = np.nansum(grid[max(pnt[0]-eps, 0):pnt[0]+eps, pnt_])
-                point[1:3] = np.array((pnt[0], pnt_)) / geometry.cube_shape[:2]
+                point[1:3] = np.array((pnt[0], pnt_)) / geometry.cube_shape[:2] if unit else (pnt[0], pnt_)
                 if sum_i >= sum_x:
                     return point, shape
                 return point, shape_t
@@ -268,7 +278,7 @@ class SeismicCropBatch(Batch):
             if grid[pnt_, pnt[1]] == 1:
                 sum_i = np.nansum(grid[pnt_, max(pnt[1]-eps, 0) : pnt[1]+eps])
                 sum_x = np.nansum(grid[max(pnt_-eps, 0) : pnt_+eps, pnt[1]])
-                point[1:3] = np.array((pnt_, pnt[1])) / geometry.cube_shape[:2]
+                point[1:3] = np.array((pnt_, pnt[1])) / geometry.cube_shape[:2] if unit else (pnt_, pnt[1])
                 if sum_i >= sum_x:
                     return point, shape
                 return point, shape_t
@@ -279,9 +289,9 @@ class SeismicCropBatch(Batch):
 
 
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
-    def load_cubes(self, ix, dst, src='slices', **kwargs):
+    def load_cubes(self, dst, src='slices', **kwargs):
         """ Load data from cube in given positions.
+        All the crops from the same cube are loaded at once, so data shared by multiple crops is read only once.
 
         Parameters
         ----------
@@ -289,16 +299,25 @@ class SeismicCropBatch(Batch):
             Component of batch with positions of crops to load.
         dst : str
             Component of batch to put loaded crops in.
+        kwargs : dict
+            Passed directly to :meth:`.SeismicGeometry.load_crops`.
         """
-        #pylint: disable=unused-argument
-        geom = self.get(ix, 'geometries')
-        slice_ = self.get(ix, src)
-        return geom.load_crop(slice_, **kwargs)
+        groups = {}
+        for i, ix in enumerate(self.indices):
+            geom = self.get(ix, 'geometries')
+            groups.setdefault(id(geom), (geom, []))[1].append(i)
+
+        crops = [None] * len(self.indices)
+        for geom, positions in groups.values():
+            locations_list = [self.get(self.indices[i], src) for i in positions]
+            for i, crop in zip(positions, geom.load_crops(locations_list, **kwargs)):
+                crops[i] = crop
+        return self._assemble(crops, dst=dst)
 
 
     @action
     @inbatch_parallel(init='indices', post='_assemble', target='for')
-    def create_masks(self, ix, dst, src='slices', width=3, src_labels='labels', indices=-1):
+    def create_masks(self, ix, dst, src='slices', width=3, src_labels='labels', indices=-1, src_volume=None):
         """ Create masks from labels-dictionary in given positions.
 
         Parameters
@@ -319,6 +338,10 @@ class SeismicCropBatch(Batch):
             and must be ints in range [0, len(horizons) - 1].
             Note if you want to pass an index of a single label it must be a list with one
             element.
+        src_volume : str, optional
+            If provided, then masks are cut from the volume of labels, stored in this attribute,
+            for example, `label_geometries` (see :meth:`.SeismicCubeset.create_label_volume`),
+            instead of rasterizing each label; `width` of such volume is fixed at its creation.
 
         Returns
         -------
@@ -328,11 +351,14 @@ class SeismicCropBatch(Batch):
         Notes
         -----
         Can be run only after labels-dict is loaded into labels-component.
+        If the dataset has a valid index of labels (see :meth:`.SeismicCubeset.create_labels`), then only labels
+        that cross the crop are added; otherwise, every label is tried.
         """
         #pylint: disable=unused-argument
         labels = self.get(ix, src_labels) if isinstance(src_labels, str) else src_labels
         labels = [labels] if not isinstance(labels, (tuple, list)) else labels
         check_sum = False
+        slice_ = self.get(ix, src)
 
         if indices in [-1, 'all']:
             indices = np.arange(0, len(labels))
@@ -344,9 +370,28 @@ class SeismicCropBatch(Batch):
             raise ValueError('Inidices should be either -1, 1 or a sequence of ints.')
         elif isinstance(indices, (tuple, list, np.ndarray)):
             pass
+
+        # Cut ids of labels from the precomputed volume
+        if src_volume is not None:
+            ids = self.get(ix, src_volume).load_crop(slice_)
+            if check_sum:
+                mask = np.zeros_like(ids, dtype=bool)
+                for idx in indices:
+                    mask = ids == idx + 1
+                    if mask.any():
+                        break
+                return mask.astype('float32')
+            return np.isin(ids, np.asarray(indices) + 1).astype('float32')
+
+        # Keep only labels that cross the crop
+        index = None
+        if isinstance(src_labels, str) and hasattr(self.dataset, f'{src_labels}_index'):
+            index = self.get(ix, f'{src_labels}_index')
+        if isinstance(index, LabelIndex) and index.is_valid(labels):
+            candidates = set(index.query(slice_).tolist())
+            indices = [idx for idx in indices if idx in candidates]
         labels = [labels[idx] for idx in indices]
 
-        slice_ = self.get(ix, src)
         shape_ = self.get(ix, 'shapes')
         mask = np.zeros((shape_), dtype='float32')
 
@@ -517,7 +562,7 @@ class SeismicCropBatch(Batch):
         threshold : float
             parameter of mask-thresholding.
         averaging : str
-            method of pandas.groupby used for finding the center of a horizon.
+            method used for finding the center of a horizon, see `mode` of :meth:`.Horizon.from_mask`.
         coordinates : str
             coordinates-mode to use for keys of point-cloud. Can be either 'cubic'
             or 'lines'. In case of `lines`-option, `geometries` must be loaded as
@@ -548,14 +593,42 @@ class SeismicCropBatch(Batch):
         geom = self.get(ix, 'geometries')
         grid_info = {
             'geom': geom,
-            'range': [[self.get(ix, src_slices)[k][0], None] for k in range(3)]
+            'range': [[location_bounds(self.get(ix, src_slices)[k])[0], None] for k in range(3)]
         }
 
         # get horizons and merge them with matching aggregated ones
         horizons = Horizon.from_mask(mask, grid_info, threshold=threshold,
-                                     averaging=averaging, minsize=minsize, prefix=prefix)
+                                     mode=averaging, minsize=minsize, prefix=prefix)
         return horizons
 
+    @action
+    def masks_to_surfaces(self, src='masks', src_slices='slices', dst='predicted_labels', prefix='predict',
+                          threshold=0.5, minsize=0, order=(2, 0, 1), skip_merge=False,
+                          mean_threshold=2.0, adjacency=1):
+        """ Convert masks with one surface in each of them into horizons: for each trace, depth of the maximum
+        value is taken, if this value is greater or equal to `threshold`.
+        Masks of the same shape are stacked and processed at once. Resulting horizons are merged to the ones
+        in `dst` in the same way, as in :meth:`.masks_to_horizons`, parameters of which are used here.
+        """
+        orders = np.array(order).reshape(-1, 3)
+        masks = []
+        for ix in self.indices:
+            pos = self.get_pos(None, src, ix)
+            masks.append(np.transpose(getattr(self, src)[pos], axes=orders[pos % len(orders)]))
+
+        if len({mask.shape for mask in masks}) == 1:
+            depths, confident = extract_surface(np.stack(masks), threshold=threshold)
+        else:
+            depths, confident = zip(*[extract_surface(mask, threshold=threshold) for mask in masks])
+
+        horizons_lists = []
+        for k, ix in enumerate(self.indices):
+            shifts = np.array([location_bounds(item)[0] for item in self.get(ix, src_slices)])
+            horizons_lists.append(Horizon.from_surface(depths[k], confident[k], geometry=self.get(ix, 'geometries'),
+                                                       shifts=shifts, minsize=minsize, prefix=prefix, index=k))
+        return self._masks_to_horizons_post(horizons_lists, dst=dst, skip_merge=skip_merge,
+                                            mean_threshold=mean_threshold, adjacency=adjacency)
+
 
     def _masks_to_horizons_post(self, horizons_lists, *args, dst=None, skip_merge=False,
                                 mean_threshold=2.0, adjacency=1, **kwargs):
@@ -1,8 +1,10 @@
 """ Contains container for storing dataset of seismic crops. """
 #pylint: disable=too-many-lines
+import os
 from glob import glob
 
 import numpy as np
+import h5py
 
 from ..batchflow import Dataset, Sampler, DatasetIndex, Pipeline
 from ..batchflow import NumpySampler, ConstantSampler
@@ -12,8 +14,9 @@ from .crop_batch import SeismicCropBatch
 
 from .horizon import Horizon, UnstructuredHorizon
 from .metrics import HorizonMetrics
+from .samplers import AliasSampler
 from .plotters import plot_image
-from .utils import IndexedDict, round_to_array, gen_crop_coordinates
+from .utils import IndexedDict, LabelIndex, round_to_array, gen_crop_coordinates, make_index, FILE_POOL
 
 
 
@@ -113,15 +116,25 @@ class SeismicCubeset(Dataset):
             self.geometries[ix].make_hdf5(postfix=postfix)
 
 
-    def create_labels(self, paths=None, filter_zeros=True, dst='labels', labels_class=None, **kwargs):
+    def create_labels(self, paths=None, filter_zeros=True, dst='labels', labels_class=None,
+                      horizon_names=None, depth_range=None, index_tile_size=128, **kwargs):
         """ Create labels (horizons, facies, etc) from given paths.
+        Also creates spatial index of labels for each cube in the `{dst}_index` attribute: it is used
+        to quickly find labels that cross a crop in :meth:`.SeismicCropBatch.create_masks`.
 
         Parameters
         ----------
         paths : dict
             Mapping from indices to txt paths with labels.
+            Paths to HDF5 containers with multiple horizons, created by :meth:`.Horizon.dump_many`, are also allowed.
         dst : str
             Name of attribute to put labels in.
+        horizon_names : sequence of str, optional
+            Names of horizons to load from containers. By default, all of them are loaded.
+        depth_range : sequence of two numbers, optional
+            If provided, only horizons intersecting with this depth range are loaded from containers.
+        index_tile_size : int or None
+            Size of spatial tiles in the index of labels. If None, then no index is created.
 
         Returns
         -------
@@ -130,6 +143,8 @@ class SeismicCubeset(Dataset):
         """
         if not hasattr(self, dst):
             setattr(self, dst, IndexedDict({ix: dict() for ix in self.indices}))
+        if index_tile_size is not None:
+            setattr(self, f'{dst}_index', IndexedDict({ix: None for ix in self.indices}))
 
         for ix in self.indices:
             if labels_class is None:
@@ -138,12 +153,88 @@ class SeismicCubeset(Dataset):
                 else:
                     labels_class = UnstructuredHorizon
 
-            label_list = [labels_class(path, self.geometries[ix], **kwargs) for path in paths[ix]]
+            label_list = []
+            for path in paths[ix]:
+                if os.path.splitext(path)[1][1:] in Horizon.CONTAINER_ALIASES:
+                    label_list.extend(Horizon.load_many(path, self.geometries[ix], names=horizon_names,
+                                                        depth_range=depth_range, **kwargs))
+                else:
+                    label_list.append(labels_class(path, self.geometries[ix], **kwargs))
             label_list.sort(key=lambda label: label.h_mean)
             if filter_zeros:
                 _ = [getattr(item, 'filter')() for item in label_list]
             getattr(self, dst)[ix] = label_list
 
+            if index_tile_size is not None:
+                getattr(self, f'{dst}_index')[ix] = LabelIndex(label_list, tile_size=index_tile_size)
+
+    def create_label_volume(self, src_labels='labels', width=3, postfix='_labels', dst='label_geometries',
+                            chunk_size=64):
+        """ Rasterize all the labels of each cube into an on-disk volume with the same projections as HDF5 cubes.
+        Each voxel contains `1 + index` of the label in the list of labels (later labels overwrite earlier ones),
+        or zero, if there is no label at that place. Volume is stored as `uint8` if possible, `uint16` otherwise.
+
+        The volume is opened as a geometry, so that masks can be cut from it with `load_crop`: see `src_volume`
+        parameter of :meth:`.SeismicCropBatch.create_masks`. Note that it must be re-created if labels are changed:
+        the new volume replaces the file of the previous one, which is closed.
+
+        Parameters
+        ----------
+        src_labels : str
+            Attribute with labels.
+        width : int
+            Width of horizons in the volume.
+        postfix : str
+            Postfix to add to the name of the cube to get the path of the volume.
+        dst : str
+            Attribute to put geometries of volumes in.
+        chunk_size : int
+            Number of ilines rasterized at a time.
+        """
+        previous = getattr(self, dst, None) or {}
+        setattr(self, dst, IndexedDict({ix: None for ix in self.indices}))
+
+        for ix in self.indices:
+            geometry = self.geometries[ix]
+            labels = getattr(self, src_labels)[ix]
+            if len(labels) > np.iinfo(np.uint16).max:
+                raise ValueError(f'Too many labels to put into one volume: {len(labels)}.')
+            dtype = np.uint8 if len(labels) <= np.iinfo(np.uint8).max else np.uint16
+            path = os.path.splitext(geometry.path)[0] + postfix + '.hdf5'
+            ilines_len, xlines_len, depth = geometry.cube_shape
+
+            # Volume is written to a temporary file, so that the previous one stays valid for its current users
+            path_tmp = path + '.tmp'
+            with h5py.File(path_tmp, 'w') as file_hdf5:
+                cube = file_hdf5.create_dataset('cube', (ilines_len, xlines_len, depth), dtype=dtype)
+                cube_x = file_hdf5.create_dataset('cube_x', (xlines_len, depth, ilines_len), dtype=dtype)
+                cube_h = file_hdf5.create_dataset('cube_h', (depth, ilines_len, xlines_len), dtype=dtype)
+
+                for start in range(0, ilines_len, chunk_size):
+                    stop = min(start + chunk_size, ilines_len)
+                    locations = [slice(start, stop), slice(0, xlines_len), slice(0, depth)]
+
+                    chunk = np.zeros((stop - start, xlines_len, depth), dtype=dtype)
+                    for idx, label in enumerate(labels):
+                        label.add_to_mask(chunk, locations=locations, width=width, alpha=idx + 1)
+
+                    cube[start:stop] = chunk
+                    cube_x[:, :, start:stop] = chunk.transpose(1, 2, 0)
+                    cube_h[:, start:stop, :] = chunk.transpose(2, 0, 1)
+
+                for attr in geometry.PRESERVED:
+                    if hasattr(geometry, attr) and getattr(geometry, attr) is not None:
+                        file_hdf5['/info/' + attr] = getattr(geometry, attr)
+
+            # Close handlers of the previous volume: they would be re-opened on the new file
+            if previous.get(ix) is not None:
+                previous[ix].file_hdf5.close()
+                previous[ix].memmaps = {}
+            FILE_POOL.close(path)
+            os.replace(path_tmp, path)
+
+            getattr(self, dst)[ix] = SeismicGeometry(path)
+
     @property
     def sampler(self):
         """ Lazily create sampler at the time of first access. """
@@ -166,6 +257,9 @@ class SeismicCubeset(Dataset):
         mode : str or Sampler
             Type of sampler to be created.
             If 'hist' or 'horizon', then sampler is estimated from given labels.
+            If 'alias', then one :class:`.AliasSampler` is created for labels of all cubes: `kwargs` are passed
+            to :meth:`.AliasSampler.from_labels`. Note that it generates points in cube coordinates, unless `unit`
+            is set to True. Pass `crop_shape` to generate starts of crops, that contain label points.
             If 'numpy', then sampler is created with `kwargs` parameters.
             If instance of Sampler is provided, it must generate points from unit cube.
         p : list
@@ -180,6 +274,14 @@ class SeismicCubeset(Dataset):
         Passed `dataset` must have `geometries` and `labels` attributes if you want to create HistoSampler.
         """
         #pylint: disable=cell-var-from-loop
+        if mode == 'alias':
+            _ = kwargs.pop('bins', None) # histogram bins are replaced with `bin_size`
+            self.samplers = {ix: AliasSampler.from_labels({ix: self.labels[ix]}, self.geometries, **kwargs)
+                             for ix in self.indices}
+            labels = {ix: self.labels[ix] for ix in self.indices}
+            setattr(self, dst, AliasSampler.from_labels(labels, self.geometries, p=p, **kwargs))
+            return
+
         lowcut, highcut = [0, 0, 0], [1, 1, 1]
         transforms = transforms or dict()
 
@@ -239,6 +341,7 @@ class SeismicCubeset(Dataset):
             Shift grid for previous parameter.
         to_cube : bool
             Transform sampled values to each cube coordinates.
+            Points of :class:`.AliasSampler` are already in cube coordinates, unless it is created with `unit`.
         post : callable
             Additional function to apply to sampled points.
         finish : bool
@@ -264,6 +367,8 @@ class SeismicCubeset(Dataset):
 
         # Parsing arguments
         sampler = getattr(self, src)
+        # Samplers, marked with `unit=False`, generate points in cube coordinates
+        cube_coordinates = getattr(sampler, 'unit', True) is False
 
         mapping = {'ilines': 0, 'xlines': 1, 'heights': 2,
                    'iline': 0, 'xline': 1, 'i': 0, 'x': 1, 'h': 2}
@@ -274,8 +379,13 @@ class SeismicCubeset(Dataset):
 
         # Keep only points from region
         if (low != 0) or (high != 1):
-            sampler = sampler.truncate(low=low, high=high, prob=high-low,
-                                       expr=lambda p: p[:, axis+1])
+            def get_position(array):
+                if cube_coordinates:
+                    lengths = np.array([self.geometries[name].cube_shape[axis] for name in array[:, 0]])
+                    return array[:, axis+1].astype(float) / lengths
+                return array[:, axis+1]
+
+            sampler = sampler.truncate(low=low, high=high, prob=high-low, expr=get_position)
 
         # Keep only every `each`-th point
         if each is not None:
@@ -285,14 +395,19 @@ class SeismicCubeset(Dataset):
                     ticks = np.arange(each_start, shape, each)
                     name_idx = np.asarray(array[:, 0] == cube_name).nonzero()
 
-                    arr = np.rint(array[array[:, 0] == cube_name][:, axis+1].astype(float)*shape).astype(int)
-                    array[name_idx, np.full_like(name_idx, axis+1)] = round_to_array(arr, ticks).astype(float) / shape
+                    arr = array[array[:, 0] == cube_name][:, axis+1]
+                    if cube_coordinates:
+                        arr = round_to_array(arr.astype(int), ticks)
+                    else:
+                        arr = np.rint(arr.astype(float)*shape).astype(int)
+                        arr = round_to_array(arr, ticks).astype(float) / shape
+                    array[name_idx, np.full_like(name_idx, axis+1)] = arr
                 return array
 
             sampler = sampler.apply(filter_out)
 
         # Change representation of points from unit cube to cube coordinates
-        if to_cube:
+        if to_cube and not cube_coordinates:
             def get_shapes(name):
                 return self.geometries[name].cube_shape
 
@@ -307,6 +422,10 @@ class SeismicCubeset(Dataset):
         if callable(post):
             sampler = sampler.apply(post)
 
+        # Mark the resulting sampler, so that its points are processed correctly on subsequent modifications
+        if cube_coordinates or to_cube:
+            sampler.unit = False
+
         if finish:
             setattr(self, dst, sampler.sample)
         else:
@@ -330,7 +449,7 @@ class SeismicCubeset(Dataset):
 
         for slice_ in np.array(batch.slices)[unsalted == self.indices[idx]]:
             idx_i, idx_x, _ = slice_
-            background[idx_i, idx_x] += 1
+            background[make_index([idx_i, idx_x])] += 1
 
         if normalize:
             background = (background > 0).astype(int)
@@ -455,7 +574,7 @@ class SeismicCubeset(Dataset):
 
 
     def mask_to_horizons(self, src, cube_name, threshold=0.5, averaging='mean', minsize=0,
-                         dst='predicted_horizons', prefix='predict', src_grid_info='grid_info'):
+                         dst='predicted_horizons', prefix='predict', src_grid_info='grid_info', chunk_size=None):
         """ Convert mask to a list of horizons.
 
         Parameters
@@ -467,20 +586,22 @@ class SeismicCubeset(Dataset):
         threshold : float
             Parameter of mask-thresholding.
         averaging : str
-            Method of pandas.groupby used for finding the center of a horizon
-            for each (iline, xline).
+            Method used for finding the center of a horizon for each (iline, xline),
+            see `mode` of :meth:`.Horizon.from_mask`.
         minsize : int
             Minimum length of a horizon to be saved.
         prefix : str
             Name of horizon to use.
+        chunk_size : int, optional
+            If provided, then mask is processed in chunks of that many ilines. Allows to use on-disk masks
+            (HDF5 datasets, memmaps) of any size.
         """
-        #TODO: add `chunks` mode
         mask = getattr(self, src) if isinstance(src, str) else src
 
         grid_info = getattr(self, src_grid_info)
 
-        horizons = Horizon.from_mask(mask, grid_info,
-                                     threshold=threshold, averaging=averaging, minsize=minsize, prefix=prefix)
+        horizons = Horizon.from_mask(mask, grid_info, threshold=threshold, mode=averaging,
+                                     minsize=minsize, prefix=prefix, chunk_size=chunk_size)
         if not hasattr(self, dst):
             setattr(self, dst, IndexedDict({ix: dict() for ix in self.indices}))
 
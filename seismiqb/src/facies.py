@@ -12,7 +12,7 @@ from skimage.measure import label
 from ..batchflow import HistoSampler
 
 from .plotters import plot_image
-from .utils import groupby_min, groupby_max
+from .utils import groupby_min, groupby_max, location_bounds, location_length, read_point_cloud
 
 
 
@@ -150,28 +150,25 @@ class GeoBody:
                                                              self.i_length, self.x_length)
 
 
-    def from_file(self, path, transform=True, **kwargs):
+    def from_file(self, path, transform=True, cache=False, **kwargs):
         """ Init from path to csv-like file. """
         _ = kwargs
 
         self.path = path
         self.name = os.path.basename(path)
-        points = self.file_to_points(path)
+        points = self.file_to_points(path, cache=cache)
         self.from_points(points, transform)
 
-    def file_to_points(self, path):
+    def file_to_points(self, path, cache=False):
         """ Get point cloud array from file values. """
-        #pylint: disable=anomalous-backslash-in-string
         with open(path) as file:
-            line_len = len(file.readline().split(' '))
+            line_len = len(file.readline().split())
         if line_len == 4:
             names = GeoBody.FACIES_SPEC
         else:
             raise ValueError('GeoBody labels must be in FACIES_SPEC format.')
 
-        df = pd.read_csv(path, sep='\s+', names=names, usecols=GeoBody.COLUMNS)
-        df.sort_values(GeoBody.COLUMNS, inplace=True)
-        return df.values
+        return read_point_cloud(path, names=names, usecols=GeoBody.COLUMNS, cache=cache)
 
     @staticmethod
     def points_to_matrix(points, i_min, x_min, i_length, x_length):
@@ -266,15 +263,12 @@ class GeoBody:
         ----------
         mask : ndarray
             Background to add to.
-        locations : ndarray
+        locations : sequence of slices or arrays
             Where the mask is located.
         """
         _ = kwargs
 
-        mask_bbox = np.array([[locations[0][0], locations[0][-1]+1],
-                              [locations[1][0], locations[1][-1]+1],
-                              [locations[2][0], locations[2][-1]+1]],
-                             dtype=np.int32)
+        mask_bbox = np.array([location_bounds(item) for item in locations], dtype=np.int32)
 
         # Getting coordinates of overlap in cubic system
         (mask_i_min, mask_i_max), (mask_x_min, mask_x_max), (mask_h_min, mask_h_max) = mask_bbox
@@ -434,7 +428,7 @@ class GeoBody:
         # Make `locations` for slide loading
         axis = self.geometry.parse_axis(axis)
         locations = self.geometry.make_slide_locations(loc, axis=axis)
-        shape = np.array([len(item) for item in locations])
+        shape = np.array([location_length(item) for item in locations])
 
         # Load seismic and mask
         seismic_slide = self.geometry.load_slide(loc=loc, axis=axis)
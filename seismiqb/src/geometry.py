@@ -1,19 +1,24 @@
 """ SeismicGeometry-class containing geometrical info about seismic-cube."""
+#pylint: disable=too-many-lines
 import os
 import sys
 import logging
+import asyncio
 from textwrap import dedent
 from random import random
 from itertools import product
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 
 import numpy as np
 import pandas as pd
 import h5py
 import segyio
-import h5pickle
 
-from .utils import lru_cache, find_min_max #, SafeIO
+from .utils import lru_cache, find_min_max, SafeIO, open_segy
+from .utils import coalesce_locations, location_length, location_to_array, shift_location, make_index
+from .utils import check_locations
 from .plotters import plot_image
 
 
@@ -81,7 +86,7 @@ def add_descriptors(cls):
 
 @add_descriptors
 class SeismicGeometry:
-    """ This class selects which type of geometry to initialize:the SEG-Y or the HDF5 one,
+    """ This class selects which type of geometry to initialize: the SEG-Y, the HDF5 or the NPY one,
     depending on the passed path.
 
     Independent of exact format, `SeismicGeometry` provides following:
@@ -109,9 +114,14 @@ class SeismicGeometry:
 
     Refer to the documentation of respective classes to learn about more their structure, attributes and methods.
     """
+    #pylint: disable=too-many-public-methods
     #TODO: add separate class for cube-like labels
     SEGY_ALIASES = ['sgy', 'segy', 'seg']
     HDF5_ALIASES = ['hdf5', 'h5py']
+    NPY_ALIASES = ['npy']
+
+    # Projections of structured cubes: name and order of axes in each of them
+    PROJECTIONS = {'cube': [0, 1, 2], 'cube_x': [1, 2, 0], 'cube_h': [2, 0, 1]}
 
     # Attributes to store during SEG-Y -> HDF5 conversion
     PRESERVED = [
@@ -142,16 +152,24 @@ class SeismicGeometry:
             new_cls = SeismicGeometrySEGY
         elif fmt in cls.HDF5_ALIASES:
             new_cls = SeismicGeometryHDF5
+        elif os.path.isfile(os.path.join(path, SeismicGeometryNPY.META)):
+            # Directory with NPY projections is recognized by its metadata file, whatever its extension is
+            new_cls = SeismicGeometryNPY
         else:
             raise TypeError('Unknown format of the cube.')
 
         instance = super().__new__(new_cls)
         return instance
 
-    def __init__(self, path, *args, process=True, **kwargs):
+    def __init__(self, path, *args, process=True, async_workers=4, **kwargs):
         _ = args
         self.path = path
 
+        # Asynchronous loading: executor and semaphore are created on the first use
+        self.async_workers = async_workers
+        self._executor = None
+        self._semaphore = None
+
         # Names of different lengths and format: helpful for outside usage
         self.name = os.path.basename(self.path)
         self.short_name = self.name.split('.')[0]
@@ -205,15 +223,153 @@ class SeismicGeometry:
 
 
     def make_slide_locations(self, loc, axis=0):
-        """ Create locations (sequence of locations for each axis) for desired slide along desired axis. """
+        """ Create locations (sequence of slices for each axis) for desired slide along desired axis. """
         axis = self.parse_axis(axis)
 
-        locations = [np.arange(item) for item in self.lens]
-        locations += [np.arange(self.depth)]
-        locations[axis] = [loc]
+        locations = [slice(0, item) for item in self.lens]
+        locations += [slice(0, self.depth)]
+        locations[axis] = slice(loc, loc + 1)
         return locations
 
 
+    def load_crops(self, locations_list, axis=None, max_overhead=2.0, **kwargs):
+        """ Load multiple 3D crops from the cube at once.
+
+        For structured cubes, crops are grouped by the projection to load them from. Inside each group,
+        crops close to each other are merged into clusters: bounding hyperslab of each cluster is read only once,
+        and all of the crops are cut from it. That way, data shared by overlapping crops is read only once.
+        For unstructured cubes, crops are loaded one by one.
+
+        Parameters
+        ----------
+        locations_list : sequence
+            Locations of crops, each in the same format as in :meth:`.load_crop`.
+        axis : str or int, optional
+            Identificator of the axis to use to load data for every crop.
+            By default, the fastest axis is chosen for each crop separately.
+        max_overhead : number
+            Maximum ratio of the bounding hyperslab volume to the total volume of crops cut from it.
+        """
+        if not self.structured:
+            return [self.load_crop(locations, axis=axis, **kwargs) for locations in locations_list]
+        for locations in locations_list:
+            check_locations(locations, self.cube_shape)
+
+        projection_names = list(self.PROJECTIONS)
+        crops = [None] * len(locations_list)
+
+        groups = defaultdict(list)
+        for i, locations in enumerate(locations_list):
+            axis_ = np.argmin([location_length(item) for item in locations]) if axis is None else self.parse_axis(axis)
+            projection = projection_names[axis_]
+            projection = projection if self.has_projection(projection) else 'cube'
+            groups[projection].append(i)
+
+        for projection, indices in groups.items():
+            order = self.PROJECTIONS[projection]
+            inverse = np.argsort(order)
+            locations_group = [[locations_list[i][k] for k in order] for i in indices]
+
+            for cluster, bounds in coalesce_locations(locations_group, max_overhead=max_overhead):
+                block = self._read_block(projection, tuple(slice(int(start), int(stop)) for start, stop in bounds))
+
+                for j in cluster:
+                    shifted = [shift_location(item, start) for item, (start, _) in zip(locations_group[j], bounds)]
+                    crops[indices[j]] = np.ascontiguousarray(block[make_index(shifted)].transpose(inverse))
+        return crops
+
+
+    # Asynchronous loading
+    @property
+    def executor(self):
+        """ Thread pool to run loading functions in. Bounded by `async_workers`, shared by all coroutines. """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.async_workers,
+                                                thread_name_prefix=f'{self.short_name}_loader')
+        return self._executor
+
+    def _get_semaphore(self):
+        """ Semaphore to limit the number of reads in flight. Created for each event loop separately. """
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self.async_workers))
+        return self._semaphore[1]
+
+    async def _run_async(self, function, *args, **kwargs):
+        """ Run `function` in the executor, while holding the semaphore.
+        If the coroutine is cancelled before the read is started, the read is not started at all.
+        """
+        async with self._get_semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    async def aload_crop(self, locations, **kwargs):
+        """ Coroutine version of :meth:`.load_crop`: the actual read is done in the thread pool,
+        so the event loop (and model computations) are not blocked.
+        At most `async_workers` reads are in flight at the same time.
+        """
+        return await self._run_async(self.load_crop, locations, **kwargs)
+
+    async def aload_slide(self, loc, **kwargs):
+        """ Coroutine version of :meth:`.load_slide`. """
+        return await self._run_async(self.load_slide, loc, **kwargs)
+
+    async def aload_crops(self, locations_list, coalesce=False, **kwargs):
+        """ Coroutine version of :meth:`.load_crops`.
+
+        Parameters
+        ----------
+        locations_list : sequence
+            Locations of crops, each in the same format as in :meth:`.load_crop`.
+        coalesce : bool
+            If True, then the whole batch is loaded by one :meth:`.load_crops` call in the thread pool,
+            so the reads are coalesced. Otherwise, each crop is loaded separately and concurrently.
+        kwargs : dict
+            Passed directly to the loading method.
+        """
+        if coalesce:
+            return await self._run_async(self.load_crops, locations_list, **kwargs)
+
+        tasks = [asyncio.ensure_future(self.aload_crop(locations, **kwargs)) for locations in locations_list]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # Cancel all the other reads on error or cancellation
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def shutdown_executor(self, wait=True):
+        """ Stop the thread pool used for asynchronous loading. It is re-created on the next use. """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def __getnewargs__(self):
+        """ Arguments for `__new__` on unpickling and copying: the class is selected from the path. """
+        return (self.path,)
+
+    def __getstate__(self):
+        """ Thread pool and semaphore can't be pickled: they are re-created on the first use. """
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_semaphore'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+    def get_zero_traces(self):
+        """ Matrix of dead traces. Unstructured cubes have it only after stats are collected:
+        until then, all the traces are considered alive.
+        """
+        zero_traces = getattr(self, 'zero_traces', None)
+        if zero_traces is None:
+            zero_traces = np.zeros(self.cube_shape[:-1], dtype=np.int32)
+        return zero_traces
+
+
     # Spatial matrices
     @lru_cache(100)
     def get_quantile_matrix(self, q):
@@ -309,6 +465,13 @@ class SeismicGeometry:
         """ Size of instance in gigabytes. """
         return self.nbytes / (1024**3)
 
+    @property
+    def file_size(self):
+        """ Size of the cube on disk in gigabytes. """
+        if os.path.isdir(self.path):
+            return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file()) / (1024**3)
+        return os.path.getsize(self.path) / (1024**3)
+
     def __repr__(self):
         return 'Inferred geometry for {}: ({}x{}x{})'.format(os.path.basename(self.path), *self.cube_shape)
 
@@ -319,7 +482,7 @@ class SeismicGeometry:
         Shape:                         {self.cube_shape}
         Time delay and sample rate:    {self.delay}, {self.sample_rate}
 
-        Cube size:                     {os.path.getsize(self.path) / (1024**3):4.3} GB
+        Cube size:                     {self.file_size:4.3} GB
         Size of the instance:          {self.ngbytes:4.3} GB
 
         Number of traces:              {np.prod(self.cube_shape[:-1])}
@@ -445,9 +608,7 @@ class SeismicGeometrySEGY(SeismicGeometry):
     def process(self, collect_stats=False, **kwargs):
         """ Create dataframe based on `segy` file headers. """
         # Note that all the `segyio` structure inference is disabled
-        # self.segyfile = SafeIO(self.path, opener=segyio.open, mode='r', strict=False, ignore_geometry=True)
-        self.segyfile = segyio.open(self.path, mode='r', strict=False, ignore_geometry=True)
-        self.segyfile.mmap()
+        self.segyfile = SafeIO(self.path, opener=open_segy, mode='r', strict=False, ignore_geometry=True)
 
         self.depth = len(self.segyfile.trace[0])
         self.delay = self.segyfile.header[0].get(segyio.TraceField.DelayRecordingTime)
@@ -480,6 +641,7 @@ class SeismicGeometrySEGY(SeismicGeometry):
         """ Infer info about curent index from `dataframe` attribute. """
         self.index_len = len(self.index_headers)
         self._zero_trace = np.zeros(self.depth)
+        self._trace_index_matrix = None
 
         # Unique values in each of the indexing column
         self.unsorted_uniques = [np.unique(self.dataframe.index.get_level_values(i).values)
@@ -602,6 +764,95 @@ class SeismicGeometrySEGY(SeismicGeometry):
         """ Stack multiple traces together. """
         return np.stack([self.load_trace(idx) for idx in trace_indices])
 
+    @property
+    def trace_index_matrix(self):
+        """ Matrix of (ilines_len, xlines_len) shape with index of trace in the file for each location.
+        Missing traces are marked with -1. Available only for 2D index.
+        """
+        if self._trace_index_matrix is None:
+            if self.index_len != 2:
+                raise ValueError('Trace index matrix is available only for 2D index.')
+
+            positions = [np.searchsorted(self.uniques[i], self.dataframe.index.get_level_values(i).values)
+                         for i in range(2)]
+            matrix = np.full(self.lens, -1, dtype=np.int64)
+            matrix[positions[0], positions[1]] = self.dataframe['trace_index'].values
+            self._trace_index_matrix = matrix
+        return self._trace_index_matrix
+
+    def make_trace_memmap(self):
+        """ Memory-map all the traces of the file as a structured array with `header` and `data` fields.
+        Possible only for IEEE float samples and fixed trace length; otherwise, returns None.
+        """
+        if int(self.segyfile.format) != 5:
+            return None
+
+        offset = 3600 + 3200 * self.segyfile.ext_headers
+        dtype = np.dtype([('header', 'V240'), ('data', '>f4', self.depth)])
+        if os.path.getsize(self.path) != offset + self.segyfile.tracecount * dtype.itemsize:
+            return None
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(self.segyfile.tracecount,))
+
+    def load_windows(self, ilines, xlines, starts, window, max_gap=16, max_traces=4096):
+        """ Load `window` samples, starting from `starts` depths, from traces at (ilines, xlines) locations.
+        Needed traces are sorted and split into runs of close traces: each run is read in bulk,
+        and only the depth range needed by its windows is taken from it.
+        If possible, traces are read through memory-mapping; otherwise, via `segyio` bulk reader.
+
+        Parameters
+        ----------
+        ilines, xlines : sequences of ints
+            Ordinal locations of traces, e.g. indices in `uniques`.
+        starts : sequence of ints
+            Depth of the first sample of each window.
+        window : int
+            Number of samples to load for each location.
+        max_gap : int
+            Maximum distance between traces in the file to read them in one run.
+        max_traces : int
+            Maximum number of traces in one run: bounds memory usage.
+
+        Returns
+        -------
+        ndarray
+            Float32 array of (len(starts), window) shape. Samples outside of the cube and
+            missing traces are filled with zeros.
+        """
+        starts = np.asarray(starts)
+        result = np.zeros((len(starts), window), dtype=np.float32)
+
+        traces = self.trace_index_matrix[ilines, xlines]
+        valid = np.nonzero(traces >= 0)[0]
+        if len(valid) == 0:
+            return result
+
+        order = valid[np.argsort(traces[valid], kind='stable')]
+        breaks = np.nonzero(np.diff(traces[order]) > max_gap)[0] + 1
+        memmap = self.make_trace_memmap()
+        window_range = np.arange(window)
+
+        for run in np.split(order, breaks):
+            for piece in np.array_split(run, -(-len(run) // max_traces)):
+                t_start, t_end = traces[piece[0]], traces[piece[-1]] + 1
+                d_start = max(starts[piece].min(), 0)
+                d_end = min(starts[piece].max() + window, self.depth)
+                if d_start >= d_end:
+                    continue
+
+                if memmap is not None:
+                    block = memmap['data'][t_start:t_end, d_start:d_end]
+                else:
+                    block = self.segyfile.trace.raw[t_start:t_end][:, d_start:d_end]
+
+                # Take windows from the block, leaving zeros for samples outside of the cube
+                depths = starts[piece].reshape(-1, 1) - d_start + window_range
+                inside = (depths >= 0) & (depths < block.shape[1])
+                rows = np.broadcast_to((traces[piece] - t_start).reshape(-1, 1), depths.shape)
+                targets = np.broadcast_to(piece.reshape(-1, 1), depths.shape)
+                columns = np.broadcast_to(window_range, depths.shape)
+                result[targets[inside], columns[inside]] = block[rows[inside], depths[inside]]
+        return result
+
     @lru_cache(128, attributes='index_headers')
     def load_slide(self, loc=None, axis=0, start=None, end=None, step=1, stable=True):
         """ Create indices and load actual traces for one slide.
@@ -710,14 +961,14 @@ class SeismicGeometrySEGY(SeismicGeometry):
                 np.arange(0, 700)
             ]
         """
-        shape = np.array([len(item) for item in locations])
+        shape = np.array([location_length(item) for item in locations])
         indices = self.make_crop_indices(locations)
         crop = self.load_traces(indices)[..., locations[-1]].reshape(shape)
         return crop
 
     def make_crop_indices(self, locations):
         """ Create indices for 3D crop loading. """
-        iterator = list(product(*[[self.uniques[idx][i] for i in locations[idx]] for idx in range(2)]))
+        iterator = list(product(*[self.uniques[idx][location_to_array(locations[idx])] for idx in range(2)]))
         indices = self.dataframe['trace_index'].get(list(iterator), np.nan).values
         return np.unique(indices)
 
@@ -725,7 +976,8 @@ class SeismicGeometrySEGY(SeismicGeometry):
         """ Smart choice between using :meth:`._load_crop` and stacking multiple slides created by :meth:`.load_slide`.
         """
         _ = kwargs
-        shape = np.array([len(item) for item in locations])
+        check_locations(locations, self.cube_shape)
+        shape = np.array([location_length(item) for item in locations])
         mode = mode or ('slide' if min(shape) < threshold else 'crop')
 
         if mode == 'slide':
@@ -733,7 +985,7 @@ class SeismicGeometrySEGY(SeismicGeometry):
             #TODO: add depth-slicing; move this logic to separate function
             if axis in [0, 1]:
                 return np.stack([self.load_slide(loc, axis=axis)[..., locations[-1]]
-                                 for loc in locations[axis]],
+                                 for loc in location_to_array(locations[axis])],
                                 axis=axis)
         return self._load_crop(locations)
 
@@ -797,22 +1049,52 @@ class SeismicGeometryHDF5(SeismicGeometry):
 
     All the attributes are loaded directly from HDF5 file itself, so most of the attributes from SEG-Y file
     are preserved, with the exception of `dataframe` and `uniques`.
+
+    Each thread uses its own file handler. As all the calls to `h5py` are serialized by its global lock,
+    projections that are stored contiguously and without compression are also memory-mapped directly:
+    reads from them bypass `h5py` altogether and can run in parallel from multiple threads.
     """
     #pylint: disable=attribute-defined-outside-init
     def __init__(self, path, **kwargs):
         self.structured = True
         self.file_hdf5 = None
+        self.memmaps = {}
 
         super().__init__(path, **kwargs)
 
-    def process(self, **kwargs):
+    def process(self, use_memmap=True, **kwargs):
         """ Put info from `.hdf5` groups to attributes.
         No passing through data whatsoever.
         """
         _ = kwargs
-        # self.file_hdf5 = SafeIO(self.path, opener=h5pickle.File, mode='r')
-        self.file_hdf5 = h5pickle.File(self.path, mode='r')
+        self.file_hdf5 = SafeIO(self.path, opener=h5py.File, per_thread=True, mode='r')
         self.add_attributes()
+        self.memmaps = self.make_memmaps() if use_memmap else {}
+
+    def make_memmaps(self):
+        """ Memory-map projections, stored contiguously and without any filters, right from the file. """
+        memmaps = {}
+        for projection in self.PROJECTIONS:
+            if projection not in self.file_hdf5:
+                continue
+
+            dataset = self.file_hdf5[projection]
+            offset = dataset.id.get_offset()
+            if dataset.chunks is None and dataset.compression is None and offset is not None:
+                memmaps[projection] = np.memmap(self.path, dtype=dataset.dtype, mode='r',
+                                                offset=offset, shape=dataset.shape)
+        return memmaps
+
+    def __getstate__(self):
+        """ Memory-mapped arrays are pickled with all of their data: re-create them after unpickling instead. """
+        state = super().__getstate__()
+        state['memmaps'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.memmaps is None:
+            self.memmaps = self.make_memmaps()
 
     def add_attributes(self):
         """ Store values from `hdf5` file to attributes. """
@@ -838,17 +1120,21 @@ class SeismicGeometryHDF5(SeismicGeometry):
         Automatically chooses the fastest axis to use: as `hdf5` files store multiple copies of data with
         various orientations, some axis are faster than others depending on exact crop location and size.
 
+        If every location is a slice, then the crop is read as one hyperslab;
+        otherwise, slides along the chosen axis are loaded (and cached) one by one.
+
         Parameters
-        locations : sequence of arrays
+        locations : sequence of slices or arrays
             List of desired locations to load: along the first index, the second, and depth.
         axis : str or int
             Identificator of the axis to use to load data.
             Can be `iline`, `xline`, `height`, `depth`, `i`, `x`, `h`, 0, 1, 2.
         """
         _ = kwargs
+        check_locations(locations, self.cube_shape)
 
         if axis is None:
-            shape = np.array([len(item) for item in locations])
+            shape = np.array([location_length(item) for item in locations])
             axis = np.argmin(shape)
         else:
             mapping = {0: 0, 1: 1, 2: 2,
@@ -856,6 +1142,13 @@ class SeismicGeometryHDF5(SeismicGeometry):
                        'iline': 0, 'xline': 1, 'height': 2, 'depth': 2}
             axis = mapping[axis]
 
+        if all(isinstance(item, slice) for item in locations):
+            projection = list(self.PROJECTIONS)[axis]
+            projection = projection if projection in self.file_hdf5 else 'cube'
+            order = self.PROJECTIONS[projection]
+            crop = self._read_block(projection, tuple(locations[k] for k in order))
+            return np.ascontiguousarray(crop.transpose(np.argsort(order)))
+
         if axis == 1 and 'cube_x' in self.file_hdf5:
             crop = self._load_x(*locations)
         elif axis == 2 and 'cube_h' in self.file_hdf5:
@@ -865,38 +1158,198 @@ class SeismicGeometryHDF5(SeismicGeometry):
         return crop
 
     def _load_i(self, ilines, xlines, heights):
-        cube_hdf5 = self.file_hdf5['cube']
-        return np.stack([self._cached_load(cube_hdf5, iline)[xlines, :][:, heights]
-                         for iline in ilines])
+        return np.stack([self._cached_load('cube', iline)[xlines, :][:, heights]
+                         for iline in location_to_array(ilines)])
 
     def _load_x(self, ilines, xlines, heights):
-        cube_hdf5 = self.file_hdf5['cube_x']
-        return np.stack([self._cached_load(cube_hdf5, xline)[heights, :][:, ilines].transpose([1, 0])
-                         for xline in xlines], axis=1)
+        return np.stack([self._cached_load('cube_x', xline)[heights, :][:, ilines].transpose([1, 0])
+                         for xline in location_to_array(xlines)], axis=1)
 
     def _load_h(self, ilines, xlines, heights):
-        cube_hdf5 = self.file_hdf5['cube_h']
-        return np.stack([self._cached_load(cube_hdf5, height)[ilines, :][:, xlines]
-                         for height in heights], axis=2)
+        return np.stack([self._cached_load('cube_h', height)[ilines, :][:, xlines]
+                         for height in location_to_array(heights)], axis=2)
+
+    def has_projection(self, projection):
+        """ Check whether the projection is stored in the file. """
+        return projection in self.file_hdf5
+
+    def _read_block(self, projection, slices):
+        """ Read one hyperslab from a certain cube projection. """
+        if projection in self.memmaps:
+            return np.array(self.memmaps[projection][slices])
+        return self.file_hdf5[projection][slices]
 
     @lru_cache(128)
-    def _cached_load(self, cube, loc):
+    def _cached_load(self, projection, loc):
         """ Load one slide of data from a certain cube projection.
         Caches the result in a thread-safe manner.
         """
-        return cube[loc, :, :]
+        if projection in self.memmaps:
+            return np.array(self.memmaps[projection][loc, :, :])
+        return self.file_hdf5[projection][loc, :, :]
 
     def load_slide(self, loc, axis='iline', **kwargs):
         """ Load desired slide along desired axis. """
         _ = kwargs
         axis = self.parse_axis(axis)
         if axis == 0:
-            cube = self.file_hdf5['cube']
-            slide = self._cached_load(cube, loc)
+            slide = self._cached_load('cube', loc)
         elif axis == 1:
-            cube = self.file_hdf5['cube_x']
-            slide = self._cached_load(cube, loc).T
+            slide = self._cached_load('cube_x', loc).T
         elif axis == 2:
-            cube = self.file_hdf5['cube_h']
-            slide = self._cached_load(cube, loc)
+            slide = self._cached_load('cube_h', loc)
         return slide
+
+    # Convert HDF5 to NPY
+    def make_npy(self, path_npy=None, postfix='', chunk_size=64):
+        """ Converts `.hdf5` cube to a directory with raw `.npy` files: one for each of the projections.
+        All the preserved attributes are stored in the metadata file inside the same directory.
+
+        Parameters
+        ----------
+        path_npy : str
+            Path to the directory to store converted cube. By default, new cube is stored right next to original.
+        postfix : str
+            Postfix to add to the name of resulting cube.
+        chunk_size : int
+            Number of slides to copy at a time.
+        """
+        path_npy = path_npy or (os.path.splitext(self.path)[0] + postfix + '.npy')
+        os.makedirs(path_npy, exist_ok=True)
+
+        for projection in self.PROJECTIONS:
+            if projection not in self.file_hdf5:
+                continue
+            cube_hdf5 = self.file_hdf5[projection]
+            cube_npy = np.lib.format.open_memmap(os.path.join(path_npy, projection + '.npy'), mode='w+',
+                                                 dtype=cube_hdf5.dtype, shape=cube_hdf5.shape)
+
+            description = f'Converting {self.long_name} to npy; {projection} projection'
+            for start in tqdm(range(0, cube_hdf5.shape[0], chunk_size), desc=description, ncols=1000):
+                end = min(start + chunk_size, cube_hdf5.shape[0])
+                cube_npy[start:end] = cube_hdf5[start:end]
+            cube_npy.flush()
+            del cube_npy
+
+        # Save all the necessary attributes to the metadata file
+        meta = {attr: getattr(self, attr) for attr in self.PRESERVED
+                if hasattr(self, attr) and getattr(self, attr) is not None}
+        np.savez(os.path.join(path_npy, SeismicGeometryNPY.META), **meta)
+        return path_npy
+
+
+class SeismicGeometryNPY(SeismicGeometry):
+    """ Class to infer information about cubes, stored as a directory with raw `.npy` files,
+    and provide convenient methods of working with them.
+
+    Each projection of the cube (the same as in HDF5: `cube`, `cube_x` and `cube_h`) is stored in a separate
+    `.npy` file, and all the attributes are stored in the `meta.npz` file inside the same directory.
+    Every projection is opened as `np.memmap`, so loading data is just slicing of an array:
+    no copies are made by the storage itself, no library overhead is involved, and
+    memory-mapped files are trivially shared between processes.
+
+    Such a directory can be created from HDF5 cube via :meth:`.SeismicGeometryHDF5.make_npy`.
+    """
+    #pylint: disable=attribute-defined-outside-init
+    META = 'meta.npz'
+
+    def __init__(self, path, **kwargs):
+        self.structured = True
+        self.file_npy = None
+
+        super().__init__(path, **kwargs)
+
+    def process(self, **kwargs):
+        """ Open every projection as memory-mapped array and put info from metadata file to attributes.
+        No passing through data whatsoever.
+        """
+        _ = kwargs
+        self.file_npy = self.open_projections()
+        self.add_attributes()
+
+    def open_projections(self):
+        """ Memory-map every available projection of the cube. """
+        projections = {}
+        for projection in self.PROJECTIONS:
+            path = os.path.join(self.path, projection + '.npy')
+            if os.path.exists(path):
+                projections[projection] = np.load(path, mmap_mode='r')
+        return projections
+
+    def add_attributes(self):
+        """ Store values from metadata file to attributes. """
+        self.index_headers = self.INDEX_POST
+
+        with np.load(os.path.join(self.path, self.META), allow_pickle=False) as meta:
+            for item in self.PRESERVED:
+                if item in meta:
+                    value = meta[item]
+                    setattr(self, item, value[()] if value.ndim == 0 else value)
+        # BC
+        self.ilines_offset = min(self.ilines)
+        self.xlines_offset = min(self.xlines)
+        self.ilines_len = len(self.ilines)
+        self.xlines_len = len(self.xlines)
+        self.cube_shape = np.asarray([self.ilines_len, self.xlines_len, self.depth])
+        self.has_stats = True
+
+    def __getstate__(self):
+        """ Memory-mapped arrays are pickled with all of their data: re-open them after unpickling instead. """
+        state = super().__getstate__()
+        state['file_npy'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self.file_npy is None and os.path.isdir(self.path):
+            self.file_npy = self.open_projections()
+
+    # Methods to load actual data from NPY
+    def load_crop(self, locations, axis=None, **kwargs):
+        """ Load 3D crop from the cube.
+        Automatically chooses the fastest axis to use: as the directory stores multiple copies of data with
+        various orientations, some axis are faster than others depending on exact crop location and size.
+
+        Parameters
+        locations : sequence of slices or arrays
+            List of desired locations to load: along the first index, the second, and depth.
+        axis : str or int
+            Identificator of the axis to use to load data.
+            Can be `iline`, `xline`, `height`, `depth`, `i`, `x`, `h`, 0, 1, 2.
+        """
+        _ = kwargs
+        check_locations(locations, self.cube_shape)
+
+        if axis is None:
+            shape = np.array([location_length(item) for item in locations])
+            axis = np.argmin(shape)
+        else:
+            axis = self.parse_axis(axis)
+
+        projection = list(self.PROJECTIONS)[axis]
+        projection = projection if projection in self.file_npy else 'cube'
+        order = self.PROJECTIONS[projection]
+        crop = self.file_npy[projection][make_index([locations[k] for k in order])]
+        return np.ascontiguousarray(crop.transpose(np.argsort(order)))
+
+    def has_projection(self, projection):
+        """ Check whether the projection is stored in the directory. """
+        return projection in self.file_npy
+
+    def _read_block(self, projection, slices):
+        """ Get one hyperslab of a certain cube projection. No copies are made. """
+        return np.asarray(self.file_npy[projection][slices])
+
+    def load_slide(self, loc, axis='iline', **kwargs):
+        """ Load desired slide along desired axis. No copies are made. """
+        _ = kwargs
+        axis = self.parse_axis(axis)
+        if axis == 0:
+            slide = self.file_npy['cube'][loc]
+        elif axis == 1:
+            slide = self.file_npy['cube_x'][loc].T
+        elif axis == 2:
+            slide = self.file_npy['cube_h'][loc]
+        else:
+            raise ValueError(f'Unknown axis `{axis}`.')
+        return np.asarray(slide)
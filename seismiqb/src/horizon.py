@@ -2,21 +2,23 @@
 #pylint: disable=too-many-lines, import-error
 import os
 from copy import copy
-from itertools import product
+from itertools import product, combinations
 from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+import h5py
 from numba import njit, prange
 
 import cv2
 from scipy.ndimage.morphology import binary_fill_holes, binary_erosion
-from scipy.ndimage import find_objects
 from skimage.measure import label
 
 from ..batchflow import HistoSampler
 
-from .utils import round_to_array, groupby_mean, groupby_min, groupby_max
+from .utils import round_to_array, extract_components, extract_surface, union_components, versioned_property
+from .utils import location_bounds, location_length, location_to_array, read_point_cloud
 from .plotters import plot_image
 
 
@@ -107,7 +109,8 @@ class UnstructuredHorizon:
             self.attach()
 
 
-    def from_file(self, path, names=None, columns=None, height_prefix='height', reader_params=None, **kwargs):
+    def from_file(self, path, names=None, columns=None, height_prefix='height', reader_params=None, cache=False,
+                  **kwargs):
         """ Init from path to csv-like file.
 
         Parameters
@@ -119,13 +122,15 @@ class UnstructuredHorizon:
         height_prefix : str
             Column name with height.
         reader_params : None or dict
-            Additional parameters for file reader.
+            Additional parameters for file reader. If not provided, the fast whitespace parser is used.
+        cache : bool
+            Whether to store parsed values in a hidden `.npz` file next to the original one.
+            Used only if `reader_params` are not provided.
         """
-        #pylint: disable=anomalous-backslash-in-string
         _ = kwargs
         if names is None:
             with open(path) as file:
-                line_len = len(file.readline().split(' '))
+                line_len = len(file.readline().split())
             if line_len == 3:
                 names = UnstructuredHorizon.REDUCED_CHARISMA_SPEC
             elif line_len == 9:
@@ -135,10 +140,12 @@ class UnstructuredHorizon:
         self.path = path
         self.name = os.path.basename(path)
 
-        defaults = {'sep': '\s+'}
-        reader_params = reader_params or {}
-        reader_params = {**defaults, **reader_params}
-        df = pd.read_csv(path, names=names, usecols=columns, **reader_params)
+        if reader_params is None:
+            points = read_point_cloud(path, names=names, usecols=columns, sort=False, cache=cache)
+            df = pd.DataFrame(points, columns=columns)
+        else:
+            reader_params = {'sep': r'\s+', 'engine': 'c', **reader_params}
+            df = pd.read_csv(path, names=names, usecols=columns, **reader_params)
 
         # Convert coordinates of horizons to the one that present in cube geometry
         # df[columns] = np.rint(df[columns]).astype(np.int64)
@@ -167,7 +174,7 @@ class UnstructuredHorizon:
         ----------
         mask : ndarray
             Background to add horizon to.
-        locations : sequence of arrays
+        locations : sequence of slices or arrays
             List of desired locations to load: along the first index, the second, and depth.
         width : int
             Width of an added horizon.
@@ -178,13 +185,14 @@ class UnstructuredHorizon:
         low = width // 2
         high = max(width - low, 0)
 
-        shift_1, shift_2, h_min = [np.min(item) for item in locations]
-        h_max = np.max(locations[-1])
+        (shift_1, _), (shift_2, _), (h_min, h_max) = [location_bounds(item) for item in locations]
+        h_max -= 1
 
         if iterator is None:
             # Usual case
-            iterator = list(product(*[[self.geometry.uniques[idx][i] for i in locations[idx]] for idx in range(2)]))
-            idx_iterator = np.array(list(product(*locations[:2])))
+            locations = [location_to_array(item) for item in locations[:2]]
+            iterator = list(product(*[self.geometry.uniques[idx][locations[idx]] for idx in range(2)]))
+            idx_iterator = np.array(list(product(*locations)))
             idx_1 = idx_iterator[:, 0] - shift_1
             idx_2 = idx_iterator[:, 1] - shift_2
 
@@ -264,7 +272,7 @@ class UnstructuredHorizon:
         # Make `locations` for slide loading
         axis = self.geometry.parse_axis(axis)
         locations = self.geometry.make_slide_locations(loc, axis=axis)
-        shape = np.array([len(item) for item in locations])
+        shape = np.array([location_length(item) for item in locations])
 
         # Create the same indices, as for seismic slide loading
         #TODO: make slide indices shareable
@@ -290,6 +298,103 @@ class UnstructuredHorizon:
 
 
 
+class TiledMatrix:
+    """ Sparse storage of a depth map: square tiles in cubic coordinates, and only tiles with at least one
+    labeled trace are kept. Useful for horizons that cover small part of their bounding box: diagonal or sparse.
+
+    Parameters
+    ----------
+    tiles : dict
+        Mapping from (i, x) tile index to (tile_size, tile_size) array of depths.
+        Tile with index (i, x) covers ilines from `i * tile_size` to `(i + 1) * tile_size` and the same for xlines.
+    tile_size : int
+        Size of tiles along both spatial axes.
+    fill_value : int
+        Value in blank spaces.
+    """
+    def __init__(self, tiles, tile_size, fill_value):
+        self.tiles = tiles
+        self.tile_size = tile_size
+        self.fill_value = fill_value
+
+    @classmethod
+    def from_matrix(cls, matrix, i_min, x_min, tile_size=256, fill_value=-999999):
+        """ Split dense `matrix`, located at (`i_min`, `x_min`), into tiles and keep only non-empty ones. """
+        tiles = {}
+        i_max, x_max = i_min + matrix.shape[0], x_min + matrix.shape[1]
+        for ti in range(i_min // tile_size, (i_max - 1) // tile_size + 1):
+            for tx in range(x_min // tile_size, (x_max - 1) // tile_size + 1):
+                tile = cls._window(matrix, i_min, x_min, ti * tile_size, (ti + 1) * tile_size,
+                                   tx * tile_size, (tx + 1) * tile_size, fill_value)
+                if (tile != fill_value).any():
+                    tiles[(ti, tx)] = tile
+        return cls(tiles, tile_size, fill_value)
+
+    @staticmethod
+    def _window(matrix, i_min, x_min, i_start, i_stop, x_start, x_stop, fill_value):
+        """ Part of dense `matrix`, located at (`i_min`, `x_min`), padded with `fill_value` outside of it. """
+        window = np.full((i_stop - i_start, x_stop - x_start), fill_value, dtype=np.int32)
+        ii_start, ii_stop = max(i_start, i_min), min(i_stop, i_min + matrix.shape[0])
+        xx_start, xx_stop = max(x_start, x_min), min(x_stop, x_min + matrix.shape[1])
+        if ii_start < ii_stop and xx_start < xx_stop:
+            window[ii_start - i_start:ii_stop - i_start, xx_start - x_start:xx_stop - x_start] = \
+                matrix[ii_start - i_min:ii_stop - i_min, xx_start - x_min:xx_stop - x_min]
+        return window
+
+    def items(self):
+        """ Iterate over (i_start, x_start, tile) for stored tiles in (iline, xline) order. """
+        for (ti, tx) in sorted(self.tiles):
+            yield ti * self.tile_size, tx * self.tile_size, self.tiles[(ti, tx)]
+
+    def window(self, i_start, i_stop, x_start, x_stop):
+        """ Dense part of the depth map in cubic coordinates. Only tiles, intersecting with it, are accessed. """
+        ts = self.tile_size
+        window = np.full((i_stop - i_start, x_stop - x_start), self.fill_value, dtype=np.int32)
+        for ti in range(i_start // ts, (i_stop - 1) // ts + 1):
+            for tx in range(x_start // ts, (x_stop - 1) // ts + 1):
+                tile = self.tiles.get((ti, tx))
+                if tile is not None:
+                    part = self._window(tile, ti * ts, tx * ts, i_start, i_stop, x_start, x_stop, self.fill_value)
+                    mask = part != self.fill_value
+                    window[mask] = part[mask]
+        return window
+
+    @property
+    def bbox(self):
+        """ Tight bounding box of labeled traces. """
+        bounds = []
+        for i_start, x_start, tile in self.items():
+            idx_i, idx_x = np.nonzero((tile != self.fill_value).any(axis=1))[0], \
+                           np.nonzero((tile != self.fill_value).any(axis=0))[0]
+            bounds.append([i_start + idx_i[0], i_start + idx_i[-1], x_start + idx_x[0], x_start + idx_x[-1]])
+        bounds = np.array(bounds)
+        return np.array([[bounds[:, 0].min(), bounds[:, 1].max()],
+                         [bounds[:, 2].min(), bounds[:, 3].max()]], dtype=np.int32)
+
+    @property
+    def depths(self):
+        """ Depths of all labeled traces. """
+        return np.concatenate([tile[tile != self.fill_value] for _, _, tile in self.items()])
+
+    @property
+    def points(self):
+        """ Array of (N, 3) shape with (iline, xline, height) rows, sorted by (iline, xline). """
+        points = []
+        for i_start, x_start, tile in self.items():
+            idx_i, idx_x = np.nonzero(tile != self.fill_value)
+            points.append(np.stack([idx_i + i_start, idx_x + x_start, tile[idx_i, idx_x]], axis=1))
+        points = np.concatenate(points).astype(np.int64)
+        return points[np.lexsort([points[:, 1], points[:, 0]])]
+
+    @property
+    def nbytes(self):
+        """ Memory, occupied by tiles. """
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def __len__(self):
+        return len(self.tiles)
+
+
 class Horizon:
     """ Contains spatially-structured horizon: each point describes a height on a particular (iline, xline).
 
@@ -316,6 +421,9 @@ class Horizon:
           Stored height is corrected on `time_delay` and `sample_rate` of the cube.
           In order to initialize from this storage, one must supply (N, 3) ndarray.
 
+        - `tiled` is a :class:`.TiledMatrix`: sparse version of `matrix`, that keeps only tiles with labeled traces.
+          It can be created by `sparsify` method; `matrix` and `points` are then assembled on each access.
+
     Independently of type of initial storage, Horizon provides following:
         - Attributes `i_min`, `x_min`, `i_max`, `x_max`, `h_min`, `h_max`, `h_mean`, `h_std`, `bbox`,
           to completely describe location of the horizon in the 3D volume of the seismic cube.
@@ -340,13 +448,14 @@ class Horizon:
           `coverage` is the ratio between labeled traces and non-zero traces in the seismic cube;
           `solidity` is the ratio between labeled traces and traces inside the hull of the horizon;
           `perimeter` and `number_of_holes` speak for themselves.
+          Such properties are computed once and cached until the horizon is changed; cached arrays are read-only.
 
         - Multiple instances of Horizon can be compared against one another and, if needed,
           merged into one (either in-place or not) via `check_proximity`, `overlap_merge`, `adjacent_merge` methods.
 
         - A wealth of visualization methods: view from above, slices along iline/xline axis, etc.
     """
-    #pylint: disable=too-many-public-methods, import-outside-toplevel
+    #pylint: disable=too-many-public-methods, too-many-instance-attributes, import-outside-toplevel
 
     # CHARISMA: default seismic format of storing surfaces inside the 3D volume
     CHARISMA_SPEC = ['INLINE', '_', 'iline', 'XLINE', '__', 'xline', 'cdp_x', 'cdp_y', 'height']
@@ -360,6 +469,14 @@ class Horizon:
     # Value to place into blank spaces
     FILL_VALUE = -999999
 
+    # Extensions of files with multiple horizons and fields of their index
+    CONTAINER_ALIASES = ['hdf5', 'h5', 'hdf']
+    CONTAINER_INDEX = ['i_min', 'i_max', 'x_min', 'x_max', 'h_min', 'h_max', 'h_mean', 'length']
+
+    # Number of remembered changes of the horizon and bounding box of no changes
+    DIRTY_LOG_SIZE = 64
+    EMPTY_BBOX = np.array([[np.iinfo(np.int32).max, -1], [np.iinfo(np.int32).max, -1]], dtype=np.int32)
+
     def __init__(self, storage, geometry, name=None, **kwargs):
         # Meta information
         self.path = None
@@ -377,6 +494,12 @@ class Horizon:
         self._matrix = None
         self._points = None
         self._depths = None
+        self.tiled = None
+
+        # Incremented on each change of the data: used to invalidate cached properties
+        self._version = 0
+        # Log of changed regions: tuples of (version before, version after, bbox)
+        self._dirty = []
 
         # Heights information
         self._h_min, self._h_max = None, None
@@ -399,8 +522,12 @@ class Horizon:
             # mapping from (iline, xline) to (height)
             self.format = 'dict'
 
+        elif isinstance(storage, TiledMatrix):
+            # sparse depth map
+            self.format = 'tiled'
+
         elif isinstance(storage, np.ndarray):
-            if storage.ndim == 2 and storage.shape[1] == 3:
+            if storage.ndim == 2 and storage.shape[1] == 3 and 'i_min' not in kwargs:
                 # array with row in (iline, xline, height) format
                 self.format = 'points'
 
@@ -420,6 +547,8 @@ class Horizon:
         """ Storage of horizon data as (N, 3) array of (iline, xline, height) in cubic coordinates.
         If the horizon is created not from (N, 3) array, evaluated at the time of the first access.
         """
+        if self._points is None and self.tiled is not None:
+            return self.tiled.points
         if self._points is None and self.matrix is not None:
             points = self.matrix_to_points(self.matrix)
             points += np.array([self.i_min, self.x_min, 0])
@@ -429,6 +558,7 @@ class Horizon:
     @points.setter
     def points(self, value):
         self._points = value
+        self._version += 1
 
     @staticmethod
     def matrix_to_points(matrix):
@@ -445,7 +575,10 @@ class Horizon:
         """ Storage of horizon data as depth map: matrix of (ilines_length, xlines_length) with each point
         corresponding to height. Matrix is shifted to a (i_min, x_min) point so it takes less space.
         If the horizon is created not from matrix, evaluated at the time of the first access.
+        If the horizon is sparsified, dense matrix is assembled from tiles on each access and is not stored.
         """
+        if self._matrix is None and self.tiled is not None:
+            return self.tiled.window(self.i_min, self.i_max + 1, self.x_min, self.x_max + 1)
         if self._matrix is None and self.points is not None:
             self._matrix = self.points_to_matrix(self.points, self.i_min, self.x_min,
                                                  self.i_length, self.x_length)
@@ -454,6 +587,8 @@ class Horizon:
     @matrix.setter
     def matrix(self, value):
         self._matrix = value
+        self.tiled = None
+        self._version += 1
 
     @staticmethod
     def points_to_matrix(points, i_min, x_min, i_length, x_length):
@@ -468,6 +603,8 @@ class Horizon:
         if self._depths is None:
             if self._points is not None:
                 self._depths = self.points[:, -1]
+            elif self.tiled is not None:
+                self._depths = self.tiled.depths
             else:
                 self._depths = self.matrix[self.matrix != self.FILL_VALUE]
         return self._depths
@@ -512,6 +649,7 @@ class Horizon:
 
     def reset_storage(self, storage=None):
         """ Reset storage along with depth-wise stats."""
+        self._version += 1
         self._depths = None
         self._h_min, self._h_max = None, None
         self._h_mean, self._h_std = None, None
@@ -519,9 +657,83 @@ class Horizon:
 
         if storage == 'matrix':
             self._matrix = None
+            self.tiled = None
         elif storage == 'points':
             self._points = None
 
+    def mark_dirty(self, version, bbox=None):
+        """ Record that data, changed since `version`, is inside of `bbox`: array of (2, 2) shape in cubic
+        coordinates. If `bbox` is None, then the whole horizon is considered changed.
+        """
+        bbox = None if bbox is None else np.array(bbox, dtype=np.int32).reshape(2, 2)
+        # New list is created so that shallow copies of the horizon do not share the log
+        self._dirty = self._dirty[-(self.DIRTY_LOG_SIZE - 1):] + [(version, self._version, bbox)]
+
+    def dirty_region(self, since):
+        """ Bounding box of all the changes made after `since` version, or None if it can't be known:
+        either the log is too short, or some of the changes were not recorded.
+        If nothing changed, then bounding box is empty: its minimums are bigger than maximums.
+        """
+        region = self.EMPTY_BBOX.copy()
+        current = self._version
+        for version, next_version, bbox in reversed(self._dirty):
+            if current <= since:
+                break
+            if next_version != current or bbox is None:
+                return None
+            region[:, 0] = np.minimum(region[:, 0], bbox[:, 0])
+            region[:, 1] = np.maximum(region[:, 1], bbox[:, 1])
+            current = version
+        return region if current == since else None
+
+    @staticmethod
+    def changed_bbox(matrix_1, i_min_1, x_min_1, matrix_2, i_min_2, x_min_2):
+        """ Bounding box of traces, that differ in two depth maps, in cubic coordinates.
+        If maps are equal, then bounding box is empty: its minimums are bigger than maximums.
+        """
+        i_min, x_min = min(i_min_1, i_min_2), min(x_min_1, x_min_2)
+        i_max = max(i_min_1 + matrix_1.shape[0], i_min_2 + matrix_2.shape[0])
+        x_max = max(x_min_1 + matrix_1.shape[1], x_min_2 + matrix_2.shape[1])
+
+        # Both maps are put on a shared canvas
+        canvases = []
+        for matrix, i_start, x_start in [(matrix_1, i_min_1 - i_min, x_min_1 - x_min),
+                                         (matrix_2, i_min_2 - i_min, x_min_2 - x_min)]:
+            canvas = np.full((i_max - i_min, x_max - x_min), Horizon.FILL_VALUE, dtype=np.int32)
+            canvas[i_start:i_start + matrix.shape[0], x_start:x_start + matrix.shape[1]] = matrix
+            canvases.append(canvas)
+        diff = canvases[0] != canvases[1]
+
+        idx_i, idx_x = np.nonzero(diff.any(axis=1))[0], np.nonzero(diff.any(axis=0))[0]
+        if len(idx_i) == 0:
+            return Horizon.EMPTY_BBOX.copy()
+        return np.array([[idx_i[0] + i_min, idx_i[-1] + i_min],
+                         [idx_x[0] + x_min, idx_x[-1] + x_min]], dtype=np.int32)
+
+    def matrix_window(self, i_start, i_stop, x_start, x_stop):
+        """ Part of the depth map in cubic coordinates; must be inside the horizon bounding box.
+        For sparsified horizons, only the needed tiles are accessed.
+        """
+        if self.tiled is not None:
+            return self.tiled.window(i_start, i_stop, x_start, x_stop)
+        return self.matrix[i_start - self.i_min:i_stop - self.i_min, x_start - self.x_min:x_stop - self.x_min]
+
+    def sparsify(self, tile_size=256):
+        """ Store the depth map as :class:`.TiledMatrix`: only tiles with labeled traces are kept in memory.
+        Dense `matrix` and `points` are still available, but are created on each access.
+        """
+        self.tiled = TiledMatrix.from_matrix(self.matrix, self.i_min, self.x_min,
+                                             tile_size=tile_size, fill_value=self.FILL_VALUE)
+        self._matrix, self._points = None, None
+        return self
+
+    def densify(self):
+        """ Return to dense storage of the depth map. """
+        if self.tiled is not None:
+            self._matrix = self.matrix
+            self.tiled = None
+        return self
+
     # Coordinate transforms
     def lines_to_cubic(self, array):
         """ Convert ilines-xlines to cubic coordinates system. """
@@ -581,20 +793,21 @@ class Horizon:
                              dtype=np.int32)
 
 
-    def from_file(self, path, transform=True, **kwargs):
-        """ Init from path to either CHARISMA or REDUCED_CHARISMA csv-like file. """
+    def from_file(self, path, transform=True, cache=False, **kwargs):
+        """ Init from path to either CHARISMA or REDUCED_CHARISMA csv-like file.
+        If `cache` is True, then parsed points are stored in a hidden `.npz` file next to the original one.
+        """
         _ = kwargs
 
         self.path = path
         self.name = os.path.basename(path)
-        points = self.file_to_points(path)
+        points = self.file_to_points(path, cache=cache)
         self.from_points(points, transform)
 
-    def file_to_points(self, path):
+    def file_to_points(self, path, cache=False):
         """ Get point cloud array from file values. """
-        #pylint: disable=anomalous-backslash-in-string
         with open(path) as file:
-            line_len = len(file.readline().split(' '))
+            line_len = len(file.readline().split())
         if line_len == 3:
             names = Horizon.REDUCED_CHARISMA_SPEC
         elif line_len >= 9:
@@ -602,9 +815,7 @@ class Horizon:
         else:
             raise ValueError('Horizon labels must be in CHARISMA or REDUCED_CHARISMA format.')
 
-        df = pd.read_csv(path, sep='\s+', names=names, usecols=Horizon.COLUMNS)
-        df.sort_values(Horizon.COLUMNS, inplace=True)
-        return df.values
+        return read_point_cloud(path, names=names, usecols=Horizon.COLUMNS, cache=cache)
 
 
     def from_matrix(self, matrix, i_min, x_min, length=None, **kwargs):
@@ -625,6 +836,23 @@ class Horizon:
         self._len = length
 
 
+    def from_tiled(self, tiled, length=None, **kwargs):
+        """ Init from sparse depth map. """
+        _ = kwargs
+
+        self.tiled = tiled
+        self._matrix = None
+        (self.i_min, self.i_max), (self.x_min, self.x_max) = tiled.bbox
+
+        self.i_length = (self.i_max - self.i_min) + 1
+        self.x_length = (self.x_max - self.x_min) + 1
+        self.bbox = np.array([[self.i_min, self.i_max],
+                              [self.x_min, self.x_max]],
+                             dtype=np.int32)
+
+        self.reset_storage('points')
+        self._len = length
+
     def from_full_matrix(self, matrix, **kwargs):
         """ Init from matrix that covers the whole cube. """
         _ = kwargs
@@ -648,10 +876,14 @@ class Horizon:
 
     @staticmethod
     def from_mask(mask, grid_info=None, geometry=None, shifts=None,
-                  mode='mean', threshold=0.5, minsize=0, prefix='predict', **kwargs):
+                  mode='mean', threshold=0.5, minsize=0, prefix='predict', chunk_size=None, **kwargs):
         """ Convert mask to a list of horizons.
         Returned list is sorted on length of horizons.
 
+        Mask can be either in-memory array or on-disk one: HDF5 dataset, memmap, etc. The latter is processed
+        in chunks along the first axis, and components are joined across chunk faces, so the result is exactly
+        the same as for the whole mask at once.
+
         Parameters
         ----------
         grid_info : dict
@@ -661,10 +893,18 @@ class Horizon:
             Parameter of mask-thresholding.
         mode : str
             Method used for finding the point of a horizon for each iline, xline.
+            If `mean`, `avg`, `min` or `max`, then mask is split into connected components, and depths of each
+            of them are aggregated with that function for each iline, xline.
+            If `argmax`, then mask is considered to contain only one surface: depth of the maximum value is taken
+            for each iline, xline, if this value is greater or equal to `threshold`. Much faster, and always
+            returns at most one horizon.
         minsize : int
             Minimum length of a horizon to be saved.
         prefix : str
             Name of horizon to use.
+        chunk_size : int, optional
+            Number of ilines in each chunk. If not provided, then in-memory arrays are processed at once,
+            and chunks of 100 ilines are used for other sources.
         """
         _ = kwargs
         if grid_info is not None:
@@ -674,35 +914,130 @@ class Horizon:
         if geometry is None or shifts is None:
             raise TypeError('Pass `grid_info` or `geometry` and `shifts` to `from_mask` method of Horizon creation.')
 
+        if mode not in ['mean', 'avg', 'min', 'max', 'argmax']:
+            raise ValueError(f'Unknown mode `{mode}`.')
+
+        if mode == 'argmax':
+            depths, confident = Horizon._chunked_surface(mask, threshold=threshold, chunk_size=chunk_size)
+            return Horizon.from_surface(depths, confident, geometry=geometry, shifts=shifts,
+                                        minsize=minsize, prefix=prefix)
+
+        # Label connected regions and aggregate their depths along each trace
+        if chunk_size is None and type(mask) is np.ndarray: # pylint: disable=unidiomatic-typecheck
+            _, records = extract_components(mask, threshold=threshold, minsize=minsize)
+        else:
+            records = Horizon._chunked_components(mask, threshold=threshold, minsize=minsize,
+                                                  chunk_size=chunk_size or 100)
+        labels, ilines, xlines, sums, counts, mins, maxs = records
+
         if mode in ['mean', 'avg']:
-            group_function = groupby_mean
+            heights = sums // counts
         elif mode in ['min']:
-            group_function = groupby_min
+            heights = mins
         elif mode in ['max']:
-            group_function = groupby_max
+            heights = maxs
 
-        # Labeled connected regions with an integer
-        labeled = label(mask >= threshold)
-        objects = find_objects(labeled)
+        # Records of each component are contiguous after stable sort, and ordered by (iline, xline) inside
+        order = np.argsort(labels, kind='stable')
+        labels = labels[order]
+        points = np.stack([ilines[order], xlines[order], heights[order]], axis=1).astype(np.int64) + shifts
+        bounds = np.flatnonzero(np.diff(labels)) + 1
 
         # Create an instance of Horizon for each separate region
         horizons = []
-        for i, sl in enumerate(objects):
-            max_possible_length = 1
-            for j in range(3):
-                max_possible_length *= sl[j].stop - sl[j].start
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(labels)]):
+            if stop > start:
+                horizons.append(Horizon(points[start:stop], geometry, name=f'{prefix}_{labels[start] - 1}'))
 
-            if max_possible_length >= minsize:
-                indices = np.nonzero(labeled[sl] == i + 1)
+        horizons.sort(key=len)
+        return horizons
 
-                if len(indices[0]) >= minsize:
-                    coords = np.vstack([indices[i] + sl[i].start for i in range(3)]).T
+    @staticmethod
+    def _chunked_surface(mask, threshold, chunk_size=None):
+        """ Apply :func:`.extract_surface` to the mask chunk by chunk along the first axis.
+        By default, in-memory arrays are processed at once, and chunks of 100 ilines are used for other sources.
+        """
+        if chunk_size is None:
+            in_memory = type(mask) is np.ndarray # pylint: disable=unidiomatic-typecheck
+            chunk_size = max(len(mask), 1) if in_memory else 100
 
-                    points = group_function(coords) + shifts
-                    horizons.append(Horizon(points, geometry, name=f'{prefix}_{i}'))
+        depths = np.zeros(mask.shape[:2], dtype=np.int64)
+        confident = np.zeros(mask.shape[:2], dtype=np.bool_)
+        for start in range(0, mask.shape[0], chunk_size):
+            depths[start:start + chunk_size], confident[start:start + chunk_size] = \
+                extract_surface(np.asarray(mask[start:start + chunk_size]), threshold=threshold)
+        return depths, confident
 
-        horizons.sort(key=len)
-        return horizons
+    @staticmethod
+    def from_surface(depths, confident, geometry, shifts, minsize=0, prefix='predict', index=0):
+        """ Convert depth map of one surface, for example, from :func:`.extract_surface`, into a list with
+        at most one horizon. Only `confident` traces are used; `shifts` are the same, as in :meth:`.from_mask`.
+        Horizon is named with `prefix` and `index`, for example, the number of the mask in a batch.
+        """
+        ilines, xlines = np.nonzero(confident)
+        if len(ilines) == 0 or len(ilines) < minsize:
+            return []
+        points = np.stack([ilines, xlines, depths[ilines, xlines]], axis=1).astype(np.int64) + shifts
+        return [Horizon(points, geometry, name=f'{prefix}_{index}')]
+
+    @staticmethod
+    def _chunked_components(mask, threshold, minsize, chunk_size):
+        """ Label components of the mask chunk by chunk along the first axis and stitch them with union-find.
+        Only faces of adjacent chunks and per-trace records are kept in memory.
+        """
+        records, pairs = [], []
+        n_labels, prev_face = 0, None
+
+        for start in range(0, mask.shape[0], chunk_size):
+            chunk = np.asarray(mask[start:start + chunk_size])
+            labels, chunk_records = extract_components(chunk, threshold=threshold, minsize=0)
+
+            # Make ids unique across chunks
+            labels = labels.astype(np.int64)
+            labels[labels > 0] += n_labels
+            chunk_records = list(chunk_records)
+            chunk_records[0] = chunk_records[0] + n_labels
+            chunk_records[1] = chunk_records[1] + start
+            n_labels = max(n_labels, labels.max(initial=0))
+            records.append(chunk_records)
+
+            # Pairs of ids, connected through the face between chunks
+            if prev_face is not None:
+                curr_face = labels[0]
+                n_x, n_h = curr_face.shape
+                for dx, dh in product([-1, 0, 1], repeat=2):
+                    x_start, x_stop = max(0, -dx), n_x - max(0, dx)
+                    h_start, h_stop = max(0, -dh), n_h - max(0, dh)
+                    current = curr_face[x_start:x_stop, h_start:h_stop]
+                    previous = prev_face[x_start + dx:x_stop + dx, h_start + dh:h_stop + dh]
+                    connected = (current > 0) & (previous > 0)
+                    pairs.append(np.stack([current[connected], previous[connected]], axis=1))
+            prev_face = labels[-1]
+
+        labels, ilines, xlines, sums, counts, mins, maxs = [np.concatenate(item) for item in zip(*records)]
+
+        # Resolve groups of components and drop small ones
+        pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+        roots = union_components(n_labels, pairs)
+        labels = roots[labels]
+
+        sizes = np.bincount(labels, weights=counts)
+        keep = sizes[labels] >= minsize
+        labels, ilines, xlines = labels[keep], ilines[keep], xlines[keep]
+        sums, counts, mins, maxs = sums[keep], counts[keep], mins[keep], maxs[keep]
+        if len(labels) == 0:
+            return labels, ilines, xlines, sums, counts, mins, maxs
+
+        # Merged components can share traces: aggregate their records once again
+        order = np.lexsort([xlines, ilines, labels])
+        labels, ilines, xlines = labels[order], ilines[order], xlines[order]
+        sums, counts, mins, maxs = sums[order], counts[order], mins[order], maxs[order]
+
+        change = (np.diff(labels) != 0) | (np.diff(ilines) != 0) | (np.diff(xlines) != 0)
+        starts = np.r_[0, np.flatnonzero(change) + 1]
+        return (labels[starts], ilines[starts], xlines[starts],
+                np.add.reduceat(sums, starts), np.add.reduceat(counts, starts),
+                np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts))
 
 
     # Functions to use to change the horizon
@@ -718,6 +1053,10 @@ class Horizon:
         kwargs : dict
             Additional arguments to pass to the function.
         """
+        tile_size = self.tiled.tile_size if self.tiled is not None else None
+        version, i_min_before, x_min_before = self._version, self.i_min, self.x_min
+        matrix_before = np.copy(self.matrix) # function can change matrix inplace
+
         result = function(self.matrix, **kwargs)
         if isinstance(result, tuple) and len(result) == 3:
             matrix, i_min, x_min = result
@@ -726,6 +1065,10 @@ class Horizon:
         self.matrix, self.i_min, self.x_min = matrix, i_min, x_min
 
         self.reset_storage('points') # applied to matrix, so we need to re-create points
+        if tile_size is not None:
+            self.sparsify(tile_size)
+        self.mark_dirty(version, self.changed_bbox(matrix_before, i_min_before, x_min_before,
+                                                   matrix, i_min, x_min))
 
     def apply_to_points(self, function, **kwargs):
         """ Apply passed function to points storage.
@@ -738,8 +1081,11 @@ class Horizon:
         kwargs : dict
             Additional arguments to pass to the function.
         """
+        version, matrix_before = self._version, self.matrix
         self.points = function(self.points, **kwargs)
         self.reset_storage('matrix') # applied to points, so we need to re-create matrix
+        self.mark_dirty(version, self.changed_bbox(matrix_before, self.i_min, self.x_min,
+                                                   self.matrix, self.i_min, self.x_min))
 
 
     def filter_points(self, filtering_matrix=None, **kwargs):
@@ -859,7 +1205,7 @@ class Horizon:
         ----------
         mask : ndarray
             Background to add horizon to.
-        locations : ndarray
+        locations : sequence of slices or arrays
             Where the mask is located.
         width : int
             Width of an added horizon.
@@ -868,10 +1214,7 @@ class Horizon:
         low = width // 2
         high = max(width - low, 0)
 
-        mask_bbox = np.array([[locations[0][0], locations[0][-1]+1],
-                              [locations[1][0], locations[1][-1]+1],
-                              [locations[2][0], locations[2][-1]+1]],
-                             dtype=np.int32)
+        mask_bbox = np.array([location_bounds(item) for item in locations], dtype=np.int32)
 
         # Getting coordinates of overlap in cubic system
         (mask_i_min, mask_i_max), (mask_x_min, mask_x_max), (mask_h_min, mask_h_max) = mask_bbox
@@ -881,8 +1224,7 @@ class Horizon:
         x_min, x_max = max(self.x_min, mask_x_min), min(self.x_max + 1, mask_x_max)
 
         if i_max >= i_min and x_max >= x_min:
-            overlap = self.matrix[i_min - self.i_min:i_max - self.i_min,
-                                  x_min - self.x_min:x_max - self.x_min]
+            overlap = self.matrix_window(i_min, i_max, x_min, x_max)
 
             # Coordinates of points to use in overlap local system
             idx_i, idx_x = np.asarray((overlap != self.FILL_VALUE) &
@@ -901,8 +1243,9 @@ class Horizon:
         return mask
 
 
-    def get_cube_values(self, window=23, offset=0, scale=False, chunk_size=256):
+    def get_cube_values(self, window=23, offset=0, scale=False, chunk_size=256, on_full=False):
         """ Get values from the cube along the horizon.
+        Only the part of the cube inside the horizon bounding box is read: chunk by chunk along the depth axis.
 
         Parameters
         ----------
@@ -915,59 +1258,170 @@ class Horizon:
             If callable, then it is applied to iline-oriented slices of data from the cube.
         chunk_size : int
             Size of data along height axis processed at a time.
+        on_full : bool
+            If True, then values are returned in cubic coordinates: array of (ilines_len, xlines_len, window) shape.
+            Otherwise, array of (i_length, x_length, window) shape, corresponding to the horizon bounding box.
+
+        Returns
+        -------
+        ndarray
+            Float32 array with cube values along the horizon.
+            Traces without horizon are filled with zeros, dead traces are filled with `nan`.
         """
-        low = window // 2
-        high = max(window - low, 0)
-        chunk_size = min(chunk_size, self.h_max - self.h_min + window)
+        return self.get_cube_values_many([self], window=window, offset=offset, scale=scale,
+                                         chunk_size=chunk_size, on_full=on_full, n_workers=1)[0]
+
+    @staticmethod
+    def get_cube_values_many(horizons, window=23, offset=0, scale=False, chunk_size=256, on_full=False,
+                             n_workers=4, max_prefetch=2):
+        """ Get values from the cube along each of the horizons in one pass over the cube.
+        Depth chunks are read once for all the horizons they are needed for: only the union of bounding boxes
+        of such horizons is read. Chunks are read in a thread pool ahead of time, while values from
+        the previous ones are put into per-horizon outputs.
+        For unstructured (SEG-Y) geometries, only the needed windows of the needed traces are read,
+        so no conversion of the cube is required.
+
+        Parameters
+        ----------
+        horizons : sequence of :class:`.Horizon`
+            Horizons on the same geometry.
+        n_workers : int
+            Number of threads to read chunks with.
+        max_prefetch : int
+            Maximum number of chunks read ahead of time: limits the memory used by chunks to
+            `max_prefetch + 1` of them.
+        other parameters
+            The same, as in :meth:`.get_cube_values`.
+
+        Returns
+        -------
+        list of ndarrays
+            Values along each of the horizons, in the same order as `horizons`.
+        """
+        if not horizons:
+            return []
+        geometry = horizons[0].geometry
+        if any(horizon.geometry is not geometry for horizon in horizons):
+            raise ValueError('All the horizons must be on the same geometry!')
 
-        cube_hdf5 = self.geometry.file_hdf5['cube_h']
-        background = np.full((self.geometry.ilines_len, self.geometry.xlines_len, window), 0.0)
+        low = window // 2
+        shift = offset - low
 
         # Make callable scaler
         if callable(scale):
             pass
         elif scale is True:
-            scale = self.geometry.scaler
+            scale = geometry.scaler
         elif scale is False:
             scale = lambda array: array
 
-        for h_start in range(self.h_min - low, self.h_max + high, chunk_size):
-            h_end = min(h_start + chunk_size, self.h_max + high, self.geometry.depth)
-
-            # Get chunk from the cube (depth-wise)
-            data_chunk = cube_hdf5[h_start:h_end, :, :]
-            data_chunk = scale(data_chunk)
+        backgrounds = [np.zeros((horizon.i_length, horizon.x_length, window), dtype=np.float32)
+                       for horizon in horizons]
 
-            # Check which points of the horizon are in the current chunk (and present)
-            idx_i, idx_x = np.asarray((self.matrix != self.FILL_VALUE) &
-                                      (self.matrix >= h_start) &
-                                      (self.matrix < h_end)).nonzero()
-            heights = self.matrix[idx_i, idx_x]
+        if geometry.structured:
+            Horizon._get_cube_values_chunks(horizons, backgrounds, geometry, window, shift, scale,
+                                            chunk_size, n_workers, max_prefetch)
+        else:
+            Horizon._get_cube_values_traces(horizons, backgrounds, geometry, window, shift, scale)
 
-            # Convert spatial coordinates to cubic, convert height to current chunk local system
-            idx_i += self.i_min
-            idx_x += self.x_min
-            heights -= (h_start + low - offset)
+        zero_traces = geometry.get_zero_traces()
+        result = []
+        for horizon, background in zip(horizons, backgrounds):
+            background[zero_traces[horizon.i_min:horizon.i_max + 1, horizon.x_min:horizon.x_max + 1] == 1] = np.nan
 
-            # Remove traces that are not fully inside `window`
-            mask = (heights + window <= (h_end - h_start))
-            idx_i = idx_i[mask]
-            idx_x = idx_x[mask]
-            heights = heights[mask]
+            if on_full:
+                background = horizon.values_to_full(background)
+            result.append(background)
+        return result
 
-            # Subsequently add values from the cube to background, shift horizon 1 unit lower,
-            # remove all heights that are bigger than can fit into background
-            for j in range(window):
-                background[idx_i, idx_x, np.full_like(heights, j)] = data_chunk[heights, idx_i, idx_x]
-                heights += 1
+    def values_to_full(self, values):
+        """ Put values along the horizon in its bounding box, for example, from :meth:`.get_cube_values`,
+        into an array that covers the whole cube spatially. Dead traces are filled with `nan`.
+        """
+        full_values = np.zeros((*self.cube_shape[:-1], values.shape[-1]), dtype=values.dtype)
+        full_values[self.geometry.get_zero_traces() == 1] = np.nan
+        full_values[self.i_min:self.i_max + 1, self.x_min:self.x_max + 1] = values
+        return full_values
 
-                mask = heights < chunk_size
-                idx_i = idx_i[mask]
-                idx_x = idx_x[mask]
-                heights = heights[mask]
+    @staticmethod
+    def _get_cube_values_traces(horizons, backgrounds, geometry, window, shift, scale):
+        """ Read only the needed windows of the needed traces from unstructured (SEG-Y) geometry. """
+        points = [horizon.tiled.points if horizon.tiled is not None else
+                  Horizon.matrix_to_points(horizon.matrix) + np.array([horizon.i_min, horizon.x_min, 0])
+                  for horizon in horizons]
+        ilines = np.concatenate([item[:, 0] for item in points])
+        xlines = np.concatenate([item[:, 1] for item in points])
+        starts = np.concatenate([item[:, 2] + shift for item in points])
+
+        values = geometry.load_windows(ilines, xlines, starts, window)
+        values = scale(values).astype(np.float32, copy=False)
+
+        position = 0
+        for horizon, background, item in zip(horizons, backgrounds, points):
+            background[item[:, 0] - horizon.i_min, item[:, 1] - horizon.x_min] = values[position:position + len(item)]
+            position += len(item)
 
-        background[self.geometry.zero_traces == 1] = np.nan
-        return background
+    @staticmethod
+    def _get_cube_values_chunks(horizons, backgrounds, geometry, window, shift, scale,
+                                chunk_size, n_workers, max_prefetch):
+        """ Stream depth chunks from structured geometry and put values from them into `backgrounds`. """
+        # Plan chunks: depths of the first sample of each window, split into chunks
+        starts = np.array([[horizon.h_min + shift, horizon.h_max + shift + 1] for horizon in horizons])
+        plan = []
+        for h_start in range(starts[:, 0].min(), starts[:, 1].max(), chunk_size):
+            h_end = h_start + chunk_size
+            active = np.nonzero((starts[:, 0] < h_end) & (starts[:, 1] > h_start))[0]
+            if len(active) == 0:
+                continue
+            h_end = min(h_end, starts[active, 1].max())
+
+            # Depth range of cube data, needed for current chunk
+            read_start = max(h_start, 0)
+            read_end = min(h_end + window - 1, geometry.depth)
+            if read_start >= read_end:
+                continue
+
+            i_min = min(horizons[idx].i_min for idx in active)
+            i_max = max(horizons[idx].i_max for idx in active)
+            x_min = min(horizons[idx].x_min for idx in active)
+            x_max = max(horizons[idx].x_max for idx in active)
+            locations = [slice(i_min, i_max + 1), slice(x_min, x_max + 1), slice(read_start, read_end)]
+            plan.append((h_start, h_end, read_start, i_min, x_min, active, locations))
+
+        def load_chunk(locations):
+            data_chunk = geometry.load_crop(locations, axis='h')
+            return scale(data_chunk).astype(np.float32, copy=False)
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(load_chunk, item[-1]) for item in plan[:max_prefetch + 1]]
+
+            for k, (h_start, h_end, read_start, i_min, x_min, active, _) in enumerate(plan):
+                data_chunk = futures[k].result()
+                futures[k] = None
+
+                for idx in active:
+                    horizon = horizons[idx]
+                    if horizon.tiled is None:
+                        data_view = data_chunk[horizon.i_min - i_min:horizon.i_max + 1 - i_min,
+                                               horizon.x_min - x_min:horizon.x_max + 1 - x_min]
+                        _gather_window(horizon.matrix, data_view, backgrounds[idx], horizon.FILL_VALUE,
+                                       shift, h_start, h_end, read_start)
+                        continue
+
+                    # Sparse horizons: only stored tiles are processed
+                    for tile_i, tile_x, tile in horizon.tiled.items():
+                        i_start, i_stop = max(tile_i, horizon.i_min), min(tile_i + len(tile), horizon.i_max + 1)
+                        x_start, x_stop = max(tile_x, horizon.x_min), min(tile_x + len(tile), horizon.x_max + 1)
+                        _gather_window(tile[i_start - tile_i:i_stop - tile_i, x_start - tile_x:x_stop - tile_x],
+                                       data_chunk[i_start - i_min:i_stop - i_min, x_start - x_min:x_stop - x_min],
+                                       backgrounds[idx][i_start - horizon.i_min:i_stop - horizon.i_min,
+                                                        x_start - horizon.x_min:x_stop - horizon.x_min],
+                                       horizon.FILL_VALUE, shift, h_start, h_end, read_start)
+                del data_chunk
+
+                # Next read is started only after the current chunk is released
+                if k + max_prefetch + 1 < len(plan):
+                    futures.append(executor.submit(load_chunk, plan[k + max_prefetch + 1][-1]))
 
     def get_cube_values_line(self, orientation='ilines', line=1, window=23, offset=0, scale=False):
         """ Get values from the cube along the horizon on a particular line.
@@ -999,23 +1453,20 @@ class Horizon:
             scale = lambda array: array
 
         # Parameters for different orientation
+        zero_traces = self.geometry.get_zero_traces()
         if orientation.startswith('i'):
-            cube_hdf5 = self.geometry.file_hdf5['cube']
-            slide_transform = lambda array: array
-
+            axis = 0
             hor_line = np.squeeze(self.matrix[line, :])
-            background = np.zeros((self.geometry.xlines_len, window))
+            background = np.zeros((self.cube_shape[1], window))
             idx_offset = self.x_min
-            bad_traces = np.squeeze(self.geometry.zero_traces[line, :])
+            bad_traces = np.squeeze(np.copy(zero_traces[line, :]))
 
         elif orientation.startswith('x'):
-            cube_hdf5 = self.geometry.file_hdf5['cube_x']
-            slide_transform = lambda array: array.T
-
+            axis = 1
             hor_line = np.squeeze(self.matrix[:, line])
-            background = np.zeros((self.geometry.ilines_len, window))
+            background = np.zeros((self.cube_shape[0], window))
             idx_offset = self.i_min
-            bad_traces = np.squeeze(self.geometry.zero_traces[:, line])
+            bad_traces = np.squeeze(np.copy(zero_traces[:, line]))
 
         # Check where horizon is
         idx = np.asarray((hor_line != self.FILL_VALUE)).nonzero()[0]
@@ -1025,8 +1476,8 @@ class Horizon:
         idx += idx_offset
         heights -= (low - offset)
 
-        slide = cube_hdf5[line, :, :]
-        slide = slide_transform(slide)
+        # For SEG-Y, `stable=False` makes the slide have a trace for each of the `uniques`, even missing ones
+        slide = self.geometry.load_slide(line, axis=axis, stable=False)
         slide = scale(slide)
 
         # Subsequently add values from the cube to background and shift horizon 1 unit lower
@@ -1048,16 +1499,16 @@ class Horizon:
     @property
     def amplitudes(self):
         """ Values from the cube along the horizon. """
-        amplitudes = self.get_cube_values(window=1)
-        amplitudes[self.full_matrix == self.FILL_VALUE] = np.nan
+        amplitudes = self.get_cube_values(window=1, on_full=True)
+        amplitudes[self.full_matrix == self.FILL_VALUE] = np.nan # pylint: disable=comparison-with-callable
         return amplitudes
 
-    @property
+    @versioned_property
     def binary_matrix(self):
         """ Matrix with ones at places where horizon is present and zeros everywhere else. """
         return (self.matrix > 0).astype(bool)
 
-    @property
+    @versioned_property
     def borders_matrix(self):
         """ Borders of horizons (borders of holes inside are not included). """
         filled_matrix = self.filled_matrix
@@ -1065,7 +1516,7 @@ class Horizon:
         eroded = binary_erosion(filled_matrix, structure, border_value=0)
         return filled_matrix ^ eroded # binary difference operation
 
-    @property
+    @versioned_property
     def boundaries_matrix(self):
         """ Borders of horizons (borders of holes inside included). """
         binary_matrix = self.binary_matrix
@@ -1078,14 +1529,14 @@ class Horizon:
         """ Ratio between number of present values and number of good traces in cube. """
         return len(self) / (np.prod(self.cube_shape[:2]) - np.sum(self.geometry.zero_traces))
 
-    @property
+    @versioned_property
     def filled_matrix(self):
         """ Binary matrix with filled holes. """
         structure = np.ones((3, 3))
         filled_matrix = binary_fill_holes(self.binary_matrix, structure)
         return filled_matrix
 
-    @property
+    @versioned_property
     def full_matrix(self):
         """ Matrix in cubic coordinate system. """
         return self.put_on_full()
@@ -1118,19 +1569,19 @@ class Horizon:
         """ Phase along the horizon. """
         return self.horizon_metrics.evaluate('instantaneous_phase')
 
-    @property
+    @versioned_property
     def number_of_holes(self):
         """ Number of holes inside horizon borders. """
         holes_array = self.filled_matrix != self.binary_matrix
         _, num = label(holes_array, connectivity=2, return_num=True, background=0)
         return num
 
-    @property
+    @versioned_property
     def perimeter(self):
         """ Number of points in the borders. """
-        return np.sum((self.borders_matrix == 1).astype(np.int32))
+        return np.sum((self.borders_matrix == 1).astype(np.int32)) # pylint: disable=comparison-with-callable
 
-    @property
+    @versioned_property
     def solidity(self):
         """ Ratio of area covered by horizon to total area inside borders. """
         return len(self) / np.sum(self.filled_matrix)
@@ -1222,11 +1673,8 @@ class Horizon:
 
         # Compare matrices on overlap without adjacency:
         if merge_code != 1 and i_range < 0 and x_range < 0:
-            self_overlap = self.matrix[overlap_i_min - self.i_min:overlap_i_max - self.i_min,
-                                       overlap_x_min - self.x_min:overlap_x_max - self.x_min]
-
-            other_overlap = other.matrix[overlap_i_min - other.i_min:overlap_i_max - other.i_min,
-                                         overlap_x_min - other.x_min:overlap_x_max - other.x_min]
+            self_overlap = self.matrix_window(overlap_i_min, overlap_i_max, overlap_x_min, overlap_x_max)
+            other_overlap = other.matrix_window(overlap_i_min, overlap_i_max, overlap_x_min, overlap_x_max)
 
             self_mask = self_overlap != self.FILL_VALUE
             other_mask = other_overlap != self.FILL_VALUE
@@ -1258,51 +1706,54 @@ class Horizon:
         """ Merge two horizons into one.
         Note that this function can either merge horizons in-place of the first one (`self`), or create a new instance.
         """
-        # Create shared background for both horizons
-        shared_i_min, shared_i_max = min(self.i_min, other.i_min), max(self.i_max, other.i_max)
-        shared_x_min, shared_x_max = min(self.x_min, other.x_min), max(self.x_max, other.x_max)
+        return Horizon.merge_many([self, other], inplace=inplace)
 
-        background = np.zeros((shared_i_max - shared_i_min + 1, shared_x_max - shared_x_min + 1),
-                              dtype=np.int32)
 
-        # Coordinates inside shared for `self` and `other`
-        shared_self_i_min, shared_self_x_min = self.i_min - shared_i_min, self.x_min - shared_x_min
-        shared_other_i_min, shared_other_x_min = other.i_min - shared_i_min, other.x_min - shared_x_min
+    def check_adjacent(self, other, mean_threshold=3.0, adjacency=3):
+        """ Check whether horizons are adjacent (that is, close with some margin) and height-close.
 
-        # Add both horizons to the background
-        background[shared_self_i_min:shared_self_i_min+self.i_length,
-                   shared_self_x_min:shared_self_x_min+self.x_length] += self.matrix
+        Parameters
+        ----------
+        self, other : :class:`.Horizon` instances
+            Horizons to check.
+        mean_threshold : number
+            Height threshold for mean distances.
+        adjacency : int
+            Margin to consider horizons close (spatially).
+        """
+        # Simplest possible check: horizons are too far away from one another (depth-wise)
+        overlap_h_min, overlap_h_max = max(self.h_min, other.h_min), min(self.h_max, other.h_max)
+        if overlap_h_max - overlap_h_min < 0:
+            return False
 
-        background[shared_other_i_min:shared_other_i_min+other.i_length,
-                   shared_other_x_min:shared_other_x_min+other.x_length] += other.matrix
+        # Band: part of `self` bbox, that is within `adjacency` of `other` bbox
+        band_i_min, band_i_max = max(self.i_min, other.i_min - adjacency), min(self.i_max, other.i_max + adjacency)
+        band_x_min, band_x_max = max(self.x_min, other.x_min - adjacency), min(self.x_max, other.x_max + adjacency)
+        if band_i_min > band_i_max or band_x_min > band_x_max:
+            return False
 
-        # Correct overlapping points
-        overlap_i_min, overlap_i_max = max(self.i_min, other.i_min), min(self.i_max, other.i_max) + 1
-        overlap_x_min, overlap_x_max = max(self.x_min, other.x_min), min(self.x_max, other.x_max) + 1
+        # Part of `other`, that can reach the band, is placed on a canvas: band with margins of `adjacency`
+        crop_i_min, crop_i_max = max(other.i_min, band_i_min - adjacency), min(other.i_max, band_i_max + adjacency)
+        crop_x_min, crop_x_max = max(other.x_min, band_x_min - adjacency), min(other.x_max, band_x_max + adjacency)
+        crop = other.matrix_window(crop_i_min, crop_i_max + 1, crop_x_min, crop_x_max + 1)
 
-        overlap_i_min -= shared_i_min
-        overlap_i_max -= shared_i_min
-        overlap_x_min -= shared_x_min
-        overlap_x_max -= shared_x_min
+        canvas_i_min, canvas_x_min = band_i_min - adjacency, band_x_min - adjacency
+        canvas = np.zeros((band_i_max - band_i_min + 1 + 2 * adjacency,
+                           band_x_max - band_x_min + 1 + 2 * adjacency), dtype=np.float32)
+        canvas[crop_i_min - canvas_i_min:crop_i_max - canvas_i_min + 1,
+               crop_x_min - canvas_x_min:crop_x_max - canvas_x_min + 1] = np.where(crop != self.FILL_VALUE, crop, 0)
 
-        overlap = background[overlap_i_min:overlap_i_max, overlap_x_min:overlap_x_max]
-        mask = overlap >= 0
-        overlap[mask] //= 2
-        overlap[~mask] -= self.FILL_VALUE
-        background[overlap_i_min:overlap_i_max, overlap_x_min:overlap_x_max] = overlap
+        # Enlarge `other` to account for adjacency: each point gets the maximum height in its neighbourhood
+        kernel = np.ones((3, 3), np.float32)
+        dilated = cv2.dilate(canvas, kernel, iterations=adjacency)
+        dilated = dilated[adjacency:adjacency + band_i_max - band_i_min + 1,
+                          adjacency:adjacency + band_x_max - band_x_min + 1]
 
-        background[background == 0] = self.FILL_VALUE
-        length = len(self) + len(other) - mask.sum()
-        # Create new instance or change `self`
-        if inplace:
-            # Change `self` inplace
-            self.from_matrix(background, i_min=shared_i_min, x_min=shared_x_min, length=length)
-            merged = True
-        else:
-            # Return a new instance of horizon
-            merged = Horizon(background, self.geometry, self.name,
-                             i_min=shared_i_min, x_min=shared_x_min, length=length)
-        return merged
+        # Compare heights of `self` in the band to the enlarged `other`
+        self_band = self.matrix_window(band_i_min, band_i_max + 1, band_x_min, band_x_max + 1)
+        mask = (self_band != self.FILL_VALUE) & (dilated > 0)
+        diffs = np.abs(self_band[mask] - dilated[mask])
+        return len(diffs) != 0 and np.mean(diffs) < mean_threshold
 
 
     def adjacent_merge(self, other, mean_threshold=3.0, adjacency=3, inplace=False):
@@ -1320,114 +1771,165 @@ class Horizon:
         inplace : bool
             Whether to create new instance or update `self`.
         """
-        # Simplest possible check: horizons are too far away from one another (depth-wise)
-        overlap_h_min, overlap_h_max = max(self.h_min, other.h_min), min(self.h_max, other.h_max)
-        if overlap_h_max - overlap_h_min < 0:
-            return False
+        if self.check_adjacent(other, mean_threshold=mean_threshold, adjacency=adjacency):
+            return Horizon.merge_many([self, other], inplace=inplace)
+        return False
 
-        # Create shared background for both horizons
-        shared_i_min, shared_i_max = min(self.i_min, other.i_min), max(self.i_max, other.i_max)
-        shared_x_min, shared_x_max = min(self.x_min, other.x_min), max(self.x_max, other.x_max)
 
-        background = np.zeros((shared_i_max - shared_i_min + 1, shared_x_max - shared_x_min + 1),
-                              dtype=np.int32)
+    @staticmethod
+    def merge_many(horizons, inplace=False):
+        """ Merge multiple horizons into one at once. Heights in points, shared by multiple horizons, are averaged.
+        Note that this function can either merge horizons in-place of the first one, or create a new instance.
+        """
+        first = horizons[0]
+        if any(horizon.tiled is not None for horizon in horizons):
+            return Horizon._merge_many_tiled(horizons, inplace=inplace)
+
+        shared_i_min, shared_i_max = min(item.i_min for item in horizons), max(item.i_max for item in horizons)
+        shared_x_min, shared_x_max = min(item.x_min for item in horizons), max(item.x_max for item in horizons)
+        shape = (shared_i_max - shared_i_min + 1, shared_x_max - shared_x_min + 1)
+
+        # Accumulate sums and counts of heights on a shared canvas
+        sums = np.zeros(shape, dtype=np.int64)
+        counts = np.zeros(shape, dtype=np.int32)
+        for horizon in horizons:
+            i_start, x_start = horizon.i_min - shared_i_min, horizon.x_min - shared_x_min
+            window = (slice(i_start, i_start + horizon.i_length), slice(x_start, x_start + horizon.x_length))
+            mask = horizon.matrix != horizon.FILL_VALUE
+            sums[window][mask] += horizon.matrix[mask]
+            counts[window][mask] += 1
+
+        mask = counts > 0
+        background = np.full(shape, first.FILL_VALUE, dtype=np.int32)
+        background[mask] = sums[mask] // counts[mask]
+        length = int(mask.sum())
+
+        # Create new instance or change the first horizon
+        if inplace:
+            version = first._version # pylint: disable=protected-access
+            first.from_matrix(background, i_min=shared_i_min, x_min=shared_x_min, length=length)
+            first.mark_dirty(version, Horizon._union_bbox(horizons[1:]))
+            merged = True
+        else:
+            merged = Horizon(background, first.geometry, first.name,
+                             i_min=shared_i_min, x_min=shared_x_min, length=length)
+        return merged
 
-        # Coordinates inside shared for `self` and `other`
-        shared_self_i_min, shared_self_x_min = self.i_min - shared_i_min, self.x_min - shared_x_min
-        shared_other_i_min, shared_other_x_min = other.i_min - shared_i_min, other.x_min - shared_x_min
 
-        # Put the second of the horizons on background
-        background[shared_other_i_min:shared_other_i_min+other.i_length,
-                   shared_other_x_min:shared_other_x_min+other.x_length] += other.matrix
+    @staticmethod
+    def _merge_many_tiled(horizons, inplace=False):
+        """ Merge multiple horizons, at least one of which is sparse, into a sparse one. Only tiles, covered by
+        any of the horizons, are allocated.
+        """
+        first = horizons[0]
+        tile_size = next(horizon.tiled.tile_size for horizon in horizons if horizon.tiled is not None)
+
+        sums, counts = {}, {}
+        for horizon in horizons:
+            tiled = horizon.tiled or TiledMatrix.from_matrix(horizon.matrix, horizon.i_min, horizon.x_min,
+                                                             tile_size=tile_size, fill_value=horizon.FILL_VALUE)
+            if tiled.tile_size != tile_size:
+                tiled = TiledMatrix.from_matrix(horizon.matrix, horizon.i_min, horizon.x_min,
+                                                tile_size=tile_size, fill_value=horizon.FILL_VALUE)
+
+            for key, tile in tiled.tiles.items():
+                if key not in sums:
+                    sums[key] = np.zeros((tile_size, tile_size), dtype=np.int64)
+                    counts[key] = np.zeros((tile_size, tile_size), dtype=np.int32)
+                mask = tile != horizon.FILL_VALUE
+                sums[key][mask] += tile[mask]
+                counts[key][mask] += 1
+
+        tiles, length = {}, 0
+        for key, tile_sums in sums.items():
+            mask = counts[key] > 0
+            tile = np.full((tile_size, tile_size), first.FILL_VALUE, dtype=np.int32)
+            tile[mask] = tile_sums[mask] // counts[key][mask]
+            tiles[key] = tile
+            length += int(mask.sum())
+        tiled = TiledMatrix(tiles, tile_size, first.FILL_VALUE)
 
-        # Enlarge the image to account for adjacency
-        kernel = np.ones((3, 3), np.float32)
-        dilated_background = cv2.dilate(background.astype(np.float32), kernel,
-                                        iterations=adjacency).astype(np.int32)
-
-        # Make counts: number of horizons in each point; create indices of overlap
-        counts = (dilated_background != 0).astype(np.int32)
-        counts[shared_self_i_min:shared_self_i_min+self.i_length,
-               shared_self_x_min:shared_self_x_min+self.x_length] += 1
-        counts_idx = counts == 2
-
-        # Determine whether horizon can be merged (adjacent and height-close) or not
-        mergeable = False
-        if counts_idx.any():
-            # Put the first horizon on dilated background, compute mean
-            background[shared_self_i_min:shared_self_i_min+self.i_length,
-                       shared_self_x_min:shared_self_x_min+self.x_length] += self.matrix
-
-            # Compute diffs on overlap
-            diffs = background[counts_idx] - dilated_background[counts_idx]
-            diffs = np.abs(diffs)
-            diffs = diffs[diffs < (-self.FILL_VALUE // 2)]
-
-            if len(diffs) != 0 and np.mean(diffs) < mean_threshold:
-                mergeable = True
+        if inplace:
+            version = first._version # pylint: disable=protected-access
+            first.from_tiled(tiled, length=length)
+            first.mark_dirty(version, Horizon._union_bbox(horizons[1:]))
+            merged = True
+        else:
+            merged = Horizon(tiled, first.geometry, first.name, length=length)
+        return merged
 
-        if mergeable:
-            background[(background < 0) & (background != self.FILL_VALUE)] -= self.FILL_VALUE
-            background[background == 0] = self.FILL_VALUE
 
-            length = len(self) + len(other) # since there is no direct overlap
+    @staticmethod
+    def _union_bbox(horizons):
+        """ Bounding box of multiple horizons: the only place, where merge with them can change a horizon. """
+        if not horizons:
+            return Horizon.EMPTY_BBOX.copy()
+        return np.array([[min(item.i_min for item in horizons), max(item.i_max for item in horizons)],
+                         [min(item.x_min for item in horizons), max(item.x_max for item in horizons)]],
+                        dtype=np.int32)
 
-            # Create new instance or change `self`
-            if inplace:
-                # Change `self` inplace
-                self.from_matrix(background, i_min=shared_i_min, x_min=shared_x_min, length=length)
-                merged = True
-            else:
-                # Return a new instance of horizon
-                merged = Horizon(background, self.geometry, self.name,
-                                 i_min=shared_i_min, x_min=shared_x_min, length=length)
-            return merged
-        return False
+
+    @staticmethod
+    def merge_candidates(horizons, mean_threshold=2.0, adjacency=3, bucket_size=128):
+        """ Pairs of indices of horizons that are close enough both spatially and depth-wise to be possibly merged.
+        Bounding boxes, enlarged by `adjacency`, are put into a grid of square buckets; only horizons that share
+        a bucket and have close depth ranges are paired.
+        """
+        buckets = {}
+        for idx, horizon in enumerate(horizons):
+            i_range = range((horizon.i_min - adjacency) // bucket_size, (horizon.i_max + adjacency) // bucket_size + 1)
+            x_range = range((horizon.x_min - adjacency) // bucket_size, (horizon.x_max + adjacency) // bucket_size + 1)
+            for key in product(i_range, x_range):
+                buckets.setdefault(key, []).append(idx)
+
+        candidates = set()
+        for bucket in buckets.values():
+            candidates.update(combinations(bucket, 2))
+
+        for i, j in sorted(candidates):
+            first, second = horizons[i], horizons[j]
+            # All depth differences are at least the gap between depth ranges
+            if max(first.h_min, second.h_min) - min(first.h_max, second.h_max) >= mean_threshold:
+                continue
+            yield i, j
 
 
     @staticmethod
-    def merge_list(horizons, mean_threshold=2.0, adjacency=3, minsize=50):
-        """ Iteratively try to merge every horizon in a list to every other, until there are no possible merges. """
+    def merge_list(horizons, mean_threshold=2.0, adjacency=3, minsize=50, bucket_size=128):
+        """ Iteratively try to merge horizons in a list, until there are no possible merges.
+        Only candidate pairs from :meth:`.merge_candidates` are checked. Mergeable pairs are joined into groups with
+        union-find, and each group is merged in one pass, in-place of its first horizon.
+        """
         horizons = [horizon for horizon in horizons if len(horizon) >= minsize]
 
-        # iterate over list of horizons to merge what can be merged
-        i = 0
-        flag = True
-        while flag:
-            # the procedure continues while at least a pair of horizons is mergeable
-            flag = False
-            while True:
-                if i >= len(horizons):
-                    break
-
-                j = i + 1
-                while True:
-                    # attempt to merge each horizon to i-th horizon with fixed i
-                    if j >= len(horizons):
-                        break
-
-                    merge_code, _ = Horizon.verify_merge(horizons[i], horizons[j],
-                                                         mean_threshold=mean_threshold,
-                                                         adjacency=adjacency)
-                    if merge_code == 3:
-                        merged = Horizon.overlap_merge(horizons[i], horizons[j], inplace=True)
-                    elif merge_code == 2:
-                        merged = Horizon.adjacent_merge(horizons[i], horizons[j], inplace=True,
-                                                        mean_threshold=mean_threshold,
-                                                        adjacency=adjacency)
-                    else:
-                        merged = False
-
-                    if merged:
-                        _ = horizons.pop(j)
-                        flag = True
-                    else:
-                        j += 1
-                i += 1
+        while len(horizons) > 1:
+            pairs = []
+            for i, j in Horizon.merge_candidates(horizons, mean_threshold=mean_threshold,
+                                                 adjacency=adjacency, bucket_size=bucket_size):
+                merge_code, _ = Horizon.verify_merge(horizons[i], horizons[j],
+                                                     mean_threshold=mean_threshold,
+                                                     adjacency=adjacency)
+                if merge_code == 3 or (merge_code == 2 and
+                                       horizons[i].check_adjacent(horizons[j], mean_threshold=mean_threshold,
+                                                                  adjacency=adjacency)):
+                    pairs.append((i + 1, j + 1))
+
+            if not pairs:
+                break
+
+            # Groups are numbered in order of their first horizon, so the order of the list is kept
+            roots = union_components(len(horizons), np.array(pairs, dtype=np.int64))
+            groups = [[] for _ in range(roots.max())]
+            for i, horizon in enumerate(horizons):
+                groups[roots[i + 1] - 1].append(horizon)
+
+            for group in groups:
+                if len(group) > 1:
+                    Horizon.merge_many(group, inplace=True)
+            horizons = [group[0] for group in groups]
         return horizons
 
 
-
     def adjacent_merge_old(self, other, mean_threshold=3.0, adjacency=3,
                            check_only=False, force_merge=False, inplace=False):
         """ Collect stats on possible adjacent merge (that is merge with some margin), and, if needed, merge horizons.
@@ -1532,8 +2034,10 @@ class Horizon:
         return mergeable, merged, adjacency_info
 
 
-    def dump(self, path, transform=None, add_height=True):
+    def dump(self, path, transform=None, add_height=True, precision=3, chunk_size=1_000_000):
         """ Save horizon points on disk.
+        Points are generated from the depth map in (iline, xline) order and written in chunks of fixed size,
+        so that memory consumption does not depend on the size of the horizon, even if it is sparsified.
 
         Parameters
         ----------
@@ -1541,17 +2045,122 @@ class Horizon:
             Path to a file to save horizon to.
         transform : None or callable
             If callable, then applied to points after converting to ilines/xlines coordinate system.
+            Note that it is applied to each chunk of points separately.
         add_height : bool
             Whether to concatenate average horizon height to a file name.
+        precision : int
+            Number of digits after the decimal point to keep. Trailing zeros are not written.
+        chunk_size : int
+            Approximate number of points in each chunk.
         """
-        values = self.cubic_to_lines(copy(self.points))
-        values = values if transform is None else transform(values)
+        path = path if not add_height else f'{path}_#{round(self.h_mean, 1)}'
+        offsets = np.array([self.geometry.ilines_offset + self.i_min, self.geometry.xlines_offset + self.x_min])
+        rows_per_chunk = max(1, chunk_size // self.x_length)
 
-        df = pd.DataFrame(values, columns=self.COLUMNS)
-        df.sort_values(['iline', 'xline'], inplace=True)
+        with open(path, 'wb') as file:
+            for start in range(0, self.i_length, rows_per_chunk):
+                # For sparsified horizons, only tiles of the current chunk are assembled
+                stop = min(start + rows_per_chunk, self.i_length)
+                chunk = self.matrix_window(self.i_min + start, self.i_min + stop, self.x_min, self.x_max + 1)
+                idx = np.nonzero(chunk != self.FILL_VALUE)
 
-        path = path if not add_height else f'{path}_#{round(self.h_mean, 1)}'
-        df.to_csv(path, sep=' ', columns=self.COLUMNS, index=False, header=False)
+                values = np.empty((len(idx[0]), 3), dtype=np.float64)
+                values[:, 0] = idx[0] + start + offsets[0]
+                values[:, 1] = idx[1] + offsets[1]
+                values[:, 2] = chunk[idx] * self.geometry.sample_rate + self.geometry.delay
+                values = values if transform is None else transform(values)
+
+                buffer = np.empty(values.size * (24 + precision), dtype=np.uint8)
+                length = _format_points(values, precision, buffer)
+                file.write(buffer[:length].data)
+
+
+    @staticmethod
+    def dump_many(horizons, path, mode='w', compression='gzip'):
+        """ Save multiple horizons into one HDF5 container.
+        Each horizon is stored in a separate group with `matrix` dataset and attributes with its location, name and
+        depth stats. The `index` group contains the same information for all the horizons at once, so that
+        they can be selected without reading any of the matrices.
+
+        Parameters
+        ----------
+        horizons : sequence of :class:`.Horizon`
+            Horizons to save.
+        path : str
+            Path to the container.
+        mode : str
+            If 'w', then the container is created anew. If 'a', then horizons are added to the existing one.
+        compression : str or None
+            Compression filter for matrices.
+        """
+        with h5py.File(path, mode) as file:
+            group = file.require_group('horizons')
+            start = len(group)
+
+            for i, horizon in enumerate(horizons):
+                horizon_group = group.create_group(f'{start + i:06}')
+                horizon_group.create_dataset('matrix', data=horizon.matrix, compression=compression)
+
+                horizon_group.attrs['name'] = str(horizon.name)
+                horizon_group.attrs['cube_name'] = str(horizon.cube_name)
+                for field in Horizon.CONTAINER_INDEX:
+                    value = len(horizon) if field == 'length' else getattr(horizon, field)
+                    horizon_group.attrs[field] = value
+
+            # Re-create the index of the whole container
+            if 'index' in file:
+                del file['index']
+            keys = sorted(group.keys())
+            index_group = file.create_group('index')
+            index_group['key'] = np.array(keys, dtype='S')
+            index_group['name'] = np.array([group[key].attrs['name'].encode('utf-8') for key in keys], dtype='S')
+            for field in Horizon.CONTAINER_INDEX:
+                index_group[field] = np.array([group[key].attrs[field] for key in keys])
+
+    @staticmethod
+    def container_index(path):
+        """ Dataframe with names, locations and depth stats of horizons in the container, indexed by their keys. """
+        with h5py.File(path, 'r') as file:
+            index_group = file['index']
+            index = {field: index_group[field][()] for field in ['key', 'name'] + Horizon.CONTAINER_INDEX}
+
+        index['key'] = [item.decode('utf-8') for item in index['key']]
+        index['name'] = [item.decode('utf-8') for item in index['name']]
+        return pd.DataFrame(index).set_index('key')
+
+    @staticmethod
+    def load_many(path, geometry, names=None, depth_range=None, **kwargs):
+        """ Load horizons from the HDF5 container, created by :meth:`.dump_many`.
+        Selection is made by the container index: matrices of other horizons are not read at all.
+
+        Parameters
+        ----------
+        path : str
+            Path to the container.
+        geometry : :class:`.SeismicGeometry`
+            Geometry of the cube the horizons belong to.
+        names : sequence of str, optional
+            Names of horizons to load.
+        depth_range : sequence of two numbers, optional
+            Only horizons that intersect with this range of depths are loaded.
+        kwargs : dict
+            Passed directly to :class:`.Horizon` initialization.
+        """
+        index = Horizon.container_index(path)
+
+        mask = np.ones(len(index), dtype=bool)
+        if names is not None:
+            mask &= index['name'].isin(names).values
+        if depth_range is not None:
+            mask &= ((index['h_max'] >= depth_range[0]) & (index['h_min'] <= depth_range[1])).values
+        index = index[mask]
+
+        horizons = []
+        with h5py.File(path, 'r') as file:
+            for key, name, i_min, x_min in zip(index.index, index['name'], index['i_min'], index['x_min']):
+                matrix = file[f'horizons/{key}/matrix'][()]
+                horizons.append(Horizon(matrix, geometry, i_min=int(i_min), x_min=int(x_min), name=name, **kwargs))
+        return horizons
 
 
     # Methods of (visual) representation of a horizon
@@ -1624,11 +2233,11 @@ class Horizon:
             Can be either 'matplotlib' ('plt') or 'plotly' ('go')
         """
         # get values along the horizon and cast them to [0, 1]
-        amplitudes = self.get_cube_values(window=1 + width*2, offset=width)
+        amplitudes = self.get_cube_values(window=1 + width*2, offset=width, on_full=True)
         amplitudes = amplitudes[:, :, (0, width, -1)]
         amplitudes -= np.nanmin(amplitudes, axis=(0, 1)).reshape(1, 1, -1)
         amplitudes *= 1 / np.nanmax(amplitudes, axis=(0, 1)).reshape(1, 1, -1)
-        amplitudes[self.full_matrix == self.FILL_VALUE, :] = np.nan
+        amplitudes[self.full_matrix == self.FILL_VALUE, :] = np.nan # pylint: disable=comparison-with-callable
         amplitudes = amplitudes[:, :, ::-1]
         amplitudes *= np.asarray(channel_weights).reshape(1, 1, -1)
 
@@ -1664,7 +2273,7 @@ class Horizon:
         # Make `locations` for slide loading
         axis = self.geometry.parse_axis(axis)
         locations = self.geometry.make_slide_locations(loc, axis=axis)
-        shape = np.array([len(item) for item in locations])
+        shape = np.array([location_length(item) for item in locations])
 
         # Load seismic and mask
         seismic_slide = self.geometry.load_slide(loc=loc, axis=axis)
@@ -1718,6 +2327,262 @@ class Horizon:
                        name=f'Copy_of_{self.name}')
 
 
+class HorizonCollection:
+    """ Multiple horizons of the same cube with their locations and depth stats stacked into arrays,
+    so that queries over all of them are vectorized.
+
+    Stacked arrays are re-created automatically, if any of the horizons is changed.
+
+    Parameters
+    ----------
+    horizons : sequence of :class:`.Horizon`
+        Horizons to put into collection.
+
+    Attributes
+    ----------
+    bboxes : ndarray
+        Array of (n, 2, 2) shape with spatial bounding box of each horizon: [[i_min, i_max], [x_min, x_max]].
+    h_min, h_max, h_mean : ndarrays
+        Depth stats of each horizon.
+    lengths : ndarray
+        Number of labeled traces of each horizon.
+    """
+    def __init__(self, horizons=None):
+        self.horizons = list(horizons) if horizons is not None else []
+        self._versions = None
+        self.refresh()
+
+    def refresh(self):
+        """ Re-create stacked arrays from horizons. """
+        n = len(self.horizons)
+        self.bboxes = np.array([horizon.bbox for horizon in self.horizons], dtype=np.int64).reshape((n, 2, 2))
+        self.h_min = np.array([horizon.h_min for horizon in self.horizons], dtype=np.float64)
+        self.h_max = np.array([horizon.h_max for horizon in self.horizons], dtype=np.float64)
+        self.h_mean = np.array([horizon.h_mean for horizon in self.horizons], dtype=np.float64)
+        self.lengths = np.array([len(horizon) for horizon in self.horizons], dtype=np.int64)
+        self._versions = [horizon._version for horizon in self.horizons] # pylint: disable=protected-access
+
+    def _check_freshness(self):
+        # pylint: disable=protected-access
+        if any(horizon._version != version for horizon, version in zip(self.horizons, self._versions)):
+            self.refresh()
+
+    def __len__(self):
+        return len(self.horizons)
+
+    def __iter__(self):
+        return iter(self.horizons)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.horizons[key]
+        if isinstance(key, slice):
+            return HorizonCollection(self.horizons[key])
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.nonzero(key)[0]
+        return HorizonCollection([self.horizons[idx] for idx in key])
+
+    def append(self, horizon):
+        """ Add one more horizon to the collection. """
+        self.horizons.append(horizon)
+        self.refresh()
+
+    def sort(self, key='h_mean', reverse=False):
+        """ Sort horizons in-place by one of the stacked attributes. """
+        self._check_freshness()
+        order = np.argsort(getattr(self, key), kind='stable')
+        order = order[::-1] if reverse else order
+        self.horizons = [self.horizons[idx] for idx in order]
+        self.refresh()
+        return self
+
+
+    # Vectorized queries
+    def query(self, i_range=None, x_range=None, h_range=None):
+        """ Indices of horizons that intersect with given ranges. Each range is a pair of inclusive bounds;
+        if not provided, then there is no restriction along that axis.
+        """
+        self._check_freshness()
+        mask = np.ones(len(self), dtype=bool)
+        if i_range is not None:
+            mask &= (self.bboxes[:, 0, 1] >= i_range[0]) & (self.bboxes[:, 0, 0] <= i_range[1])
+        if x_range is not None:
+            mask &= (self.bboxes[:, 1, 1] >= x_range[0]) & (self.bboxes[:, 1, 0] <= x_range[1])
+        if h_range is not None:
+            mask &= (self.h_max >= h_range[0]) & (self.h_min <= h_range[1])
+        return np.nonzero(mask)[0]
+
+    def query_locations(self, locations):
+        """ Indices of horizons that can cross the crop at `locations`. """
+        bounds = [location_bounds(item) for item in locations]
+        return self.query(*[(start, stop - 1) for start, stop in bounds])
+
+    def nearest(self, depth, i_range=None, x_range=None):
+        """ Index of the horizon with mean depth closest to `depth` among the ones, intersecting with
+        given spatial ranges. Returns None, if there are no such horizons.
+        """
+        indices = self.query(i_range=i_range, x_range=x_range)
+        if len(indices) == 0:
+            return None
+        return indices[np.argmin(np.abs(self.h_mean[indices] - depth))]
+
+
+    # Batch operations
+    def stack(self, indices=None):
+        """ Depth maps of horizons on their shared bounding box, stacked into one (n, i_length, x_length) array.
+
+        Returns
+        -------
+        matrices : ndarray
+            Stacked depth maps of `int32` dtype; absent traces are filled with `FILL_VALUE`.
+        origin : tuple of two ints
+            Position of the (0, 0) trace of the matrices in cubic coordinates.
+        """
+        self._check_freshness()
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        i_min, i_max = self.bboxes[indices, 0, 0].min(), self.bboxes[indices, 0, 1].max()
+        x_min, x_max = self.bboxes[indices, 1, 0].min(), self.bboxes[indices, 1, 1].max()
+
+        matrices = np.full((len(indices), i_max - i_min + 1, x_max - x_min + 1), Horizon.FILL_VALUE, dtype=np.int32)
+        for position, idx in enumerate(indices):
+            horizon = self.horizons[idx]
+            matrices[position,
+                     horizon.i_min - i_min:horizon.i_max - i_min + 1,
+                     horizon.x_min - x_min:horizon.x_max - x_min + 1] = horizon.matrix
+        return matrices, (i_min, x_min)
+
+    def add_to_mask(self, mask, locations, width=3, alpha=1, ids=False):
+        """ Add every horizon, that crosses the crop at `locations`, to the `mask`.
+        If `ids` is True, then each horizon is added with its index in the collection plus one as the value.
+        """
+        for idx in self.query_locations(locations):
+            value = idx + 1 if ids else alpha
+            self.horizons[idx].add_to_mask(mask, locations=locations, width=width, alpha=value)
+        return mask
+
+    def compare(self, target, offset=0):
+        """ Compare each horizon of the collection against the `target` on their spatial overlap.
+        Only horizons with intersecting bounding boxes and depth ranges are compared.
+
+        Returns
+        -------
+        dict
+            Arrays with one value per horizon in the collection: `count` of traces on overlap,
+            `mean` and `abs_mean` of differences between `target` and horizon heights (with `offset` added).
+            Horizons without overlap have zero `count` and `nan` as stats.
+        """
+        candidates = self.query(i_range=target.bbox[0], x_range=target.bbox[1], h_range=(target.h_min, target.h_max))
+        return self.overlap_stats(target, candidates, offset=offset)
+
+    def overlap_stats(self, target, indices, offset=0):
+        """ Differences between `target` and horizons with given `indices` on their spatial overlaps,
+        computed in one pass over the points of all the horizons.
+
+        Returns
+        -------
+        dict
+            The same, as in :meth:`.compare`.
+        """
+        n = len(self)
+        result = {'count': np.zeros(n, dtype=np.int64),
+                  'mean': np.full(n, np.nan), 'abs_mean': np.full(n, np.nan)}
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return result
+
+        points = [self.horizons[idx].points for idx in indices]
+        ids = np.repeat(indices, [len(item) for item in points])
+        points = np.concatenate(points)
+
+        # Heights of target at the same traces
+        inside = ((points[:, 0] >= target.i_min) & (points[:, 0] <= target.i_max) &
+                  (points[:, 1] >= target.x_min) & (points[:, 1] <= target.x_max))
+        points, ids = points[inside], ids[inside]
+        target_heights = target.matrix[points[:, 0] - target.i_min, points[:, 1] - target.x_min]
+
+        mask = target_heights != target.FILL_VALUE
+        diffs = (target_heights[mask] - points[mask, 2] + offset).astype(np.float64)
+        ids = ids[mask]
+
+        count = np.bincount(ids, minlength=n)
+        overlapping = count > 0
+        result['count'] = count
+        result['mean'][overlapping] = np.bincount(ids, weights=diffs, minlength=n)[overlapping] / count[overlapping]
+        result['abs_mean'][overlapping] = (np.bincount(ids, weights=np.abs(diffs), minlength=n)[overlapping]
+                                           / count[overlapping])
+        return result
+
+    def find_best_match(self, target, offset=0):
+        """ Index of the horizon with the smallest absolute mean difference to the `target` on their overlap.
+        Candidates are filtered by bounding boxes first. Then, depth ranges give a lower bound of the difference
+        for each candidate: candidates are compared in order of the bound, and ones that can't be better than
+        the current best match are never compared.
+
+        Returns
+        -------
+        idx : int or None
+            Index of the best match; None, if no horizon overlaps with the `target`.
+        stats : dict
+            Stats of overlap for all of the horizons, as in :meth:`.compare`.
+            Horizons that were not compared have zero `count` and `nan` as stats.
+        """
+        self._check_freshness()
+        candidates = self.query(i_range=target.bbox[0], x_range=target.bbox[1])
+
+        # Lower bound of absolute mean difference: distance from zero to the range of possible differences
+        low = target.h_min - self.h_max[candidates] + offset
+        high = target.h_max - self.h_min[candidates] + offset
+        bounds = np.where(low > 0, low, np.where(high < 0, -high, 0))
+
+        stats = self.overlap_stats(target, [], offset=offset)
+        best, best_value = None, np.inf
+        remaining = np.ones(len(candidates), dtype=bool)
+        threshold = bounds.min() if len(candidates) else np.inf
+        while True:
+            # The first batch is made of candidates with the smallest bound, the next one -- of all promising
+            batch = remaining & (bounds <= threshold) & (bounds < best_value)
+            if not batch.any():
+                break
+            remaining &= ~batch
+
+            batch_stats = self.overlap_stats(target, candidates[batch], offset=offset)
+            for key, value in batch_stats.items():
+                stats[key][candidates[batch]] = value[candidates[batch]]
+
+            values = np.abs(stats['mean'][candidates])
+            values[stats['count'][candidates] == 0] = np.inf
+            if values.min() < best_value:
+                position = np.argmin(values)
+                best, best_value = candidates[position], values[position]
+            threshold = np.inf
+        return best, stats
+
+    def deduplicate(self, scores, threshold=2.0):
+        """ Among horizons with mean depths closer than `threshold`, keep only the one with the best score.
+        Horizons are processed in order: each one either replaces the first stored horizon close to it
+        (if the score is better), is dropped, or is stored.
+
+        Returns
+        -------
+        HorizonCollection
+            Stored horizons.
+        """
+        self._check_freshness()
+        stored = []
+        for idx in range(len(self)):
+            if stored:
+                close = np.nonzero(np.abs(self.h_mean[stored] - self.h_mean[idx]) < threshold)[0]
+                if len(close) != 0:
+                    position = close[0]
+                    if scores[idx] > scores[stored[position]]:
+                        stored.pop(position)
+                        stored.append(idx)
+                    continue
+            stored.append(idx)
+        return self[stored]
+
+
 class StructuredHorizon(Horizon):
     """ Convenient alias for `Horizon` class. """
 
@@ -1732,3 +2597,78 @@ def _filtering_function(points, filtering_matrix):
         if filtering_matrix[il, xl] == 1:
             mask[i] = 0
     return points[mask == 1, :]
+
+@njit(parallel=True)
+def _gather_window(matrix, data, background, fill_value, shift, h_start, h_end, read_start):
+    """ Put values from `data` along the horizon into `background` for traces with window start in
+    [h_start, h_end) range. `data` is in (iline, xline, depth) order and starts from `read_start` depth.
+    """
+    #pylint: disable=not-an-iterable
+    window = background.shape[-1]
+    depth = data.shape[-1]
+
+    for i in prange(matrix.shape[0]):
+        for x in range(matrix.shape[1]):
+            height = matrix[i, x]
+            if height == fill_value:
+                continue
+
+            start = height + shift
+            if start < h_start or start >= h_end:
+                continue
+
+            for j in range(window):
+                h = start + j - read_start
+                if 0 <= h < depth:
+                    background[i, x, j] = data[i, x, h]
+
+
+@njit
+def _format_points(values, precision, buffer):
+    """ Write rows of `values` as space-separated numbers with a newline after each row into `buffer`.
+    Each value is rounded to `precision` digits after the decimal point; trailing zeros are omitted.
+    Returns number of bytes written.
+    """
+    scale = 10 ** precision
+    digits = np.empty(24, dtype=np.uint8)
+    pos = 0
+
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            value = int(round(values[i, j] * scale))
+            if value < 0:
+                buffer[pos] = 45 # '-'
+                pos += 1
+                value = -value
+
+            integer, fraction = value // scale, value % scale
+
+            # Integer part: digits are collected in reverse order
+            n = 0
+            while True:
+                digits[n] = 48 + integer % 10
+                integer //= 10
+                n += 1
+                if integer == 0:
+                    break
+            for k in range(n - 1, -1, -1):
+                buffer[pos] = digits[k]
+                pos += 1
+
+            # Fractional part without trailing zeros
+            if fraction > 0:
+                n = precision
+                while fraction % 10 == 0:
+                    fraction //= 10
+                    n -= 1
+
+                buffer[pos] = 46 # '.'
+                pos += 1
+                for k in range(n - 1, -1, -1):
+                    buffer[pos + k] = 48 + fraction % 10
+                    fraction //= 10
+                pos += n
+
+            buffer[pos] = 32 if j < values.shape[1] - 1 else 10 # ' ' or '\n'
+            pos += 1
+    return pos
@@ -14,7 +14,7 @@ from scipy.stats import mode
 
 from ..batchflow.models.metrics import Metrics
 
-from .horizon import Horizon
+from .horizon import Horizon, HorizonCollection
 from .utils import mode, compute_running_mean
 from .plotters import plot_image
 
@@ -90,8 +90,7 @@ class BaseSeismicMetric(Metrics):
                 agg = 'nanmean'
 
         # Get metric, then aggregate
-        metric_fn = getattr(self, metric)
-        metric_val, plot_dict = metric_fn(**kwargs)
+        metric_val, plot_dict = self._compute(metric, **kwargs)
         metric_val = self._aggregate(metric_val, agg)
 
         # Get plot parameters
@@ -113,6 +112,10 @@ class BaseSeismicMetric(Metrics):
                 pass
         return metric_val
 
+    def _compute(self, metric, **kwargs):
+        """ Compute metric-map along with parameters of its plot. """
+        return getattr(self, metric)(**kwargs)
+
     def _aggregate(self, metric, agg=None):
         if agg is not None:
             if callable(agg):
@@ -570,8 +573,13 @@ class HorizonMetrics(BaseSeismicMetric):
         Horizon(s) to evaluate.
         Can be either one horizon, then this horizon is evaluated on its own,
         or sequence of two horizons, then they are compared against each other,
-        or nested sequence of horizon and list of horizons, then the first horizon is compared against the
-        best match from the list.
+        or nested sequence of horizon and list of horizons (or :class:`.HorizonCollection`), then the first horizon
+        is compared against the best match from the list.
+    data : ndarray, optional
+        Precomputed values along the first horizon, for example, by :meth:`.Horizon.get_cube_values_many`.
+        Must either cover the whole cube spatially or the horizon bounding box only (`on_full=False`);
+        in the latter case, it is put into the array of the whole cube at the first time of evaluation.
+        Must correspond to the other parameters. Used only if `orientation` is None.
     other parameters
         Passed direcly to :meth:`.Horizon.get_cube_values` or :meth:`.Horizon.get_cube_values_line`.
     """
@@ -586,7 +594,8 @@ class HorizonMetrics(BaseSeismicMetric):
         'hilbert', 'instantaneous_phase',
     ]
 
-    def __init__(self, horizons, orientation=None, window=23, offset=0, scale=False, chunk_size=256, line=1):
+    def __init__(self, horizons, orientation=None, window=23, offset=0, scale=False, chunk_size=256, line=1,
+                 data=None):
         super().__init__()
         horizons = list(horizons) if isinstance(horizons, tuple) else horizons
         horizons = horizons if isinstance(horizons, list) else [horizons]
@@ -602,30 +611,44 @@ class HorizonMetrics(BaseSeismicMetric):
         self.cube_name = self.horizon.cube_name
 
         if orientation is None: # metrics are computed on full cube (spatially)
-            self._data = None # evaluated later
+            # Evaluated later, if not provided
+            if data is not None and data.shape[:2] != tuple(self.horizon.cube_shape[:2]):
+                self._data, self._data_bbox = None, data
+            else:
+                self._data, self._data_bbox = data, None
             self._probs = None
-            self.bad_traces = np.copy(self.horizon.geometry.zero_traces)
+            self.bad_traces = np.copy(self.horizon.geometry.get_zero_traces())
             self.bad_traces[self.horizon.full_matrix == Horizon.FILL_VALUE] = 1
             self.spatial = True
 
         else: # metrics are computed on a specific slide
             self._data, self.bad_traces = self.horizon.get_cube_values_line(orientation=orientation, line=line,
                                                                             window=window, offset=offset, scale=scale)
+            self._data_bbox = None
             self._probs = None
             self.spatial = False
 
+        # Version of the horizon that attributes correspond to, and already computed metrics
+        self._version = self.horizon._version
+        self._cache = {}
+
     @property
     def data(self):
         """ Create `data` attribute at the first time of evaluation. """
+        self.update()
+        if self._data is None and self._data_bbox is not None:
+            self._data, self._data_bbox = self.horizon.values_to_full(self._data_bbox), None
         if self._data is None:
             self._data = self.horizon.get_cube_values(window=self.window, offset=self.offset,
-                                                      scale=self.scale, chunk_size=self.chunk_size)
+                                                      scale=self.scale, chunk_size=self.chunk_size,
+                                                      on_full=True)
         self._data[self._data == Horizon.FILL_VALUE] = np.nan
         return self._data
 
     @property
     def probs(self):
         """ Probabilistic interpretation of `data`. """
+        self.update()
         if self._probs is None:
             # Somewhat viable?
             # mins = np.min(self.data, axis=-1, keepdims=True)
@@ -633,10 +656,130 @@ class HorizonMetrics(BaseSeismicMetric):
             # shift_scaled = (self.data - mins) / (maxs - mins)
             # self._probs = shift_scaled / np.sum(shift_scaled, axis=-1, keepdims=True) + self.EPS
 
-            hist_matrix = NumbaNumpy.histo_reduce(self.data, self.horizon.geometry.bins)
-            self._probs = hist_matrix / np.sum(hist_matrix, axis=-1, keepdims=True) + self.EPS
+            self._probs = self._make_probs(self.data)
         return self._probs
 
+    def _make_probs(self, data):
+        hist_matrix = NumbaNumpy.histo_reduce(data, self.horizon.geometry.bins)
+        return hist_matrix / np.sum(hist_matrix, axis=-1, keepdims=True) + self.EPS
+
+
+    def update(self):
+        """ Synchronize with changes of the horizon, made after the last evaluation.
+        Only the changed region of `data`, `probs` and `bad_traces` is re-computed, and already computed metrics
+        are re-computed in the same region (enlarged by the kernel size) on the next evaluation.
+        If changes are unknown (see :meth:`.Horizon.dirty_region`), then everything is re-computed.
+        Metrics, computed on a line, are not updated.
+        """
+        #pylint: disable=protected-access
+        horizon = self.horizon
+        if not self.spatial or horizon._version == self._version:
+            return
+        region = horizon.dirty_region(since=self._version)
+        self._version = horizon._version
+
+        if region is None or (region[:, 0] <= 0).all() and (region[:, 1] + 1 >= self.bad_traces.shape).all():
+            self._data, self._data_bbox, self._probs, self._cache = None, None, None, {}
+            self.bad_traces = np.copy(horizon.geometry.get_zero_traces())
+            self.bad_traces[horizon.full_matrix == Horizon.FILL_VALUE] = 1
+            return
+        if (region[:, 0] > region[:, 1]).any():
+            return
+        # Precomputed data corresponds to the previous bounding box of the horizon
+        self._data_bbox = None
+
+        (i_start, i_stop), (x_start, x_stop) = region[0] + (0, 1), region[1] + (0, 1)
+        slices = (slice(i_start, i_stop), slice(x_start, x_stop))
+        matrix = self._matrix_region(i_start, i_stop, x_start, x_stop)
+
+        self.bad_traces[slices] = horizon.geometry.get_zero_traces()[slices]
+        self.bad_traces[slices][matrix == Horizon.FILL_VALUE] = 1
+
+        if self._data is not None:
+            if (matrix != Horizon.FILL_VALUE).any():
+                values = Horizon(matrix, horizon.geometry, i_min=i_start, x_min=x_start)\
+                         .get_cube_values(window=self.window, offset=self.offset, scale=self.scale,
+                                          chunk_size=self.chunk_size)
+            else:
+                values = np.zeros((*matrix.shape, self.window), dtype=np.float32)
+                values[horizon.geometry.get_zero_traces()[slices] == 1] = np.nan
+            self._data[slices] = values
+        if self._probs is not None:
+            self._probs[slices] = self._make_probs(self.data[slices])
+
+        for entry in self._cache.values():
+            entry['region'][:, 0] = np.minimum(entry['region'][:, 0], region[:, 0])
+            entry['region'][:, 1] = np.maximum(entry['region'][:, 1], region[:, 1])
+
+    def _matrix_region(self, i_start, i_stop, x_start, x_stop):
+        """ Depth map of the horizon in a region of the cube, filled with `FILL_VALUE` outside of the horizon. """
+        horizon = self.horizon
+        matrix = np.full((i_stop - i_start, x_stop - x_start), Horizon.FILL_VALUE, dtype=np.int32)
+
+        i_min, i_max = max(i_start, horizon.i_min), min(i_stop, horizon.i_max + 1)
+        x_min, x_max = max(x_start, horizon.x_min), min(x_stop, horizon.x_max + 1)
+        if i_min < i_max and x_min < x_max:
+            matrix[i_min - i_start:i_max - i_start,
+                   x_min - x_start:x_max - x_start] = horizon.matrix_window(i_min, i_max, x_min, x_max)
+        return matrix
+
+    def _compute(self, metric, **kwargs):
+        """ Compute metric-map along with parameters of its plot, re-using previous results, if possible.
+        After the horizon changes, local metrics are re-computed only in the changed region enlarged by
+        the kernel size; other cached metrics are re-computed on the whole (updated) `data`.
+        """
+        self.update()
+        # Other methods are not cached: they can return non-array results or have side effects;
+        # support metrics draw new random supports on each evaluation
+        if metric not in self.AVAILABLE_METRICS or metric.startswith('support'):
+            return getattr(self, metric)(**kwargs)
+
+        key = (metric, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError: # for example, array of supports
+            key = None
+        entry = self._cache.get(key) if key is not None else None
+
+        if entry is None:
+            metric_val, plot_dict = getattr(self, metric)(**kwargs)
+        elif (entry['region'][:, 0] > entry['region'][:, 1]).any():
+            metric_val, plot_dict = entry['metric_val'], entry['plot_dict']
+        elif metric.startswith('local') and self.spatial:
+            metric_val, plot_dict = self._compute_local_region(metric, entry, **kwargs)
+        else:
+            metric_val, plot_dict = getattr(self, metric)(**kwargs)
+
+        if key is not None:
+            self._cache[key] = {'metric_val': metric_val, 'plot_dict': plot_dict,
+                                'region': Horizon.EMPTY_BBOX.copy()}
+        return np.copy(metric_val), dict(plot_dict)
+
+    def _compute_local_region(self, metric, entry, **kwargs):
+        """ Re-compute local metric in the changed region, stored in cache `entry`. """
+        #pylint: disable=protected-access
+        halo = kwargs.get('kernel_size', self.LOCAL_DEFAULTS['kernel_size'])
+        shape = self.bad_traces.shape
+        (i_min, i_max), (x_min, x_max) = entry['region']
+
+        # Metric changes within `halo` of the region, and its computation requires another `halo` of data
+        out_i = max(i_min - halo, 0), min(i_max + halo + 1, shape[0])
+        out_x = max(x_min - halo, 0), min(x_max + halo + 1, shape[1])
+        in_i = max(i_min - 2 * halo, 0), min(i_max + 2 * halo + 1, shape[0])
+        in_x = max(x_min - 2 * halo, 0), min(x_max + 2 * halo + 1, shape[1])
+        slices = (slice(*in_i), slice(*in_x))
+
+        view = copy(self)
+        view._data = self.data[slices]
+        view._probs = self._probs[slices] if self._probs is not None else None
+        view.bad_traces = self.bad_traces[slices]
+        crop, plot_dict = getattr(view, metric)(**kwargs)
+
+        metric_val = entry['metric_val']
+        metric_val[out_i[0]:out_i[1], out_x[0]:out_x[1]] = crop[out_i[0] - in_i[0]:out_i[1] - in_i[0],
+                                                                out_x[0] - in_x[0]:out_x[1] - in_x[0]]
+        return metric_val, plot_dict
+
     def instantaneous_phase(self, **kwargs):
         """ Compute instantaneous phase via Hilbert transform. """
         #pylint: disable=unexpected-keyword-arg
@@ -666,18 +809,25 @@ class HorizonMetrics(BaseSeismicMetric):
 
 
     def find_best_match(self, offset=0, **kwargs):
-        """ Find the closest horizon to the first one in the list of passed at initialization. """
+        """ Find the closest horizon to the first one in the list of passed at initialization.
+        Candidates are compared in a vectorized way by :meth:`.HorizonCollection.find_best_match`;
+        full stats are computed for the best match only.
+        """
         _ = kwargs
         if isinstance(self.horizons[1], Horizon):
             self.horizons[1] = [self.horizons[1]]
-
-        lst = []
-        for hor in self.horizons[1]:
-            if hor.geometry.name == self.horizon.geometry.name:
-                overlap_info = Horizon.check_proximity(self.horizon, hor, offset=offset)
-                lst.append((hor, overlap_info))
-        lst.sort(key=lambda x: abs(x[1].get('mean', 999999)))
-        other, overlap_info = lst[0]
+        if not isinstance(self.horizons[1], HorizonCollection):
+            self.horizons[1] = HorizonCollection(self.horizons[1])
+
+        # Only horizons from the same cube can be matched
+        same_cube = np.array([hor.geometry.name == self.horizon.geometry.name for hor in self.horizons[1]],
+                             dtype=bool)
+        if not same_cube.all():
+            self.horizons[1] = self.horizons[1][same_cube]
+
+        idx, _ = self.horizons[1].find_best_match(self.horizon, offset=offset)
+        other = self.horizons[1][idx if idx is not None else 0]
+        overlap_info = Horizon.check_proximity(self.horizon, other, offset=offset)
         return (other, overlap_info), {} # actual return + fake plot dict
 
 
@@ -0,0 +1,187 @@
+""" Samplers of crop locations, that combine labels of multiple cubes. """
+import numpy as np
+from numba import njit
+
+from ..batchflow import Sampler
+
+
+
+class AliasSampler(Sampler):
+    """ Sampler of points near labels of multiple cubes at once.
+
+    Labels are split into bins of fixed size, and only non-empty (cube, bin) pairs are stored in one flat table.
+    Each draw takes constant time regardless of the number of entries (Vose's alias method),
+    and a batch of points is generated with a handful of vectorized operations.
+    Inside of the chosen bin, one of the label points is taken uniformly.
+
+    Generated points are arrays of (N, 4) shape with `object` dtype: name of the cube and location of the point
+    inside it. By default, locations are integer cube coordinates, which can be directly used by
+    :meth:`.SeismicCropBatch.crop`. If `unit` is True, then locations are in the unit cube, like ones
+    from other samplers in :class:`.SeismicCubeset`.
+
+    If `crop_shape` is provided, then generated locations are starts of crops of that shape: the label point is
+    shifted by a random offset inside the crop, and the crop is moved inside the cube, if needed.
+    That way, every crop contains the sampled label point, which can be at any position inside of it.
+    Such points must be used with the default `loc` of :meth:`.SeismicCropBatch.crop` and without `side_view`.
+
+    Parameters
+    ----------
+    names : sequence of str
+        Names of cubes.
+    shapes : sequence of sequences of ints
+        Shapes of cubes.
+    cube_ids : ndarray of ints
+        Index of the cube for each entry.
+    weights : ndarray
+        Non-negative weight of each entry.
+    points : ndarray of ints
+        Label points of all the entries, of (n_points, 3) shape: points of each entry are stored contiguously.
+    starts : ndarray of ints
+        Position of the first point of each entry in `points`, with total number of points at the end.
+    crop_shape : sequence of ints, optional
+        Shape of crops to generate starts of.
+    unit : bool
+        Whether to generate points in the unit cube instead of cube coordinates.
+    seed : int, optional
+        Seed for the random number generator.
+    """
+    def __init__(self, names, shapes, cube_ids, weights, points, starts, crop_shape=None, unit=False, seed=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.names = np.array(names, dtype=object)
+        self.shapes = np.array(shapes, dtype=np.int64)
+        self.cube_ids = np.asarray(cube_ids, dtype=np.int64)
+        self.points = np.asarray(points)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.crop_shape = np.asarray(crop_shape, dtype=np.int64) if crop_shape is not None else None
+        self.unit = unit
+        self.rng = np.random.default_rng(seed)
+
+        if self.crop_shape is not None and (self.crop_shape > self.shapes[self.cube_ids]).any():
+            raise ValueError(f'Crop of {tuple(self.crop_shape)} shape does not fit into some of the cubes.')
+
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) == 0 or weights.sum() <= 0:
+            raise ValueError('At least one entry with positive weight is required!')
+        self.prob, self.alias = _make_alias_table(weights / weights.sum())
+
+    @classmethod
+    def from_labels(cls, labels, geometries, p=None, bin_size=(5, 20, 20), quality_grid=None, crop_shape=None,
+                    **kwargs):
+        """ Create sampler from labels of each cube.
+        Labels of the same cube are equally likely to be chosen; cubes are chosen with probabilities `p`.
+
+        Parameters
+        ----------
+        labels : dict
+            Mapping from cube names to lists of labels with `points` attribute.
+        geometries : dict
+            Mapping from cube names to geometries.
+        p : sequence of numbers, optional
+            Weights of cubes. By default, cubes are equally likely to be chosen.
+        bin_size : sequence of ints
+            Size of bins along each axis.
+        quality_grid : ndarray or bool, optional
+            If provided, then only points on the grid (ones) are used. If True, then grid is taken from geometries.
+        crop_shape : sequence of ints, optional
+            If provided, then starts of crops of this shape, that contain label points, are generated.
+        kwargs : dict
+            Other parameters are passed directly to the sampler.
+        """
+        names = list(labels.keys())
+        p = np.ones(len(names)) if p is None else np.asarray(p, dtype=np.float64)
+        bin_size = np.asarray(bin_size, dtype=np.int64)
+
+        shapes, cube_ids, points, weights = [], [], [], []
+        for idx, name in enumerate(names):
+            geometry = geometries[name]
+            shapes.append(geometry.cube_shape)
+            grid = geometry.quality_grid if quality_grid is True else quality_grid
+
+            cube_labels = [label for label in labels[name] if len(label.points) > 0]
+            for label in cube_labels:
+                label_points = label.points[:, :3]
+                if isinstance(grid, np.ndarray):
+                    label_points = label_points[grid[label_points[:, 0], label_points[:, 1]] == 1]
+                if len(label_points) == 0:
+                    continue
+
+                # Weight of each bin is proportional to the number of label points in it
+                cube_ids.append(np.full(len(label_points), idx))
+                points.append(label_points.astype(np.int32))
+                weights.append(np.full(len(label_points), p[idx] / len(cube_labels) / len(label_points)))
+
+        # Same bins of different labels are joined into one entry; points are grouped by entries
+        cube_ids, points, weights = np.concatenate(cube_ids), np.concatenate(points), np.concatenate(weights)
+        keys, inverse = np.unique(np.column_stack([cube_ids, points // bin_size]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        weights = np.bincount(inverse, weights=weights)
+        starts = np.concatenate([[0], np.cumsum(np.bincount(inverse))])
+        points = points[np.argsort(inverse, kind='stable')]
+        return cls(names, shapes, keys[:, 0], weights, points, starts, crop_shape=crop_shape, **kwargs)
+
+    def sample(self, size):
+        """ Generate `size` points. """
+        size = int(size)
+        columns = self.rng.integers(0, len(self.prob), size=size)
+        entries = np.where(self.rng.random(size) < self.prob[columns], columns, self.alias[columns])
+
+        cube_ids = self.cube_ids[entries]
+        shapes = self.shapes[cube_ids]
+        counts = self.starts[entries + 1] - self.starts[entries]
+        positions = self.points[self.starts[entries] + (self.rng.random(size) * counts).astype(np.int64)]
+        positions = np.minimum(positions.astype(np.int64), shapes - 1)
+
+        if self.crop_shape is not None:
+            # Label point is at a random position inside the crop; crop is moved inside the cube
+            positions = positions - self.rng.integers(0, self.crop_shape, size=(size, 3))
+            positions = np.clip(positions, 0, shapes - self.crop_shape)
+            # Unit locations of crop starts are scaled by the free space, as in `SeismicCropBatch.crop`
+            shapes = np.maximum(shapes - self.crop_shape, 1)
+
+        points = np.empty((size, 4), dtype=object)
+        points[:, 0] = self.names[cube_ids]
+        points[:, 1:] = positions / shapes if self.unit else positions
+        return points
+
+    def __len__(self):
+        return len(self.prob)
+
+
+@njit
+def _make_alias_table(probabilities):
+    """ Vose's alias method: split probabilities into equally likely columns with at most two outcomes each. """
+    n = len(probabilities)
+    prob = probabilities * n
+    alias = np.arange(n)
+
+    small, large = np.empty(n, dtype=np.int64), np.empty(n, dtype=np.int64)
+    n_small, n_large = 0, 0
+    for i in range(n):
+        if prob[i] < 1.0:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        n_large -= 1
+        less, more = small[n_small], large[n_large]
+
+        alias[less] = more
+        prob[more] = prob[more] + prob[less] - 1.0
+        if prob[more] < 1.0:
+            small[n_small] = more
+            n_small += 1
+        else:
+            large[n_large] = more
+            n_large += 1
+
+    # Leftovers are due to rounding errors only
+    for i in range(n_small):
+        prob[small[i]] = 1.0
+    for i in range(n_large):
+        prob[large[i]] = 1.0
+    return prob, alias
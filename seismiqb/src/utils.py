@@ -1,7 +1,9 @@
 """ Utility functions. """
+#pylint: disable=too-many-lines
+import os
 from math import isnan
 from collections import OrderedDict
-from threading import RLock
+from threading import RLock, local
 from functools import wraps
 from hashlib import blake2b
 
@@ -14,24 +16,104 @@ from numba import njit, prange
 
 
 
+class FilePool:
+    """ Process-wide pool of opened file handlers with limited number of simultaneously opened files.
+    When the limit is exceeded, the least recently used handler is removed from the pool: it is closed as soon
+    as nobody else holds a reference to it. On the next request, the file is transparently re-opened.
+
+    Parameters
+    ----------
+    max_open : int
+        Maximum number of files to keep opened.
+    """
+    def __init__(self, max_open=128):
+        self.max_open = max_open
+        self.handlers = OrderedDict()
+        self.lock = RLock()
+
+    def get(self, path, opener=open, **kwargs):
+        """ Get handler for `path`, opened with `opener` and `kwargs`. Open it, if needed. """
+        key = (path, opener, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            handler = self.handlers.get(key)
+            if handler is not None:
+                self.handlers.move_to_end(key)
+                return handler
+
+            handler = opener(path, **kwargs)
+            self.handlers[key] = handler
+            self._shrink()
+        return handler
+
+    def close(self, path):
+        """ Remove all the handlers of `path` from the pool. """
+        with self.lock:
+            for key in [key for key in self.handlers if key[0] == path]:
+                self.handlers.pop(key)
+
+    def set_max_open(self, max_open):
+        """ Change maximum number of opened files. Excessive handlers are removed immediately. """
+        with self.lock:
+            self.max_open = max_open
+            self._shrink()
+
+    def _shrink(self):
+        while len(self.handlers) > self.max_open:
+            self.handlers.popitem(last=False)
+
+    def __len__(self):
+        return len(self.handlers)
+
+FILE_POOL = FilePool()
+
+
 class SafeIO:
-    """ Opens the file handler with desired `open` function, closes it at destruction.
-    Can log open and close actions to the `log_file`.
+    """ Proxy to the file handler, opened with desired `open` function.
+    The actual handler is taken from the process-wide `FILE_POOL` on each access, so it can be closed by the pool
+    and re-opened later. Instances can be pickled: the handler is re-opened in the other process.
+    If `per_thread` is True, then each thread uses its own handler, so no handler state is shared between threads.
+    Such handlers are kept in thread-local storage instead of the pool: they are closed as soon as their thread
+    exits, and short-lived threads never evict handlers of other files from the pool.
     getattr, getitem and `in` operator are directed to the `handler`.
     """
-    def __init__(self, path, opener=open, log_file=None, **kwargs):
+    def __init__(self, path, opener=open, per_thread=False, **kwargs):
         self.path = path
-        self.log_file = log_file # or '/notebooks/log_safeio.txt'
-        self.handler = opener(path, **kwargs)
-
-        if self.log_file:
-            self._info(self.log_file, f'Opened {self.path}')
-
-    def _info(self, log_file, msg):
-        with open(log_file, 'a') as f:
-            f.write('\n' + msg)
+        self.opener = opener
+        self.per_thread = per_thread
+        self.kwargs = kwargs
+        self.local = local()
+
+    @property
+    def handler(self):
+        """ Opened file handler. """
+        if not self.per_thread:
+            return FILE_POOL.get(self.path, self.opener, **self.kwargs)
+
+        handler = getattr(self.local, 'handler', None)
+        if handler is None:
+            handler = self.opener(self.path, **self.kwargs)
+            self.local.handler = handler
+        return handler
+
+    def close(self):
+        """ Remove handler from the pool and drop per-thread handlers of all threads. """
+        FILE_POOL.close(self.path)
+        self.local = local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('local')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = local()
 
     def __getattr__(self, key):
+        # Own attributes are not yet set during unpickling: prevent infinite recursion
+        if key.startswith('__') or key in ['path', 'opener', 'per_thread', 'kwargs', 'local']:
+            raise AttributeError(key)
         return getattr(self.handler, key)
 
     def __getitem__(self, key):
@@ -40,14 +122,16 @@ class SafeIO:
     def __contains__(self, key):
         return key in self.handler
 
-    def __del__(self):
-        if self.log_file:
-            self._info(self.log_file, f'Tried to close {self.path}')
+    def __len__(self):
+        return len(self.handler)
+
 
-        self.handler.close()
+def open_segy(path, **kwargs):
+    """ Open SEG-Y file with `segyio` and memory-map it. """
+    segyfile = segyio.open(path, **kwargs)
+    segyfile.mmap()
+    return segyfile
 
-        if self.log_file:
-            self._info(self.log_file, f'Closed {self.path}')
 
 
 class IndexedDict(OrderedDict):
@@ -189,6 +273,37 @@ class lru_cache:
 
 
 
+def versioned_property(func):
+    """ Property, that is cached on the instance until its `_version` attribute is changed.
+    Returned arrays are made read-only, so that the cached value can't be modified by accident.
+
+    Examples
+    --------
+    Compute the mask only once for each state of an instance::
+
+    @versioned_property
+    def binary_matrix(self):
+        return self.matrix > 0
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(instance):
+        cache = instance.__dict__.setdefault('_property_cache', {})
+        version = getattr(instance, '_version', 0)
+
+        cached = cache.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        value = func(instance)
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        cache[name] = (version, value)
+        return value
+    return property(wrapper)
+
+
 #TODO: rethink
 def make_subcube(path, geometry, path_save, i_range, x_range):
     """ Make subcube from .sgy cube by removing some of its first and
@@ -248,6 +363,69 @@ def make_subcube(path, geometry, path_save, i_range, x_range):
         pass
 
 #TODO: rename, add some defaults
+def read_point_cloud(path, names, usecols, sort=True, dropna=False, cache=False):
+    """ Read whitespace-separated file with point cloud labels into an array with `usecols` columns.
+    Uses the C engine of `pandas`; sorting is skipped if the data is already sorted.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to read.
+    names : sequence of str
+        Names of all the columns in the file.
+    usecols : sequence of str
+        Names and order of columns to keep.
+    sort : bool
+        Whether to sort the rows lexicographically by `usecols`.
+    dropna : bool
+        Whether to drop rows with missing values.
+    cache : bool
+        If True, then the resulting array is stored in a hidden `.npz` sidecar next to the file,
+        keyed on the file modification time and size, and subsequent reads use it.
+    """
+    directory, name = os.path.split(path)
+    cache_path = os.path.join(directory, f'.{name}.npz')
+    stat = os.stat(path)
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    columns = np.array(usecols, dtype=str)
+
+    if cache and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cached:
+                if np.array_equal(cached['key'], key) and np.array_equal(cached['columns'], columns) \
+                   and bool(cached['sort']) == sort and bool(cached['dropna']) == dropna:
+                    return cached['points']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    df = pd.read_csv(path, sep=r'\s+', engine='c', header=None, names=names, usecols=usecols)
+    if dropna:
+        df.dropna(inplace=True)
+    points = df.loc[:, usecols].values
+
+    if sort and not _is_lexsorted(points):
+        points = points[np.lexsort(points.T[::-1])]
+
+    if cache:
+        # Write to a temporary file first, so that concurrent readers never see a partially written sidecar
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                np.savez(file, points=points, key=key, columns=columns, sort=sort, dropna=dropna)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return points
+
+def _is_lexsorted(array):
+    """ Check whether rows of 2D array are sorted lexicographically. """
+    if len(array) < 2:
+        return True
+    diffs = np.diff(array, axis=0)
+    first_nonzero = np.argmax(diffs != 0, axis=1)
+    return bool(np.all(diffs[np.arange(len(diffs)), first_nonzero] >= 0))
+
+
 def convert_point_cloud(path, path_save, names=None, order=None, transform=None):
     """ Change set of columns in file with point cloud labels.
     Usually is used to remove redundant columns.
@@ -273,10 +451,10 @@ def convert_point_cloud(path, path_save, names=None, order=None, transform=None)
     names = [names] if isinstance(names, str) else names
     order = [order] if isinstance(order, str) else order
 
-    df = pd.read_csv(path, sep='\s+', names=names, usecols=set(order))
+    df = pd.read_csv(path, sep=r'\s+', engine='c', header=None, names=names, usecols=set(order))
     df.dropna(inplace=True)
 
-    if 'iline' in order and 'xline' in order:
+    if 'iline' in order and 'xline' in order and not _is_lexsorted(df[['iline', 'xline']].values):
         df.sort_values(['iline', 'xline'], inplace=True)
 
     data = df.loc[:, order]
@@ -391,6 +569,180 @@ def gen_crop_coordinates(point, horizon_matrix, zero_traces,
                 shapes_array[top], \
                 orders_array[top])
 
+# Crop locations: along each axis, either a slice for a contiguous range or a sequence of arbitrary indices
+def _location_range(location):
+    return range(location.start or 0, location.stop, location.step or 1)
+
+def location_to_array(location):
+    """ Convert location along one axis to an array of indices. """
+    if isinstance(location, slice):
+        range_ = _location_range(location)
+        return np.arange(range_.start, range_.stop, range_.step)
+    return np.asarray(location)
+
+def location_length(location):
+    """ Number of indices in location along one axis. """
+    if isinstance(location, slice):
+        return len(_location_range(location))
+    return len(location)
+
+def location_bounds(location):
+    """ Half-open bounds (start, stop) of location along one axis. """
+    if isinstance(location, slice):
+        range_ = _location_range(location)
+        if len(range_) == 0:
+            return range_.start, range_.start
+        return min(range_[0], range_[-1]), max(range_[0], range_[-1]) + 1
+    return int(np.min(location)), int(np.max(location)) + 1
+
+def check_locations(locations, shape):
+    """ Raise IndexError, if any of slices in `locations` gets out of the array of `shape`.
+    Unlike index arrays, slices are silently truncated by indexing, so they are checked explicitly.
+    """
+    for axis, (location, length) in enumerate(zip(locations, shape)):
+        if isinstance(location, slice):
+            start, stop = location_bounds(location)
+            if stop > start and (start < 0 or stop > length):
+                raise IndexError(f'Location [{start}, {stop}) is out of bounds for axis {axis} with size {length}.')
+
+def shift_location(location, shift):
+    """ Move location along one axis by `-shift`. """
+    if isinstance(location, slice):
+        range_ = _location_range(location)
+        return slice(range_.start - shift, range_.stop - shift, range_.step)
+    return np.asarray(location) - shift
+
+def to_slice(location):
+    """ Convert location along one axis to a slice, if it is a contiguous increasing range. """
+    if isinstance(location, slice):
+        return location
+    location = np.asarray(location)
+    if len(location) > 0 and location[-1] - location[0] == len(location) - 1 and np.all(np.diff(location) == 1):
+        return slice(int(location[0]), int(location[-1]) + 1)
+    return location
+
+def make_index(locations):
+    """ Index to cut the crop at `locations` from an array.
+    If every location is a slice, then basic indexing is used and no copies are made;
+    otherwise, locations are converted to arrays for advanced indexing.
+    """
+    if all(isinstance(item, slice) for item in locations):
+        return tuple(locations)
+    return np.ix_(*[location_to_array(item) for item in locations])
+
+
+def coalesce_locations(locations_list, max_overhead=2.0):
+    """ Group crop locations into clusters, each of which can be read with one bounding hyperslab.
+    Crops are sorted along the first axis and greedily added to the current cluster while the volume of
+    the cluster bounding box does not exceed `max_overhead` times the total volume of crops in it.
+
+    Parameters
+    ----------
+    locations_list : sequence
+        Each element is a sequence of locations along each axis: either slices or arrays of indices.
+    max_overhead : number
+        Maximum allowed ratio of the bounding box volume to the total volume of crops in it.
+
+    Returns
+    -------
+    list of tuples
+        Each tuple contains indices of crops in the cluster and its bounds: (start, stop) pair for each axis.
+    """
+    bounds = np.array([[location_bounds(item) for item in locations]
+                       for locations in locations_list])
+    volumes = np.prod(bounds[:, :, 1] - bounds[:, :, 0], axis=1)
+    order = np.argsort(bounds[:, 0, 0], kind='stable')
+
+    clusters = []
+    cluster, cluster_bounds, cluster_volume = [], None, 0
+    for i in order:
+        if cluster:
+            union = np.stack([np.minimum(cluster_bounds[:, 0], bounds[i, :, 0]),
+                              np.maximum(cluster_bounds[:, 1], bounds[i, :, 1])], axis=1)
+            if np.prod(union[:, 1] - union[:, 0]) <= max_overhead * (cluster_volume + volumes[i]):
+                cluster.append(i)
+                cluster_bounds, cluster_volume = union, cluster_volume + volumes[i]
+                continue
+            clusters.append((cluster, cluster_bounds))
+        cluster, cluster_bounds, cluster_volume = [i], bounds[i].copy(), volumes[i]
+
+    if cluster:
+        clusters.append((cluster, cluster_bounds))
+    return clusters
+
+
+
+class LabelIndex:
+    """ Spatial index of labels of a cube: for each square tile of (iline, xline) plane,
+    labels present in it along with their depth range inside the tile.
+    Labels without `matrix` storage (for example, not horizons) are always considered to be candidates.
+
+    Parameters
+    ----------
+    labels : sequence
+        Labels to index. The index is valid only for exactly the same list of labels in the same state.
+    tile_size : int
+        Size of tiles along both spatial axes.
+    """
+    def __init__(self, labels, tile_size=128):
+        self.tile_size = tile_size
+        self.labels = list(labels)
+        self.versions = [getattr(label, '_version', None) for label in labels]
+
+        self.always = []
+        entries = {}
+        for idx, label in enumerate(labels):
+            if getattr(label, 'matrix', None) is None or not hasattr(label, 'FILL_VALUE'):
+                self.always.append(idx)
+                continue
+
+            for key, h_min, h_max in self._tile_ranges(label, tile_size):
+                entries.setdefault(key, []).append((idx, h_min, h_max))
+
+        self.entries = {key: np.array(value, dtype=np.int64) for key, value in entries.items()}
+
+    @staticmethod
+    def _tile_ranges(label, tile_size):
+        """ Depth ranges of `label` in each of the tiles it is present in. """
+        matrix = label.matrix
+        i_offset, x_offset = label.i_min % tile_size, label.x_min % tile_size
+        n_i = (i_offset + matrix.shape[0] - 1) // tile_size + 1
+        n_x = (x_offset + matrix.shape[1] - 1) // tile_size + 1
+
+        # Align matrix to the grid of tiles and compute stats in each tile at once
+        padded = np.full((n_i * tile_size, n_x * tile_size), label.FILL_VALUE, dtype=matrix.dtype)
+        padded[i_offset:i_offset + matrix.shape[0], x_offset:x_offset + matrix.shape[1]] = matrix
+        padded = padded.reshape(n_i, tile_size, n_x, tile_size)
+        present = padded != label.FILL_VALUE
+
+        h_max = np.where(present, padded, np.iinfo(np.int64).min).max(axis=(1, 3))
+        h_min = np.where(present, padded, np.iinfo(np.int64).max).min(axis=(1, 3))
+        i_start, x_start = label.i_min // tile_size, label.x_min // tile_size
+        for ti, tx in zip(*np.nonzero(present.any(axis=(1, 3)))):
+            yield (i_start + ti, x_start + tx), h_min[ti, tx], h_max[ti, tx]
+
+    def is_valid(self, labels):
+        """ Check whether the index corresponds to `labels`: same instances in the same order and state. """
+        if len(labels) != len(self.labels):
+            return False
+        return all(label is indexed and getattr(label, '_version', None) == version
+                   for label, indexed, version in zip(labels, self.labels, self.versions))
+
+    def query(self, locations):
+        """ Indices of labels that can cross the crop at `locations`, in increasing order. """
+        (i_start, i_stop), (x_start, x_stop), (h_start, h_stop) = [location_bounds(item) for item in locations]
+        if i_stop <= i_start or x_stop <= x_start:
+            return np.array(self.always, dtype=np.int64)
+
+        candidates = [np.array(self.always, dtype=np.int64)]
+        for ti in range(i_start // self.tile_size, (i_stop - 1) // self.tile_size + 1):
+            for tx in range(x_start // self.tile_size, (x_stop - 1) // self.tile_size + 1):
+                entry = self.entries.get((ti, tx))
+                if entry is not None:
+                    mask = (entry[:, 2] >= h_start) & (entry[:, 1] < h_stop)
+                    candidates.append(entry[mask, 0])
+        return np.unique(np.concatenate(candidates))
+
 
 @njit
 def groupby_mean(array):
@@ -491,6 +843,183 @@ def groupby_max(array):
 
 
 
+def extract_components(mask, threshold=0.5, minsize=0):
+    """ Label 26-connected components of thresholded `mask` and aggregate their depths for each trace.
+    Crops, thin along some of the axes (for example, `1xHxW`), are processed with reduced neighbourhood.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Array of (iline, xline, depth) shape.
+    threshold : number
+        Values of `mask` that are greater or equal to it are considered to be foreground.
+    minsize : int
+        Components with less points are dropped.
+
+    Returns
+    -------
+    labels : ndarray
+        Array of the same shape as `mask` with component ids; zero means background.
+    records : tuple of ndarrays
+        Component id, iline, xline, depth sum, number of points, depth minimum and maximum for each pair of
+        component and trace. Records are ordered by (iline, xline).
+    """
+    offsets = np.array([(di, dx, dh) for di in (-1, 0, 1) for dx in (-1, 0, 1) for dh in (-1, 0, 1)
+                        if (di, dx, dh) < (0, 0, 0)], dtype=np.int64)
+    for axis, length in enumerate(mask.shape):
+        if length == 1:
+            offsets = offsets[offsets[:, axis] == 0]
+    return _extract_components(mask, threshold, minsize, offsets)
+
+def extract_surface(mask, threshold=0.5):
+    """ Pick depth of the maximum value along the last axis of `mask` for each trace.
+    Works with arrays with any number of leading axes, for example, with stacked crops of a batch.
+
+    Returns
+    -------
+    depths : ndarray
+        Array of `mask` shape without the last axis: depths of maximums.
+    confident : ndarray
+        Boolean array of the same shape: whether maximum is greater or equal to `threshold`.
+    """
+    depths = np.argmax(mask, axis=-1)
+    maximums = np.take_along_axis(mask, depths[..., np.newaxis], axis=-1)[..., 0]
+    return depths, maximums >= threshold
+
+@njit
+def _find_root(parent, item):
+    while parent[item] != item:
+        parent[item] = parent[parent[item]]
+        item = parent[item]
+    return item
+
+@njit
+def union_components(n_labels, pairs):
+    """ Join components with ids from 1 to `n_labels`, connected by `pairs`, with union-find.
+    Returns mapping from the original ids to the compact ids of the groups, numbered in order of their smallest id.
+    Zero id is kept as background.
+    """
+    parent = np.arange(n_labels + 1)
+    for k in range(len(pairs)):
+        a, b = _find_root(parent, pairs[k, 0]), _find_root(parent, pairs[k, 1])
+        if a < b:
+            parent[b] = a
+        elif b < a:
+            parent[a] = b
+
+    roots = np.zeros(n_labels + 1, dtype=np.int64)
+    n_groups = 0
+    for k in range(1, n_labels + 1):
+        root = _find_root(parent, k)
+        if roots[root] == 0:
+            n_groups += 1
+            roots[root] = n_groups
+        roots[k] = roots[root]
+    return roots
+
+@njit
+def _extract_components(mask, threshold, minsize, offsets):
+    #pylint: disable=too-many-statements, too-many-branches, too-many-nested-blocks
+    n_i, n_x, n_h = mask.shape
+    labels = np.zeros(mask.shape, dtype=np.int32)
+
+    n_points = 0
+    for i in range(n_i):
+        for x in range(n_x):
+            for h in range(n_h):
+                if mask[i, x, h] >= threshold:
+                    n_points += 1
+    parent = np.arange(n_points + 1)
+
+    # First pass: provisional labels, connected with union-find
+    n_labels = 0
+    for i in range(n_i):
+        for x in range(n_x):
+            for h in range(n_h):
+                if mask[i, x, h] < threshold:
+                    continue
+
+                current = 0
+                for k in range(len(offsets)):
+                    ni, nx, nh = i + offsets[k, 0], x + offsets[k, 1], h + offsets[k, 2]
+                    if ni < 0 or nx < 0 or nh < 0 or nx >= n_x or nh >= n_h:
+                        continue
+                    neighbour = labels[ni, nx, nh]
+                    if neighbour == 0:
+                        continue
+
+                    root = _find_root(parent, neighbour)
+                    if current == 0:
+                        current = root
+                    elif root != current:
+                        if root < current:
+                            parent[current] = root
+                            current = root
+                        else:
+                            parent[root] = current
+
+                if current == 0:
+                    n_labels += 1
+                    current = n_labels
+                labels[i, x, h] = current
+
+    # Compact ids of roots: components are numbered in order of their first point
+    final = np.zeros(n_labels + 1, dtype=np.int32)
+    n_components = 0
+    for k in range(1, n_labels + 1):
+        root = _find_root(parent, k)
+        if final[root] == 0:
+            n_components += 1
+            final[root] = n_components
+        final[k] = final[root]
+
+    # Second pass: final ids and per-trace aggregation of depths
+    sizes = np.zeros(n_components + 1, dtype=np.int64)
+    rec_label = np.empty(n_points, dtype=np.int32)
+    rec_i, rec_x = np.empty(n_points, dtype=np.int32), np.empty(n_points, dtype=np.int32)
+    rec_sum, rec_count = np.empty(n_points, dtype=np.int64), np.empty(n_points, dtype=np.int64)
+    rec_min, rec_max = np.empty(n_points, dtype=np.int32), np.empty(n_points, dtype=np.int32)
+    n_records = 0
+
+    for i in range(n_i):
+        for x in range(n_x):
+            start = n_records
+            for h in range(n_h):
+                if labels[i, x, h] == 0:
+                    continue
+                component = final[labels[i, x, h]]
+                labels[i, x, h] = component
+                sizes[component] += 1
+
+                # Few components cross the same trace, so linear search is fine
+                position = start
+                while position < n_records and rec_label[position] != component:
+                    position += 1
+
+                if position == n_records:
+                    rec_label[position], rec_i[position], rec_x[position] = component, i, x
+                    rec_sum[position], rec_count[position] = h, 1
+                    rec_min[position], rec_max[position] = h, h
+                    n_records += 1
+                else:
+                    rec_sum[position] += h
+                    rec_count[position] += 1
+                    rec_max[position] = h
+
+    # Drop small components
+    position = 0
+    for k in range(n_records):
+        if sizes[rec_label[k]] >= minsize:
+            rec_label[position], rec_i[position], rec_x[position] = rec_label[k], rec_i[k], rec_x[k]
+            rec_sum[position], rec_count[position] = rec_sum[k], rec_count[k]
+            rec_min[position], rec_max[position] = rec_min[k], rec_max[k]
+            position += 1
+
+    records = (rec_label[:position], rec_i[:position], rec_x[:position],
+               rec_sum[:position], rec_count[:position], rec_min[:position], rec_max[:position])
+    return labels, records
+
+
 @njit
 def round_to_array(values, ticks):
     """ Jit-accelerated function to round values from one array to the
@@ -0,0 +1,66 @@
+""" Tests for the adjacency check of horizons: it must agree with the full-bbox statistic of the old merge. """
+# pylint: disable=import-error, redefined-outer-name
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from seismiqb.src.horizon import Horizon
+
+
+GEOMETRY = SimpleNamespace(name='cube', cube_shape=np.array([100, 100, 500]))
+THRESHOLDS = [0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 100.0]
+
+
+def make_horizon(i_min, x_min, shape, depth, seed, holes=0.0):
+    """ Horizon with slightly tilted, noisy surface and, optionally, missing traces. """
+    rng = np.random.default_rng(seed)
+    ilines, xlines = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    matrix = (depth + (ilines + i_min) // 4 + (xlines + x_min) // 5 + rng.integers(-1, 2, size=shape)).astype(np.int32)
+    matrix[rng.random(shape) < holes] = Horizon.FILL_VALUE
+    return Horizon(matrix, GEOMETRY, i_min=i_min, x_min=x_min)
+
+def old_mean(first, second, adjacency):
+    """ Mean difference on the adjacency zone, computed on the shared bounding box of both horizons.
+    Horizons without common depths are never adjacent, as in the check before restricting it to the band.
+    """
+    if max(first.h_min, second.h_min) > min(first.h_max, second.h_max):
+        return np.inf
+    _, _, info = first.adjacent_merge_old(second, adjacency=adjacency, check_only=True)
+    return info.get('mean', np.inf)
+
+
+@pytest.mark.parametrize('gap', [0, 1, 2, 3, 5])
+@pytest.mark.parametrize('adjacency', [1, 3])
+@pytest.mark.parametrize('shift', [0, 2, 7])
+@pytest.mark.parametrize('holes', [0.0, 0.3])
+def test_neighbours(gap, adjacency, shift, holes):
+    """ Horizons next to each other along ilines, with a `gap` of empty ilines between them. """
+    first = make_horizon(10, 10, (20, 30), 100, seed=0, holes=holes)
+    second = make_horizon(30 + gap, 15, (25, 30), 100 + shift, seed=1, holes=holes)
+
+    for first_, second_ in [(first, second), (second, first)]:
+        mean = old_mean(first_, second_, adjacency)
+        for threshold in THRESHOLDS:
+            assert first_.check_adjacent(second_, mean_threshold=threshold, adjacency=adjacency) == (mean < threshold)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_diagonal(seed):
+    """ Horizons of random shapes, touching only by their corners. """
+    rng = np.random.default_rng(seed)
+    shape_1, shape_2 = rng.integers(5, 20, size=2), rng.integers(5, 20, size=2)
+    gap = rng.integers(0, 3, size=2)
+    first = make_horizon(5, 5, tuple(shape_1), 200, seed=seed, holes=0.2)
+    second = make_horizon(5 + shape_1[0] + gap[0], 5 + shape_1[1] + gap[1], tuple(shape_2),
+                          200 + rng.integers(0, 4), seed=seed + 10, holes=0.2)
+
+    for adjacency in [1, 2, 3]:
+        mean = old_mean(first, second, adjacency)
+        for threshold in THRESHOLDS:
+            assert first.check_adjacent(second, mean_threshold=threshold, adjacency=adjacency) == (mean < threshold)
+
+def test_far_away():
+    """ Horizons too far from one another, spatially or depth-wise, are not adjacent. """
+    first = make_horizon(10, 10, (10, 10), 100, seed=0)
+    assert not first.check_adjacent(make_horizon(40, 10, (10, 10), 100, seed=1), mean_threshold=100)
+    assert not first.check_adjacent(make_horizon(20, 10, (10, 10), 300, seed=1), mean_threshold=100)
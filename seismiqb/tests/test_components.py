@@ -0,0 +1,104 @@
+""" Tests for labeling of connected components of masks: in-memory and chunked. """
+# pylint: disable=import-error, redefined-outer-name, protected-access
+import numpy as np
+import pytest
+from scipy.ndimage import label
+
+from seismiqb.src.utils import extract_components, union_components
+from seismiqb.src.horizon import Horizon
+
+
+SHAPES = [(8, 9, 10), (1, 16, 12), (10, 1, 7), (6, 7, 1), (20, 15, 12)]
+
+
+def make_mask(shape, density, seed):
+    """ Random binary mask with approximately `density` of points being ones. """
+    rng = np.random.default_rng(seed)
+    return (rng.random(shape) < density).astype(np.float32)
+
+
+def components_from_labels(labels, minsize=0):
+    """ Set of components, each being a frozenset of per-trace records: (iline, xline, sum, count, min, max). """
+    result = set()
+    for idx in range(1, labels.max() + 1):
+        points = np.argwhere(labels == idx)
+        if len(points) == 0 or len(points) < minsize:
+            continue
+        records = []
+        for i, x in np.unique(points[:, :2], axis=0):
+            depths = points[(points[:, 0] == i) & (points[:, 1] == x), 2]
+            records.append((i, x, depths.sum(), len(depths), depths.min(), depths.max()))
+        result.add(frozenset(records))
+    return result
+
+def components_from_records(records):
+    """ The same set of components, but from the records returned by labeling functions. """
+    labels, ilines, xlines, sums, counts, mins, maxs = [np.asarray(item) for item in records]
+    result = set()
+    for idx in np.unique(labels):
+        mask = labels == idx
+        result.add(frozenset(zip(ilines[mask], xlines[mask], sums[mask], counts[mask], mins[mask], maxs[mask])))
+    return result
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('density', [0.1, 0.3, 0.6])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_labels_match_scipy(shape, density, seed):
+    """ Partition of the mask into 26-connected components is the same, as in `scipy.ndimage.label`. """
+    mask = make_mask(shape, density, seed)
+    labels, _ = extract_components(mask, threshold=0.5)
+    expected, n_expected = label(mask >= 0.5, structure=np.ones((3, 3, 3)))
+
+    assert ((labels > 0) == (expected > 0)).all()
+    foreground = labels > 0
+    pairs = np.unique(np.stack([labels[foreground], expected[foreground]], axis=1), axis=0)
+    assert len(pairs) == n_expected == len(np.unique(labels[foreground]))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('minsize', [0, 3, 10])
+def test_records_match_scipy(shape, minsize):
+    """ Per-trace aggregated depths of components with at least `minsize` points. """
+    mask = make_mask(shape, 0.3, seed=42)
+    _, records = extract_components(mask, threshold=0.5, minsize=minsize)
+    expected, _ = label(mask >= 0.5, structure=np.ones((3, 3, 3)))
+
+    assert components_from_records(records) == components_from_labels(expected, minsize=minsize)
+
+
+def test_empty_mask():
+    """ No components in an empty mask. """
+    labels, records = extract_components(np.zeros((4, 5, 6)), threshold=0.5)
+    assert (labels == 0).all()
+    assert all(len(item) == 0 for item in records)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7])
+@pytest.mark.parametrize('minsize', [0, 5])
+def test_chunked_matches_whole(shape, chunk_size, minsize):
+    """ Components, stitched across faces of chunks, are the same, as for the whole mask at once. """
+    mask = make_mask(shape, 0.4, seed=7)
+    _, records = extract_components(mask, threshold=0.5, minsize=minsize)
+    chunked = Horizon._chunked_components(mask, threshold=0.5, minsize=minsize, chunk_size=chunk_size)
+
+    assert components_from_records(chunked) == components_from_records(records)
+
+
+def test_chunked_component_across_all_chunks():
+    """ Diagonal line crosses each face of chunks through a corner neighbour only. """
+    mask = np.zeros((10, 10, 10))
+    for k in range(10):
+        mask[k, k, k] = 1
+    chunked = Horizon._chunked_components(mask, threshold=0.5, minsize=0, chunk_size=1)
+
+    assert len(np.unique(chunked[0])) == 1
+    assert len(chunked[0]) == 10
+
+
+def test_union_components():
+    """ Groups are numbered in order of their smallest id; background stays zero. """
+    pairs = np.array([[2, 5], [5, 3], [4, 6]], dtype=np.int64)
+    roots = union_components(7, pairs)
+    assert roots.tolist() == [0, 1, 2, 2, 3, 2, 3, 4]
@@ -0,0 +1,133 @@
+""" Tests for crop locations: slices must give the same crops and masks, as index arrays. """
+# pylint: disable=import-error, redefined-outer-name, protected-access
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import h5py
+
+from seismiqb.src.geometry import SeismicGeometry
+from seismiqb.src.crop_batch import SeismicCropBatch
+from seismiqb.src.horizon import Horizon
+from seismiqb.src.utils import check_locations
+
+
+SHAPE = (20, 30, 40)
+
+
+@pytest.fixture(scope='module')
+def data():
+    """ Random cube values. """
+    return np.random.default_rng(0).random(SHAPE).astype(np.float32)
+
+@pytest.fixture(scope='module', params=['hdf5', 'npy'])
+def geometry(request, data, tmp_path_factory):
+    """ The same cube, stored in each of the structured formats. """
+    directory = tmp_path_factory.mktemp(request.param)
+    info = {'ilines': np.arange(SHAPE[0]) + 100, 'xlines': np.arange(SHAPE[1]) + 200, 'depth': SHAPE[2]}
+
+    if request.param == 'hdf5':
+        path = str(directory / 'cube.hdf5')
+        with h5py.File(path, 'w') as file_hdf5:
+            for projection, order in SeismicGeometry.PROJECTIONS.items():
+                file_hdf5[projection] = data.transpose(order)
+            for key, value in info.items():
+                file_hdf5['/info/' + key] = value
+    else:
+        path = str(directory / 'cube.npy')
+        os.makedirs(path)
+        for projection, order in SeismicGeometry.PROJECTIONS.items():
+            np.save(os.path.join(path, projection + '.npy'), np.ascontiguousarray(data.transpose(order)))
+        np.savez(os.path.join(path, 'meta.npz'), **info)
+    return SeismicGeometry(path)
+
+
+def to_arrays(locations):
+    """ The same locations, described with index arrays. """
+    return [np.arange(item.start, item.stop) for item in locations]
+
+
+LOCATIONS = [
+    [slice(0, 20), slice(0, 30), slice(0, 40)],
+    [slice(3, 9), slice(10, 11), slice(5, 37)],
+    [slice(19, 20), slice(4, 28), slice(39, 40)],
+    [slice(5, 15), slice(0, 7), slice(20, 21)],
+]
+
+@pytest.mark.parametrize('locations', LOCATIONS)
+@pytest.mark.parametrize('axis', [None, 0, 1, 2])
+def test_load_crop(geometry, data, locations, axis):
+    """ Crops, loaded with slices and arrays along any of the projections, are the same. """
+    expected = data[tuple(locations)]
+    assert np.array_equal(geometry.load_crop(locations, axis=axis), expected)
+    assert np.array_equal(geometry.load_crop(to_arrays(locations), axis=axis), expected)
+
+def test_load_crops(geometry, data):
+    """ Crops of a batch, loaded at once with coalesced reads, are the same, as loaded one by one. """
+    crops = geometry.load_crops(LOCATIONS + [to_arrays(item) for item in LOCATIONS])
+    for crop, locations in zip(crops, LOCATIONS + LOCATIONS):
+        assert np.array_equal(crop, data[tuple(locations)])
+
+@pytest.mark.parametrize('locations', [
+    [slice(15, 25), slice(0, 10), slice(0, 10)],
+    [slice(0, 10), slice(-2, 8), slice(0, 10)],
+    [slice(0, 10), slice(0, 10), slice(35, 41)],
+])
+def test_out_of_bounds(geometry, locations):
+    """ Slices are not silently truncated. """
+    with pytest.raises(IndexError):
+        check_locations(locations, SHAPE)
+    with pytest.raises(IndexError):
+        geometry.load_crop(locations)
+
+
+@pytest.fixture(scope='module')
+def batch():
+    """ Stand-in for a batch: only the shape of the cube is needed to make slices. """
+    return SimpleNamespace(get=lambda ix, component: SimpleNamespace(cube_shape=np.array(SHAPE)))
+
+@pytest.mark.parametrize('point, loc, expected', [
+    ([3, 4, 5], (0, 0, 0), [3, 4, 5]),
+    ([19, 29, 39], (0, 0, 0), [12, 20, 24]),
+    ([10, 15, 20], (0.5, 0.5, 0.5), [6, 10, 12]),
+    ([1, 2, 3], (0.5, 0.5, 0.5), [0, 0, 0]),
+    ([0.0, 0.5, 1.0], (0, 0, 0), [0, 10, 24]),
+])
+def test_make_slice(batch, point, loc, expected):
+    """ Crops are moved inside the cube; unit points are scaled by the free space. """
+    point = np.array(['cube'] + point, dtype=object)
+    slices = SeismicCropBatch._make_slice(batch, point, (8, 10, 16), loc=loc)
+    assert [(item.start, item.stop) for item in slices] == [(start, start + size)
+                                                            for start, size in zip(expected, (8, 10, 16))]
+    check_locations(slices, SHAPE)
+
+def test_make_slice_crop_too_big(batch):
+    """ Crops bigger than the cube can't be placed inside of it. """
+    with pytest.raises(ValueError):
+        SeismicCropBatch._make_slice(batch, np.array(['cube', 0, 0, 0], dtype=object), (8, 31, 16))
+
+
+@pytest.mark.parametrize('locations', LOCATIONS)
+@pytest.mark.parametrize('width', [1, 3])
+def test_add_to_mask(locations, width):
+    """ Masks, created with slices and arrays, are the same, and match the horizon points. """
+    rng = np.random.default_rng(1)
+    matrix = rng.integers(2, SHAPE[2] - 2, size=(12, 25)).astype(np.int32)
+    matrix[rng.random(matrix.shape) < 0.2] = Horizon.FILL_VALUE
+    horizon = Horizon(matrix, SimpleNamespace(name='cube', cube_shape=np.array(SHAPE)), i_min=5, x_min=3)
+
+    crop_shape = [item.stop - item.start for item in locations]
+    mask = horizon.add_to_mask(np.zeros(crop_shape, dtype=np.float32), locations=locations, width=width)
+    mask_arrays = horizon.add_to_mask(np.zeros(crop_shape, dtype=np.float32), locations=to_arrays(locations),
+                                      width=width)
+    assert np.array_equal(mask, mask_arrays)
+
+    # Each point is added as a band of `width` values; bands, that are cut by the crop, are skipped
+    (i_start, i_stop), (x_start, x_stop), (h_start, h_stop) = [(item.start, item.stop) for item in locations]
+    expected = np.zeros(crop_shape, dtype=np.float32)
+    for i, x, h in horizon.points:
+        start = h - width // 2
+        if i_start <= i < i_stop and x_start <= x < x_stop and h_start <= start and start + width <= h_stop:
+            expected[i - i_start, x - x_start, start - h_start:start - h_start + width] = 1
+    assert np.array_equal(mask, expected)
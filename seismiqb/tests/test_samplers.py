@@ -0,0 +1,121 @@
+""" Tests for the alias sampler: sampled crops must contain label points. """
+# pylint: disable=import-error, redefined-outer-name, protected-access
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from seismiqb.src.samplers import AliasSampler
+from seismiqb.src.crop_batch import SeismicCropBatch
+
+
+SHAPES = {'A': (30, 40, 200), 'B': (25, 20, 120)}
+CROP_SHAPE = (8, 12, 16)
+
+
+def make_surface(shape, seed):
+    """ Horizon-like label: one point for each trace of the left half of the cube, with smoothly varying depth. """
+    rng = np.random.default_rng(seed)
+    ilines, xlines = np.meshgrid(np.arange(shape[0]), np.arange(shape[1] // 2), indexing='ij')
+    depths = shape[2] // 2 + 10 * np.sin(ilines / 5) + rng.integers(-2, 3, size=ilines.shape)
+    return np.stack([ilines.ravel(), xlines.ravel(), depths.ravel()], axis=1).astype(np.int32)
+
+
+@pytest.fixture(scope='module')
+def labels():
+    """ Two labels in the first cube and one in the second. Surfaces near the bottom are moved to the cube end. """
+    bottom = make_surface(SHAPES['A'], seed=1)
+    bottom[:, 2] = SHAPES['A'][2] - 1
+    return {'A': [SimpleNamespace(points=make_surface(SHAPES['A'], seed=0)), SimpleNamespace(points=bottom)],
+            'B': [SimpleNamespace(points=make_surface(SHAPES['B'], seed=2))]}
+
+@pytest.fixture(scope='module')
+def geometries():
+    """ Stand-ins for geometries: only the shape of the cube is needed. """
+    return {name: SimpleNamespace(cube_shape=np.array(shape), name=name) for name, shape in SHAPES.items()}
+
+@pytest.fixture(scope='module')
+def volumes(labels):
+    """ Binary volume of label points for each cube. """
+    result = {}
+    for name, shape in SHAPES.items():
+        volume = np.zeros(shape, dtype=bool)
+        for label in labels[name]:
+            volume[label.points[:, 0], label.points[:, 1], label.points[:, 2]] = True
+        result[name] = volume
+    return result
+
+
+def make_slices(points, geometries, shape):
+    """ Slices of crops, as made by :meth:`.SeismicCropBatch.crop`. """
+    batch = SimpleNamespace(get=lambda ix, component: geometries[ix])
+    return [SeismicCropBatch._make_slice(batch, point, shape) for point in points]
+
+
+def test_points_are_labels(labels, geometries, volumes):
+    """ Without `crop_shape`, sampled points are label points themselves. """
+    sampler = AliasSampler.from_labels(labels, geometries, seed=0)
+    points = sampler.sample(2000)
+    for name, i, x, h in points:
+        assert volumes[name][i, x, h]
+
+
+@pytest.mark.parametrize('unit', [False, True])
+def test_crops_contain_labels(labels, geometries, volumes, unit):
+    """ With `crop_shape`, every crop cut at the sampled point contains label points. """
+    sampler = AliasSampler.from_labels(labels, geometries, crop_shape=CROP_SHAPE, unit=unit, seed=0)
+    points = sampler.sample(2000)
+    assert all(isinstance(value, float) == unit for value in points[:, 1:].ravel())
+
+    for point, slices in zip(points, make_slices(points, geometries, CROP_SHAPE)):
+        assert [item.stop - item.start for item in slices] == list(CROP_SHAPE)
+        assert volumes[point[0]][tuple(slices)].any()
+
+def test_label_positions_inside_crops(labels, geometries):
+    """ Label points are not stuck to the top of the crop: depth of the surface inside crops covers the crop. """
+    sampler = AliasSampler.from_labels({'B': labels['B']}, geometries, crop_shape=CROP_SHAPE, seed=0)
+    points = sampler.sample(5000)
+    surface = labels['B'][0].points
+
+    depths = np.zeros(CROP_SHAPE[2], dtype=np.int64)
+    for point in points:
+        i_start, x_start, h_start = point[1:].astype(int)
+        inside = ((surface[:, 0] >= i_start) & (surface[:, 0] < i_start + CROP_SHAPE[0]) &
+                  (surface[:, 1] >= x_start) & (surface[:, 1] < x_start + CROP_SHAPE[1]))
+        relative = surface[inside, 2] - h_start
+        relative = relative[(relative >= 0) & (relative < CROP_SHAPE[2])]
+        depths[np.unique(relative)] += 1
+    assert (depths > 0).all()
+
+
+def test_cube_weights(labels, geometries):
+    """ Cubes are chosen with given probabilities. """
+    sampler = AliasSampler.from_labels(labels, geometries, p=[0.8, 0.2], seed=0)
+    names = sampler.sample(20000)[:, 0]
+    assert np.isclose(np.mean(names == 'A'), 0.8, atol=0.02)
+
+    sampler = AliasSampler.from_labels(labels, geometries, p=[0, 1], seed=0)
+    assert (sampler.sample(1000)[:, 0] == 'B').all()
+
+
+def test_crop_bigger_than_cube(labels, geometries):
+    """ Crops must fit into each of the cubes. """
+    with pytest.raises(ValueError):
+        AliasSampler.from_labels(labels, geometries, crop_shape=(8, 30, 16))
+
+
+@pytest.mark.parametrize('unit', [False, True])
+def test_correct_point_to_grid(unit):
+    """ Point is moved to the closest trace of the grid and stays in the same coordinate system. """
+    geometry = SimpleNamespace(cube_shape=np.array([20, 20, 50]), quality_grid=np.zeros((20, 20)))
+    geometry.quality_grid[::5, :] = 1
+    batch = SimpleNamespace(get=lambda ix, component: geometry)
+
+    point = np.array(['A', 6, 7, 10], dtype=object)
+    if unit:
+        point[1:] = point[1:] / geometry.cube_shape
+    corrected, _ = SeismicCropBatch._correct_point_to_grid(batch, point, np.array(CROP_SHAPE))
+
+    location = corrected[1:] * geometry.cube_shape if unit else corrected[1:]
+    assert np.allclose(location.astype(float), [5, 7, 10])
+    assert all(isinstance(value, float) == unit for value in corrected[1:])